@@ -1,17 +1,32 @@
+import asyncio
+import functools
 import logging
 from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
 import json
-import os
 import requests
 import hmac
 import hashlib
+import itertools
 import time
 from datetime import datetime, timedelta
 import pytz
 from urllib.parse import urlencode
-from config import TELEGRAM_BOT_TOKEN, USER_DATA_FILE, USER_STATES_FILE, BYBIT_API_URL
-from security import encrypt_data, decrypt_data
+from config import (
+    TELEGRAM_BOT_TOKEN, USER_DATA_FILE, USER_STATES_FILE, BYBIT_API_URL,
+    STORAGE_BACKEND, USER_DATA_DIR, USER_DATA_SHARDS, USER_DATA_DB, USER_DATA_FLUSH_INTERVAL, USER_DATA_COMMIT_WINDOW,
+    USER_DATA_JOURNAL, JOURNAL_COMPACT_INTERVAL, USER_STATE_TTL, USER_STATES_FLUSH_INTERVAL, REMINDER_SCHEDULER,
+    REMINDER_BATCH_SIZE, DELIVERY_WORKERS, DELIVERY_GLOBAL_RATE, DELIVERY_CHAT_RATE, DELIVERY_RETRY_BASE,
+    DELIVERY_RETRY_MAX, DELIVERY_MAX_ATTEMPTS, DELIVERY_LEDGER_DB, DELIVERY_LEDGER_RETENTION, COORDINATION_DB, SCHEDULER_LEASE_TTL,
+    SCHEDULER_MODE, USER_DATA_REFRESH_INTERVAL
+)
+from security import encrypt_data, decrypt_cached, invalidate_credentials
+from migrations import DEFAULT_TIMEZONE, get_timezone, new_user_record, migrate_all, set_scheduled_time, user_timezone
+from recurrence import Recurrence, preset
+from scheduler import ReminderQueue, TimingWheel
+from coordination import Lease, Membership, partition_of
+from delivery import Dispatcher, DeliveryLedger, retry_delay, is_permanent_failure
+from storage import UserDataStore, StateStore, JsonFileBackend, ShardedJsonBackend, SqliteBackend, JournalBackend
 
 # Enable logging
 logging.basicConfig(
@@ -29,95 +44,58 @@ logger = logging.getLogger(__name__)
 DATA_FILE = USER_DATA_FILE
 USER_STATES = USER_STATES_FILE
 
-# Load or create user data
-def load_user_data():
-    if os.path.exists(DATA_FILE):
-        with open(DATA_FILE, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            # Decrypt API keys when loading
-            for user_id in data:
-                if 'bybit_api_key' in data[user_id]:
-                    decrypted_key = decrypt_data(data[user_id]['bybit_api_key'])
-                    # Check if decryption failed
-                    if decrypted_key == "__DECRYPTION_FAILED__":
-                        # Reset the key if decryption failed
-                        data[user_id]['bybit_api_key'] = ''
-                    else:
-                        data[user_id]['bybit_api_key'] = decrypted_key
-                if 'bybit_api_secret' in data[user_id]:
-                    decrypted_secret = decrypt_data(data[user_id]['bybit_api_secret'])
-                    # Check if decryption failed
-                    if decrypted_secret == "__DECRYPTION_FAILED__":
-                        # Reset the secret if decryption failed
-                        data[user_id]['bybit_api_secret'] = ''
-                    else:
-                        data[user_id]['bybit_api_secret'] = decrypted_secret
-            return data
-    else:
-        return {}
+# Pick the on-disk layout for user data
+def create_storage_backend():
+    if STORAGE_BACKEND == 'sharded':
+        return ShardedJsonBackend(USER_DATA_DIR, USER_DATA_SHARDS)
+    if STORAGE_BACKEND == 'sqlite':
+        return SqliteBackend(USER_DATA_DB)
+    if STORAGE_BACKEND == 'journal':
+        return JournalBackend(DATA_FILE, USER_DATA_JOURNAL)
+    return JsonFileBackend(DATA_FILE)
+
+# Process-wide user data repository: loaded once, flushed in the background
+user_store = UserDataStore(
+    create_storage_backend(),
+    flush_interval=USER_DATA_FLUSH_INTERVAL,
+    commit_window=USER_DATA_COMMIT_WINDOW,
+    new_record=new_user_record
+)
 
-# Save user data with file locking to prevent concurrent writes
-def save_user_data(data):
-    try:
-        # Import portalocker for file locking
-        import portalocker
-        
-        # Encrypt API keys before saving
-        data_to_save = {}
-        for user_id in data:
-            data_to_save[user_id] = data[user_id].copy()
-            if 'bybit_api_key' in data_to_save[user_id]:
-                # Don't encrypt the error marker
-                if data_to_save[user_id]['bybit_api_key'] != "__DECRYPTION_FAILED__":
-                    data_to_save[user_id]['bybit_api_key'] = encrypt_data(data_to_save[user_id]['bybit_api_key'])
-            if 'bybit_api_secret' in data_to_save[user_id]:
-                # Don't encrypt the error marker
-                if data_to_save[user_id]['bybit_api_secret'] != "__DECRYPTION_FAILED__":
-                    data_to_save[user_id]['bybit_api_secret'] = encrypt_data(data_to_save[user_id]['bybit_api_secret'])
-        
-        # Write to temporary file first
-        temp_file = DATA_FILE + ".tmp"
-        with open(temp_file, 'w', encoding='utf-8') as f:
-            # Lock the file
-            portalocker.lock(f, portalocker.LOCK_EX)
-            json.dump(data_to_save, f, indent=2, ensure_ascii=False)
-            # Unlock the file
-            portalocker.unlock(f)
-        
-        # Atomically rename temp file to data file
-        os.replace(temp_file, DATA_FILE)
-    except ImportError:
-        # Fallback to original method if portalocker is not available
-        logger.warning("portalocker not available, using fallback method for file locking")
-        
-        # Encrypt API keys before saving
-        data_to_save = {}
-        for user_id in data:
-            data_to_save[user_id] = data[user_id].copy()
-            if 'bybit_api_key' in data_to_save[user_id]:
-                # Don't encrypt the error marker
-                if data_to_save[user_id]['bybit_api_key'] != "__DECRYPTION_FAILED__":
-                    data_to_save[user_id]['bybit_api_key'] = encrypt_data(data_to_save[user_id]['bybit_api_key'])
-            if 'bybit_api_secret' in data_to_save[user_id]:
-                # Don't encrypt the error marker
-                if data_to_save[user_id]['bybit_api_secret'] != "__DECRYPTION_FAILED__":
-                    data_to_save[user_id]['bybit_api_secret'] = encrypt_data(data_to_save[user_id]['bybit_api_secret'])
-        
-        with open(DATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data_to_save, f, indent=2, ensure_ascii=False)
-
-# Load or create user states
-def load_user_states():
-    if os.path.exists(USER_STATES):
-        with open(USER_STATES, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    else:
-        return {}
+# Handlers read user data with `await user_store.get_all()` / `get_user()` and
+# report changes with `await user_store.commit(user_id)`, or use
+# `async with user_store.transaction(user_id) as user:`; disk reads and
+# writes happen in executor threads, never on the event loop.
 
-# Save user states
-def save_user_states(states):
-    with open(USER_STATES, 'w', encoding='utf-8') as f:
-        json.dump(states, f, indent=2, ensure_ascii=False)
+# Updates are processed concurrently; run each one under its user's lock so
+# updates of the same user (and the reminder scheduler) never interleave
+def per_user(handler):
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        if update.effective_user is None:
+            return await handler(update, context)
+        async with user_store.lock(update.effective_user.id):
+            user = await user_store.get_user(update.effective_user.id)
+            if user is not None and user.pop('reminders_blocked', None) is not None:
+                # The user is writing to the bot again, so reminders can reach them
+                user_store.mark_dirty(update.effective_user.id)
+            return await handler(update, context)
+    return wrapper
+
+# API keys stay encrypted in user data and are only decrypted when a
+# handler actually needs them
+async def get_api_credential(user_id, field):
+    user = await user_store.get_user(user_id) or {}
+    decrypted = decrypt_cached(user_id, user.get(field, ''))
+    # Treat a key that can't be decrypted as not set
+    return '' if decrypted == "__DECRYPTION_FAILED__" else decrypted
+
+async def get_api_credentials(user_id):
+    return await get_api_credential(user_id, 'bybit_api_key'), await get_api_credential(user_id, 'bybit_api_secret')
+
+# Conversation states live in memory, expire on their own and are
+# snapshotted to USER_STATES in the background; handlers change them in place
+user_state_store = StateStore(USER_STATES, ttl=USER_STATE_TTL, flush_interval=USER_STATES_FLUSH_INTERVAL)
 
 # Bybit API functions
 def get_bybit_signature(api_key, api_secret, params, timestamp):
@@ -219,51 +197,21 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.effective_user is None:
         return
     user_id = str(update.effective_user.id)
-    user_data = load_user_data()
-    user_states = load_user_states()
+    user_data = await user_store.get_all()
+    user_states = user_state_store
     
     # Delete user's message for privacy
     # if update.message:
     #     delete_message(context, update.effective_chat.id, update.message.message_id)
     
-    # Initialize user data if not exists
+    # Initialize user data if not exists; existing users were brought to the
+    # current schema at startup
     if user_id not in user_data:
-        user_data[user_id] = {
-            'bybit_api_key': '',
-            'bybit_api_secret': '',
-            'piggy_banks': {},
-            'shopping_list': {
-                'Продукты': [],
-                'Аптека': [],
-                'Остальное': []
-            },
-            'reminders': {}
-        }
-        save_user_data(user_data)
-    else:
-        # Ensure shopping list structure exists for existing users
-        if 'shopping_list' not in user_data[user_id]:
-            user_data[user_id]['shopping_list'] = {
-                'Продукты': [],
-                'Аптека': [],
-                'Остальное': []
-            }
-        else:
-            # Ensure all categories exist
-            categories = ['Продукты', 'Аптека', 'Остальное']
-            for category in categories:
-                if category not in user_data[user_id]['shopping_list']:
-                    user_data[user_id]['shopping_list'][category] = []
-        
-        # Ensure reminders structure exists
-        if 'reminders' not in user_data[user_id]:
-            user_data[user_id]['reminders'] = {}
-            
-        save_user_data(user_data)
+        user_data[user_id] = new_user_record()
+        await user_store.commit(user_id)
     
     if user_id in user_states:
         del user_states[user_id]
-        save_user_states(user_states)
     
     # Create a comprehensive menu with all functionality
     keyboard = [
@@ -325,8 +273,8 @@ async def handle_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     if update.effective_user is None:
         return
     user_id = str(update.effective_user.id)
-    user_states = load_user_states()
-    user_data = load_user_data()
+    user_states = user_state_store
+    user_data = await user_store.get_all()
     
     # Delete user's message for privacy
     # delete_message(context, update.effective_chat.id, update.message.message_id)
@@ -342,6 +290,9 @@ async def handle_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         elif state == 'WAITING_API_SECRET':
             await handle_api_secret_input(update, context)
             return
+        elif state == 'WAITING_TIMEZONE':
+            await handle_timezone_input(update, context)
+            return
         # Handle piggy bank creation
         elif state == 'CREATING_PIGGY_NAME':
             await handle_piggy_name_input(update, context)
@@ -375,21 +326,9 @@ async def handle_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             # Log for debugging
             logger.info(f"Creating reminder with title: {title}, reminder_id: {reminder_id}")
             
-            # Initialize reminder structure
+            # Initialize user data if not exists
             if user_id not in user_data:
-                user_data[user_id] = {
-                    'bybit_api_key': '',
-                    'bybit_api_secret': '',
-                    'piggy_banks': {},
-                    'shopping_list': {
-                        'Продукты': [],
-                        'Аптека': [],
-                        'Остальное': []
-                    },
-                    'reminders': {}
-                }
-            elif 'reminders' not in user_data[user_id]:
-                user_data[user_id]['reminders'] = {}
+                user_data[user_id] = new_user_record()
                 
             user_data[user_id]['reminders'][reminder_id] = {
                 'title': title,
@@ -403,12 +342,11 @@ async def handle_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             logger.info(f"Created reminder: {user_data[user_id]['reminders'][reminder_id]}")
             
             # Save user data
-            save_user_data(user_data)
+            await user_store.commit(user_id)
             
             # Go directly to date/time selection
             # Update user state to select date
             user_states[user_id] = f'add_reminder_date_{reminder_id}'
-            save_user_states(user_states)
             
             # Provide quick date options including new ones
             keyboard = [
@@ -430,7 +368,7 @@ async def handle_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             
             # Rename category
             user_data[user_id]['shopping_list'][new_category_name] = user_data[user_id]['shopping_list'].pop(category_name)
-            save_user_data(user_data)
+            await user_store.commit(user_id)
             
             await update.message.reply_text(
                 f'Категория переименована: {new_category_name}.',
@@ -441,34 +379,17 @@ async def handle_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             # Handle adding new shopping list category
             category_name = update.message.text
             
-            # Initialize shopping list if not exists
+            # Initialize user data if not exists
             if user_id not in user_data:
-                user_data[user_id] = {
-                    'bybit_api_key': '',
-                    'bybit_api_secret': '',
-                    'piggy_banks': {},
-                    'shopping_list': {
-                        'Продукты': [],
-                        'Аптека': [],
-                        'Остальное': []
-                    },
-                    'reminders': {}
-                }
-            elif 'shopping_list' not in user_data[user_id]:
-                user_data[user_id]['shopping_list'] = {
-                    'Продукты': [],
-                    'Аптека': [],
-                    'Остальное': []
-                }
+                user_data[user_id] = new_user_record()
             
             # Add new category if it doesn't exist
             if category_name not in user_data[user_id]['shopping_list']:
                 user_data[user_id]['shopping_list'][category_name] = []
-                save_user_data(user_data)
+                await user_store.commit(user_id)
                 
                 # Clear user state
                 del user_states[user_id]
-                save_user_states(user_states)
                 
                 keyboard = [
                     [InlineKeyboardButton('🛒 Список покупок', callback_data='shopping_list_menu')],
@@ -490,7 +411,6 @@ async def handle_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             if user_id in user_data and reminder_id in user_data[user_id]['reminders']:
                 # Update user state to select date
                 user_states[user_id] = f'add_reminder_date_{reminder_id}'
-                save_user_states(user_states)
                 
                 # Provide quick date options including new ones
                 keyboard = [
@@ -513,25 +433,21 @@ async def handle_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             
             # Parse the natural language date
             try:
-                parsed_datetime = parse_natural_date(update.message.text)
+                tz = user_timezone(user_data.get(user_id, {}))
+                parsed_datetime = parse_natural_date(update.message.text, tz)
                 
-                # Convert to ISO format with timezone
-                import pytz
-                DEFAULT_TIMEZONE = pytz.timezone('Europe/Moscow')
+                # Make sure the time has a timezone
                 if parsed_datetime.tzinfo is None:
-                    # Localize to default timezone if no timezone info
-                    parsed_datetime = DEFAULT_TIMEZONE.localize(parsed_datetime)
-                
-                iso_datetime = parsed_datetime.isoformat()
+                    # Localize to the user's timezone if no timezone info
+                    parsed_datetime = tz.normalize(tz.localize(parsed_datetime))
                 
                 # Save the date and time to the reminder
                 if user_id in user_data and reminder_id in user_data[user_id]['reminders']:
-                    user_data[user_id]['reminders'][reminder_id]['scheduled_at'] = iso_datetime
-                    save_user_data(user_data)
+                    reschedule_reminder(user_data[user_id], user_data[user_id]['reminders'][reminder_id], parsed_datetime)
+                    await user_store.commit(user_id)
                     
                     # Clear user state
                     del user_states[user_id]
-                    save_user_states(user_states)
                     
                     reminder = user_data[user_id]['reminders'][reminder_id]
                     title = reminder.get('title', 'Без заголовка')
@@ -568,11 +484,10 @@ async def handle_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             # Save the time to the reminder
             if user_id in user_data and reminder_id in user_data[user_id]['reminders']:
                 user_data[user_id]['reminders'][reminder_id]['time'] = time_input
-                save_user_data(user_data)
+                await user_store.commit(user_id)
                 
                 # Clear user state
                 del user_states[user_id]
-                save_user_states(user_states)
                 
                 reminder = user_data[user_id]['reminders'][reminder_id]
                 title = reminder.get('title', 'Без заголовка')
@@ -594,11 +509,10 @@ async def handle_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             
             if user_id in user_data and reminder_id in user_data[user_id]['reminders']:
                 user_data[user_id]['reminders'][reminder_id]['content'] = content
-                save_user_data(user_data)
+                await user_store.commit(user_id)
                 
                 # Clear user state
                 del user_states[user_id]
-                save_user_states(user_states)
                 
                 keyboard = [[InlineKeyboardButton('⬅️ Назад к напоминанию', callback_data=f'view_reminder_{reminder_id}')]]
                 reply_markup = InlineKeyboardMarkup(keyboard)
@@ -614,26 +528,22 @@ async def handle_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             
             # Parse the natural language date
             try:
-                parsed_datetime = parse_natural_date(update.message.text)
+                tz = user_timezone(user_data.get(user_id, {}))
+                parsed_datetime = parse_natural_date(update.message.text, tz)
                 
-                # Convert to ISO format with timezone
-                import pytz
-                DEFAULT_TIMEZONE = pytz.timezone('Europe/Moscow')
+                # Make sure the time has a timezone
                 if parsed_datetime.tzinfo is None:
-                    # Localize to default timezone if no timezone info
-                    parsed_datetime = DEFAULT_TIMEZONE.localize(parsed_datetime)
-                
-                iso_datetime = parsed_datetime.isoformat()
+                    # Localize to the user's timezone if no timezone info
+                    parsed_datetime = tz.normalize(tz.localize(parsed_datetime))
                 
                 # Save the date and time to the reminder
                 if user_id in user_data and reminder_id in user_data[user_id]['reminders']:
-                    user_data[user_id]['reminders'][reminder_id]['scheduled_at'] = iso_datetime
+                    reschedule_reminder(user_data[user_id], user_data[user_id]['reminders'][reminder_id], parsed_datetime)
                     user_data[user_id]['reminders'][reminder_id]['sent'] = False  # Reset sent flag
-                    save_user_data(user_data)
+                    await user_store.commit(user_id)
                     
                     # Clear user state
                     del user_states[user_id]
-                    save_user_states(user_states)
                     
                     reminder = user_data[user_id]['reminders'][reminder_id]
                     title = reminder.get('title', 'Без заголовка')
@@ -666,7 +576,6 @@ async def handle_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         if not text.startswith(('➕ Создать копилку', '✏️ Редактировать', '💰 Положить', '💸 Снять')):
             if text not in ['🔑 Ввести API ключи', '➕ Добавить']:
                 del user_states[user_id]
-                save_user_states(user_states)
     
     # Handle menu selections
     if text == '💰 Крипта':
@@ -732,21 +641,23 @@ async def handle_settings_menu(update: Update, context: ContextTypes.DEFAULT_TYP
     if update.effective_user is None:
         return
     user_id = str(update.effective_user.id)
-    user_data = load_user_data()
     
     keyboard = [
         [InlineKeyboardButton('🔑 Ввести API ключи', callback_data='enter_api_keys')],
+        [InlineKeyboardButton('🌍 Часовой пояс', callback_data='timezone_menu')],
         [InlineKeyboardButton('🏠 Главная', callback_data='main_menu')]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     api_info = "API ключи не установлены"
-    if user_data.get(user_id, {}).get('bybit_api_key'):
-        api_info = f"API Key установлен: {user_data[user_id]['bybit_api_key'][:5]}...{user_data[user_id]['bybit_api_key'][-5:]}"
+    api_key = await get_api_credential(user_id, 'bybit_api_key')
+    if api_key:
+        api_info = f"API Key установлен: {api_key[:5]}...{api_key[-5:]}"
     
     await update.message.reply_text(
         f'⚙️ Настройки бота:\n\n'
-        f'{api_info}\n\n'
+        f'{api_info}\n'
+        f'Часовой пояс: {user_timezone(await user_store.get_user(user_id) or {}).zone}\n\n'
         f'Выберите действие:',
         reply_markup=reply_markup
     )
@@ -754,21 +665,23 @@ async def handle_settings_menu(update: Update, context: ContextTypes.DEFAULT_TYP
 # Handle settings menu callback
 async def handle_settings_menu_callback(query, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = str(query.from_user.id)
-    user_data = load_user_data()
     
     keyboard = [
         [InlineKeyboardButton('🔑 Ввести API ключи', callback_data='enter_api_keys')],
+        [InlineKeyboardButton('🌍 Часовой пояс', callback_data='timezone_menu')],
         [InlineKeyboardButton('🏠 Главная', callback_data='main_menu')]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     api_info = "API ключи не установлены"
-    if user_data.get(user_id, {}).get('bybit_api_key'):
-        api_info = f"API Key установлен: {user_data[user_id]['bybit_api_key'][:5]}...{user_data[user_id]['bybit_api_key'][-5:]}"
+    api_key = await get_api_credential(user_id, 'bybit_api_key')
+    if api_key:
+        api_info = f"API Key установлен: {api_key[:5]}...{api_key[-5:]}"
     
     await query.edit_message_text(
         f'⚙️ Настройки бота:\n\n'
-        f'{api_info}\n\n'
+        f'{api_info}\n'
+        f'Часовой пояс: {user_timezone(await user_store.get_user(user_id) or {}).zone}\n\n'
         f'Выберите действие:',
         reply_markup=reply_markup
     )
@@ -822,16 +735,14 @@ async def handle_crypto_menu(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if update.effective_user is None:
         return
     user_id = str(update.effective_user.id)
-    user_data = load_user_data()
     
     # Check if API keys are set
-    api_key = user_data.get(user_id, {}).get('bybit_api_key')
-    api_secret = user_data.get(user_id, {}).get('bybit_api_secret')
+    api_key, api_secret = await get_api_credentials(user_id)
     
     # Check for decryption errors
     if api_key == "__DECRYPTION_FAILED__" or api_secret == "__DECRYPTION_FAILED__":
         # Reset the keys and prompt user to re-enter them
-        reset_user_api_keys(user_id)
+        await reset_user_api_keys(user_id)
         keyboard = [
             [InlineKeyboardButton('🔑 Ввести API ключи', callback_data='enter_api_keys')],
             [InlineKeyboardButton('🏠 Главная', callback_data='main_menu')]
@@ -913,16 +824,14 @@ async def handle_crypto_menu(update: Update, context: ContextTypes.DEFAULT_TYPE)
 # Handle crypto menu callback
 async def handle_crypto_menu_callback(query, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = str(query.from_user.id)
-    user_data = load_user_data()
     
     # Check if API keys are set
-    api_key = user_data.get(user_id, {}).get('bybit_api_key')
-    api_secret = user_data.get(user_id, {}).get('bybit_api_secret')
+    api_key, api_secret = await get_api_credentials(user_id)
     
     # Check for decryption errors
     if api_key == "__DECRYPTION_FAILED__" or api_secret == "__DECRYPTION_FAILED__":
         # Reset the keys and prompt user to re-enter them
-        reset_user_api_keys(user_id)
+        await reset_user_api_keys(user_id)
         keyboard = [
             [InlineKeyboardButton('🔑 Ввести API ключи', callback_data='enter_api_keys')],
             [InlineKeyboardButton('🏠 Главная', callback_data='main_menu')]
@@ -1004,7 +913,7 @@ async def handle_crypto_menu_callback(query, context: ContextTypes.DEFAULT_TYPE)
 # Handle crypto stats callback
 async def handle_crypto_stats_callback(query, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = str(query.from_user.id)
-    user_data = load_user_data()
+    user_data = await user_store.get_all()
     
     # Check if API keys are set
     if not user_data.get(user_id, {}).get('bybit_api_key') or not user_data.get(user_id, {}).get('bybit_api_secret'):
@@ -1037,7 +946,7 @@ async def handle_crypto_stats_callback(query, context: ContextTypes.DEFAULT_TYPE
 # Handle crypto balance callback
 async def handle_crypto_balance_callback(query, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = str(query.from_user.id)
-    user_data = load_user_data()
+    user_data = await user_store.get_all()
     
     # Check if API keys are set
     if not user_data.get(user_id, {}).get('bybit_api_key') or not user_data.get(user_id, {}).get('bybit_api_secret'):
@@ -1055,8 +964,7 @@ async def handle_crypto_balance_callback(query, context: ContextTypes.DEFAULT_TY
     
     # Fetch data from Bybit API
     try:
-        api_key = user_data[user_id]['bybit_api_key']
-        api_secret = user_data[user_id]['bybit_api_secret']
+        api_key, api_secret = await get_api_credentials(user_id)
         
         # Get wallet balance
         balance_data = get_bybit_wallet_balance(api_key, api_secret)
@@ -1141,7 +1049,6 @@ async def handle_crypto_balance_callback(query, context: ContextTypes.DEFAULT_TY
 # Handle crypto settings callback
 async def handle_crypto_settings_callback(query, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = str(query.from_user.id)
-    user_data = load_user_data()
     
     keyboard = [
         [InlineKeyboardButton('🔑 Ввести API ключи', callback_data='enter_api_keys')],
@@ -1150,8 +1057,9 @@ async def handle_crypto_settings_callback(query, context: ContextTypes.DEFAULT_T
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     api_info = "API ключи не установлены"
-    if user_data.get(user_id, {}).get('bybit_api_key'):
-        api_info = f"API Key установлен: {user_data[user_id]['bybit_api_key'][:5]}...{user_data[user_id]['bybit_api_key'][-5:]}"
+    api_key = await get_api_credential(user_id, 'bybit_api_key')
+    if api_key:
+        api_info = f"API Key установлен: {api_key[:5]}...{api_key[-5:]}"
     
     await query.edit_message_text(
         f'⚙️ Настройки Bybit:\n\n'
@@ -1168,15 +1076,13 @@ async def handle_crypto_submenu(update: Update, context: ContextTypes.DEFAULT_TY
     if update.effective_user is None:
         return
     user_id = str(update.effective_user.id)
-    user_data = load_user_data()
     
     # Check for decryption errors
-    api_key = user_data.get(user_id, {}).get('bybit_api_key')
-    api_secret = user_data.get(user_id, {}).get('bybit_api_secret')
+    api_key, api_secret = await get_api_credentials(user_id)
     
     if api_key == "__DECRYPTION_FAILED__" or api_secret == "__DECRYPTION_FAILED__":
         # Reset the keys and prompt user to re-enter them
-        reset_user_api_keys(user_id)
+        await reset_user_api_keys(user_id)
         keyboard = [
             [InlineKeyboardButton('🔑 Ввести API ключи', callback_data='enter_api_keys')],
             [InlineKeyboardButton('🏠 Главная', callback_data='main_menu')]
@@ -1292,8 +1198,9 @@ async def handle_crypto_submenu(update: Update, context: ContextTypes.DEFAULT_TY
         reply_markup = InlineKeyboardMarkup(keyboard)
         
         api_info = ""
-        if user_data.get(user_id, {}).get('bybit_api_key'):
-            api_info = f"\nAPI Key: {user_data[user_id]['bybit_api_key'][:5]}...{user_data[user_id]['bybit_api_key'][-5:]}"
+        api_key = await get_api_credential(user_id, 'bybit_api_key')
+        if api_key:
+            api_info = f"\nAPI Key: {api_key[:5]}...{api_key[-5:]}"
         
         await update.message.reply_text(
             f'⚙️ Настройки Bybit:{api_info}\n\nВыберите действие:',
@@ -1305,10 +1212,9 @@ async def handle_enter_api_keys(update: Update, context: ContextTypes.DEFAULT_TY
     if update.effective_user is None:
         return
     user_id = str(update.effective_user.id)
-    user_states = load_user_states()
+    user_states = user_state_store
     
     user_states[user_id] = 'WAITING_API_KEY'
-    save_user_states(user_states)
     
     keyboard = [
         [InlineKeyboardButton('🏠 Главная', callback_data='main_menu')]
@@ -1323,10 +1229,9 @@ async def handle_enter_api_keys(update: Update, context: ContextTypes.DEFAULT_TY
 # Handle enter API keys callback
 async def handle_enter_api_keys_callback(query, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = str(query.from_user.id)
-    user_states = load_user_states()
+    user_states = user_state_store
     
     user_states[user_id] = 'WAITING_API_KEY'
-    save_user_states(user_states)
     
     keyboard = [
         [InlineKeyboardButton('🏠 Главная', callback_data='main_menu')]
@@ -1343,23 +1248,17 @@ async def handle_api_key_input(update: Update, context: ContextTypes.DEFAULT_TYP
     if update.effective_user is None:
         return
     user_id = str(update.effective_user.id)
-    user_data = load_user_data()
-    user_states = load_user_states()
+    user_states = user_state_store
     
     if user_id not in user_states or user_states[user_id] != 'WAITING_API_KEY':
         return
         
     # Save API key
-    if user_id not in user_data:
-        user_data[user_id] = {}
-    if 'bybit_api_key' not in user_data[user_id]:
-        user_data[user_id]['bybit_api_key'] = ''
-        
-    user_data[user_id]['bybit_api_key'] = update.message.text
-    save_user_data(user_data)
+    async with user_store.transaction(user_id) as user:
+        user['bybit_api_key'] = encrypt_data(update.message.text)
+    invalidate_credentials(user_id)
     
     del user_states[user_id]
-    save_user_states(user_states)
     
     # After saving API key, ask for API secret and stay in settings
     keyboard = [
@@ -1374,30 +1273,23 @@ async def handle_api_key_input(update: Update, context: ContextTypes.DEFAULT_TYP
     
     # Set state to wait for secret
     user_states[user_id] = 'WAITING_API_SECRET'
-    save_user_states(user_states)
 
 # Handle API secret input
 async def handle_api_secret_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.effective_user is None:
         return
     user_id = str(update.effective_user.id)
-    user_data = load_user_data()
-    user_states = load_user_states()
+    user_states = user_state_store
     
     if user_id not in user_states or user_states[user_id] != 'WAITING_API_SECRET':
         return
         
     # Save API secret
-    if user_id not in user_data:
-        user_data[user_id] = {}
-    if 'bybit_api_secret' not in user_data[user_id]:
-        user_data[user_id]['bybit_api_secret'] = ''
-        
-    user_data[user_id]['bybit_api_secret'] = update.message.text
-    save_user_data(user_data)
+    async with user_store.transaction(user_id) as user:
+        user['bybit_api_secret'] = encrypt_data(update.message.text)
+    invalidate_credentials(user_id)
     
     del user_states[user_id]
-    save_user_states(user_states)
     
     # After saving API keys, show crypto menu
     keyboard = [
@@ -1411,20 +1303,108 @@ async def handle_api_secret_input(update: Update, context: ContextTypes.DEFAULT_
         reply_markup=reply_markup
     )
 
+# Timezones offered as buttons in the timezone settings; any other IANA name can be typed in
+COMMON_TIMEZONES = [
+    ('Калининград', 'Europe/Kaliningrad'),
+    ('Москва', 'Europe/Moscow'),
+    ('Самара', 'Europe/Samara'),
+    ('Екатеринбург', 'Asia/Yekaterinburg'),
+    ('Омск', 'Asia/Omsk'),
+    ('Новосибирск', 'Asia/Novosibirsk'),
+    ('Иркутск', 'Asia/Irkutsk'),
+    ('Владивосток', 'Asia/Vladivostok'),
+]
+
+# Handle timezone menu callback
+async def handle_timezone_menu_callback(query, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = str(query.from_user.id)
+    current = user_timezone(await user_store.get_user(user_id) or {}).zone
+
+    keyboard = [
+        [InlineKeyboardButton(f'{"✅ " if zone == current else ""}{name}', callback_data=f'set_timezone_{zone}')
+         for name, zone in COMMON_TIMEZONES[i:i + 2]]
+        for i in range(0, len(COMMON_TIMEZONES), 2)
+    ]
+    keyboard.append([InlineKeyboardButton('✏️ Другой', callback_data='set_timezone_other')])
+    keyboard.append([InlineKeyboardButton('⬅️ Назад', callback_data='settings_menu')])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    await query.edit_message_text(
+        f'🌍 Часовой пояс: {current}\n\n'
+        f'Напоминания приходят по времени этого пояса. Выберите свой:',
+        reply_markup=reply_markup
+    )
+
+# Handle timezone selection callback
+async def handle_set_timezone_callback(query, context: ContextTypes.DEFAULT_TYPE, zone: str) -> None:
+    user_id = str(query.from_user.id)
+
+    if zone == 'other':
+        user_states = user_state_store
+        user_states[user_id] = 'WAITING_TIMEZONE'
+
+        keyboard = [[InlineKeyboardButton('⬅️ Назад', callback_data='timezone_menu')]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+
+        await query.edit_message_text(
+            'Введите часовой пояс в формате Регион/Город, например Europe/Berlin или Asia/Almaty:',
+            reply_markup=reply_markup
+        )
+        return
+
+    if get_timezone(zone) is None:
+        await query.edit_message_text('❌ Ошибка: неизвестный часовой пояс')
+        return
+    async with user_store.transaction(user_id) as user:
+        user['timezone'] = zone
+    await handle_timezone_menu_callback(query, context)
+
+# Handle timezone input
+async def handle_timezone_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user is None:
+        return
+    user_id = str(update.effective_user.id)
+    user_states = user_state_store
+
+    if user_id not in user_states or user_states[user_id] != 'WAITING_TIMEZONE':
+        return
+
+    zone = update.message.text.strip()
+    if get_timezone(zone) is None:
+        await update.message.reply_text(
+            '❌ Неизвестный часовой пояс. Введите его в формате Регион/Город, например Europe/Berlin:'
+        )
+        return
+
+    # Already scheduled reminders keep their moment in time; new ones use the new timezone
+    async with user_store.transaction(user_id) as user:
+        user['timezone'] = get_timezone(zone).zone
+
+    del user_states[user_id]
+
+    keyboard = [[InlineKeyboardButton('⚙️ Настройки', callback_data='settings_menu')]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    await update.message.reply_text(
+        f'✅ Часовой пояс сохранен: {get_timezone(zone).zone}',
+        reply_markup=reply_markup
+    )
+
 # Function to reset user API keys
-def reset_user_api_keys(user_id):
-    user_data = load_user_data()
+async def reset_user_api_keys(user_id):
+    user_data = await user_store.get_all()
     if user_id in user_data:
         user_data[user_id]['bybit_api_key'] = ''
         user_data[user_id]['bybit_api_secret'] = ''
-        save_user_data(user_data)
+        await user_store.commit(user_id)
+    invalidate_credentials(user_id)
 
 # Piggy bank section
 async def handle_piggy_bank_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.effective_user is None:
         return
     user_id = str(update.effective_user.id)
-    user_data = load_user_data()
+    user_data = await user_store.get_all()
     
     keyboard = [
         [InlineKeyboardButton('➕ Создать копилку', callback_data='create_piggy_bank')]
@@ -1446,7 +1426,7 @@ async def handle_piggy_bank_menu(update: Update, context: ContextTypes.DEFAULT_T
 # Piggy bank section callback
 async def handle_piggy_bank_menu_callback(query, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = str(query.from_user.id)
-    user_data = load_user_data()
+    user_data = await user_store.get_all()
     
     keyboard = [
         [InlineKeyboardButton('➕ Создать копилку', callback_data='create_piggy_bank')]
@@ -1470,7 +1450,7 @@ async def handle_piggy_bank_actions(update: Update, context: ContextTypes.DEFAUL
     if update.effective_user is None:
         return
     user_id = str(update.effective_user.id)
-    user_data = load_user_data()
+    user_data = await user_store.get_all()
     
     if user_id not in user_data or piggy_name not in user_data[user_id]['piggy_banks']:
         await update.message.reply_text('Копилка не найдена', reply_markup=main_menu())
@@ -1497,14 +1477,13 @@ async def handle_piggy_bank_actions(update: Update, context: ContextTypes.DEFAUL
     )
     
     # Save current piggy bank name in state
-    user_states = load_user_states()
+    user_states = user_state_store
     user_states[user_id] = f'CURRENT_PIGGY_{piggy_name}'
-    save_user_states(user_states)
 
 # Handle piggy bank actions callback
 async def handle_piggy_bank_actions_callback(query, context: ContextTypes.DEFAULT_TYPE, piggy_name: str) -> None:
     user_id = str(query.from_user.id)
-    user_data = load_user_data()
+    user_data = await user_store.get_all()
     
     if user_id not in user_data or piggy_name not in user_data[user_id]['piggy_banks']:
         await query.edit_message_text('Копилка не найдена', reply_markup=main_menu())
@@ -1531,19 +1510,17 @@ async def handle_piggy_bank_actions_callback(query, context: ContextTypes.DEFAUL
     )
     
     # Save current piggy bank name in state
-    user_states = load_user_states()
+    user_states = user_state_store
     user_states[user_id] = f'CURRENT_PIGGY_{piggy_name}'
-    save_user_states(user_states)
 
 # Handle create piggy bank
 async def handle_create_piggy_bank(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.effective_user is None:
         return
     user_id = str(update.effective_user.id)
-    user_states = load_user_states()
+    user_states = user_state_store
     
     user_states[user_id] = 'CREATING_PIGGY_NAME'
-    save_user_states(user_states)
     
     await update.message.reply_text(
         'Введите название для новой копилки:',
@@ -1555,10 +1532,9 @@ async def handle_create_piggy_bank(update: Update, context: ContextTypes.DEFAULT
 # Handle create piggy bank callback
 async def handle_create_piggy_bank_callback(query, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = str(query.from_user.id)
-    user_states = load_user_states()
+    user_states = user_state_store
     
     user_states[user_id] = 'CREATING_PIGGY_NAME'
-    save_user_states(user_states)
     
     await query.edit_message_text(
         '📝 Пожалуйста, введите название для новой копилки:\n\nНапример: "Отпуск", "Новый телефон", "Ремонт"',
@@ -1572,8 +1548,8 @@ async def handle_piggy_name_input(update: Update, context: ContextTypes.DEFAULT_
     if update.effective_user is None:
         return
     user_id = str(update.effective_user.id)
-    user_data = load_user_data()
-    user_states = load_user_states()
+    user_data = await user_store.get_all()
+    user_states = user_state_store
     
     if user_id not in user_states or user_states[user_id] != 'CREATING_PIGGY_NAME':
         return
@@ -1582,7 +1558,6 @@ async def handle_piggy_name_input(update: Update, context: ContextTypes.DEFAULT_
     
     # Save the name and ask for target amount
     user_states[user_id] = f'CREATING_PIGGY_TARGET_{piggy_name}'
-    save_user_states(user_states)
     
     await update.message.reply_text('💰 Теперь введите целевую сумму для копилки (в рублях):\n\nНапример: 10000')
 
@@ -1591,8 +1566,7 @@ async def handle_piggy_target_input(update: Update, context: ContextTypes.DEFAUL
     if update.effective_user is None:
         return
     user_id = str(update.effective_user.id)
-    user_data = load_user_data()
-    user_states = load_user_states()
+    user_states = user_state_store
     
     if user_id not in user_states or not user_states[user_id].startswith('CREATING_PIGGY_TARGET_'):
         return
@@ -1602,19 +1576,13 @@ async def handle_piggy_target_input(update: Update, context: ContextTypes.DEFAUL
         piggy_name = user_states[user_id].replace('CREATING_PIGGY_TARGET_', '')
         
         # Create piggy bank
-        if user_id not in user_data:
-            user_data[user_id] = {'piggy_banks': {}}
-        if 'piggy_banks' not in user_data[user_id]:
-            user_data[user_id]['piggy_banks'] = {}
-            
-        user_data[user_id]['piggy_banks'][piggy_name] = {
-            'current': 0,
-            'target': target_amount
-        }
-        save_user_data(user_data)
+        async with user_store.transaction(user_id) as user:
+            user['piggy_banks'][piggy_name] = {
+                'current': 0,
+                'target': target_amount
+            }
         
         del user_states[user_id]
-        save_user_states(user_states)
         
         keyboard = [
             [InlineKeyboardButton('💰 Пополнить', callback_data=f'deposit_{piggy_name}'), InlineKeyboardButton('Назад', callback_data='piggy_bank_menu')],
@@ -1658,7 +1626,7 @@ async def handle_shopping_category(update: Update, context: ContextTypes.DEFAULT
     if update.effective_user is None:
         return
     user_id = str(update.effective_user.id)
-    user_data = load_user_data()
+    user_data = await user_store.get_all()
     
     # Get items for this category (remove emoji if present)
     clean_category = category[2:] if category.startswith(('🍎', '💊 Аптека', '📦')) else category
@@ -1689,14 +1657,13 @@ async def handle_shopping_category(update: Update, context: ContextTypes.DEFAULT
     )
     
     # Save state for adding items
-    user_states = load_user_states()
+    user_states = user_state_store
     user_states[user_id] = f'ADDING_ITEM_{clean_category}'
-    save_user_states(user_states)
 
 # Handle shopping category callback
 async def handle_shopping_category_callback(query, context: ContextTypes.DEFAULT_TYPE, category: str) -> None:
     user_id = str(query.from_user.id)
-    user_data = load_user_data()
+    user_data = await user_store.get_all()
     
     # Get items for this category (remove emoji if present)
     clean_category = category[2:] if category.startswith(('🍎', '💊 Аптека', '📦')) else category
@@ -1727,21 +1694,15 @@ async def handle_shopping_category_callback(query, context: ContextTypes.DEFAULT
     )
     
     # Save state for adding items
-    user_states = load_user_states()
+    user_states = user_state_store
     user_states[user_id] = f'ADDING_ITEM_{clean_category}'
-    save_user_states(user_states)
 
 # Handle notes menu callback
 async def handle_notes_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update.effective_user is None:
         return
     user_id = str(update.effective_user.id)
-    user_data = load_user_data()
-    
-    # Ensure user has notes structure
-    if 'notes' not in user_data[user_id]:
-        user_data[user_id]['notes'] = {}
-        save_user_data(user_data)
+    user_data = await user_store.get_all()
     
     notes = user_data[user_id]['notes']
     
@@ -1776,11 +1737,10 @@ async def handle_create_note_callback(update: Update, context: ContextTypes.DEFA
     if update.effective_user is None:
         return
     user_id = str(update.effective_user.id)
-    user_states = load_user_states()
+    user_states = user_state_store
     
     # Set user state to 'add_note_title'
     user_states[user_id] = 'add_note_title'
-    save_user_states(user_states)
     
     keyboard = [[InlineKeyboardButton('⬅️ Назад', callback_data='notes_menu')]]
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -1801,7 +1761,7 @@ async def handle_view_note_callback(update: Update, context: ContextTypes.DEFAUL
     if update.effective_user is None:
         return
     user_id = str(update.effective_user.id)
-    user_data = load_user_data()
+    user_data = await user_store.get_all()
     
     if user_id in user_data and note_id in user_data[user_id]['notes']:
         note = user_data[user_id]['notes'][note_id]
@@ -1839,13 +1799,12 @@ async def handle_edit_note_callback(update: Update, context: ContextTypes.DEFAUL
     if update.effective_user is None:
         return
     user_id = str(update.effective_user.id)
-    user_states = load_user_states()
-    user_data = load_user_data()
+    user_states = user_state_store
+    user_data = await user_store.get_all()
     
     if user_id in user_data and note_id in user_data[user_id]['notes']:
         # Set user state to 'edit_note_content' with note_id
         user_states[user_id] = f'edit_note_content_{note_id}'
-        save_user_states(user_states)
         
         note = user_data[user_id]['notes'][note_id]
         current_content = note.get('content', '')
@@ -1877,12 +1836,12 @@ async def handle_delete_note_callback(update: Update, context: ContextTypes.DEFA
     if update.effective_user is None:
         return
     user_id = str(update.effective_user.id)
-    user_data = load_user_data()
+    user_data = await user_store.get_all()
     
     if user_id in user_data and note_id in user_data[user_id]['notes']:
         # Remove the note
         del user_data[user_id]['notes'][note_id]
-        save_user_data(user_data)
+        await user_store.commit(user_id)
         
         keyboard = [[InlineKeyboardButton('⬅️ Назад', callback_data='notes_menu')]]
         reply_markup = InlineKeyboardMarkup(keyboard)
@@ -1916,12 +1875,7 @@ async def handle_reminders_menu(update: Update, context: ContextTypes.DEFAULT_TY
     if update.effective_user is None:
         return
     user_id = str(update.effective_user.id)
-    user_data = load_user_data()
-    
-    # Ensure user has reminders structure
-    if 'reminders' not in user_data[user_id]:
-        user_data[user_id]['reminders'] = {}
-        save_user_data(user_data)
+    user_data = await user_store.get_all()
     
     reminders = user_data[user_id]['reminders']
     
@@ -1951,12 +1905,7 @@ async def handle_reminders_menu(update: Update, context: ContextTypes.DEFAULT_TY
 # Handle reminders menu callback
 async def handle_reminders_menu_callback(query, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = str(query.from_user.id)
-    user_data = load_user_data()
-    
-    # Ensure user has reminders structure
-    if 'reminders' not in user_data[user_id]:
-        user_data[user_id]['reminders'] = {}
-        save_user_data(user_data)
+    user_data = await user_store.get_all()
     
     reminders = user_data[user_id]['reminders']
     
@@ -1988,11 +1937,10 @@ async def handle_create_reminder(update: Update, context: ContextTypes.DEFAULT_T
     if update.effective_user is None:
         return
     user_id = str(update.effective_user.id)
-    user_states = load_user_states()
+    user_states = user_state_store
     
     # Set user state to 'add_reminder_title'
     user_states[user_id] = 'add_reminder_title'
-    save_user_states(user_states)
     
     keyboard = [[InlineKeyboardButton('⬅️ Назад', callback_data='reminders_menu')]]
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -2005,11 +1953,10 @@ async def handle_create_reminder(update: Update, context: ContextTypes.DEFAULT_T
 # Handle create reminder callback
 async def handle_create_reminder_callback(query, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = str(query.from_user.id)
-    user_states = load_user_states()
+    user_states = user_state_store
     
     # Set user state to 'add_reminder_title'
     user_states[user_id] = 'add_reminder_title'
-    save_user_states(user_states)
     
     keyboard = [[InlineKeyboardButton('⬅️ Назад', callback_data='reminders_menu')]]
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -2022,7 +1969,7 @@ async def handle_create_reminder_callback(query, context: ContextTypes.DEFAULT_T
 # Handle view reminder callback
 async def handle_view_reminder_callback(query, context: ContextTypes.DEFAULT_TYPE, reminder_id: str) -> None:
     user_id = str(query.from_user.id)
-    user_data = load_user_data()
+    user_data = await user_store.get_all()
     
     if user_id in user_data and reminder_id in user_data[user_id]['reminders']:
         reminder = user_data[user_id]['reminders'][reminder_id]
@@ -2033,7 +1980,8 @@ async def handle_view_reminder_callback(query, context: ContextTypes.DEFAULT_TYP
         if 'scheduled_at' in reminder and reminder['scheduled_at']:
             # ISO format with timezone
             try:
-                scheduled_time = datetime.fromisoformat(reminder['scheduled_at'])
+                scheduled_time = datetime.fromisoformat(reminder['scheduled_at']).astimezone(
+                    user_timezone(user_data[user_id]))
                 date = scheduled_time.strftime('%d.%m.%Y')
                 time = scheduled_time.strftime('%H:%M')
             except:
@@ -2045,14 +1993,19 @@ async def handle_view_reminder_callback(query, context: ContextTypes.DEFAULT_TYP
             time = reminder.get('time', 'Не задано')
         
         # Get repeat information
-        repeat = reminder.get('repeat', 'none')
-        repeat_text = {
-            'none': 'Не повторяется',
-            'daily': 'Ежедневно',
-            'weekly': 'Еженедельно',
-            'monthly': 'Ежемесячно',
-            'weekdays': 'По будням'
-        }.get(repeat, 'Не повторяется')
+        repeat_text = describe_repeat(reminder)
+        
+        # Preview the next occurrences of a repeating reminder
+        preview_text = ''
+        if reminder.get('repeat', 'none') != 'none' and reminder.get('scheduled_ts') and not reminder.get('sent', False):
+            tz = user_timezone(user_data[user_id])
+            upcoming = list(itertools.islice(reminder_occurrences(reminder, tz), 1, 1 + REMINDER_PREVIEW_SIZE))
+            if upcoming:
+                preview_text += '\n\n🗓 Следующие: ' + ', '.join(o.strftime('%d.%m %H:%M') for o in upcoming)
+            now = datetime.now(tz)
+            month_end = tz.localize(datetime(now.year + now.month // 12, now.month % 12 + 1, 1)) - timedelta(seconds=1)
+            in_month = count_reminder_occurrences(reminder, tz, now, month_end)
+            preview_text += f'\n📊 До конца месяца: {in_month} раз'
         
         keyboard = [
             [InlineKeyboardButton('✏️ Редактировать', callback_data=f'edit_reminder_{reminder_id}')],
@@ -2063,7 +2016,7 @@ async def handle_view_reminder_callback(query, context: ContextTypes.DEFAULT_TYP
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
-        message_text = f"⏰ <b>{title}</b>\n\n{content}\n\n📅 Дата: {date}\n🕘 Время: {time}\n🔁 Повтор: {repeat_text}"
+        message_text = f"⏰ <b>{title}</b>\n\n{content}\n\n📅 Дата: {date}\n🕘 Время: {time}\n🔁 Повтор: {repeat_text}{preview_text}"
         await query.edit_message_text(text=message_text, reply_markup=reply_markup, parse_mode='HTML')
     else:
         keyboard = [[InlineKeyboardButton('⬅️ Назад', callback_data='reminders_menu')]]
@@ -2076,13 +2029,12 @@ async def handle_view_reminder_callback(query, context: ContextTypes.DEFAULT_TYP
 # Handle edit reminder callback
 async def handle_edit_reminder_callback(query, context: ContextTypes.DEFAULT_TYPE, reminder_id: str) -> None:
     user_id = str(query.from_user.id)
-    user_states = load_user_states()
-    user_data = load_user_data()
+    user_states = user_state_store
+    user_data = await user_store.get_all()
     
     if user_id in user_data and reminder_id in user_data[user_id]['reminders']:
         # Set user state to 'edit_reminder_content' with reminder_id
         user_states[user_id] = f'edit_reminder_content_{reminder_id}'
-        save_user_states(user_states)
         
         reminder = user_data[user_id]['reminders'][reminder_id]
         current_content = reminder.get('content', '')
@@ -2096,31 +2048,26 @@ async def handle_edit_reminder_callback(query, context: ContextTypes.DEFAULT_TYP
 # Handle repeat reminder callback
 async def handle_repeat_reminder_callback(query, context: ContextTypes.DEFAULT_TYPE, reminder_id: str) -> None:
     user_id = str(query.from_user.id)
-    user_data = load_user_data()
+    user_data = await user_store.get_all()
     
     if user_id in user_data and reminder_id in user_data[user_id]['reminders']:
         # Get current repeat setting
-        current_repeat = user_data[user_id]['reminders'][reminder_id].get('repeat', 'none')
+        repeat_text = describe_repeat(user_data[user_id]['reminders'][reminder_id])
         
         # Create keyboard with repeat options
         keyboard = [
             [InlineKeyboardButton('Не повторять', callback_data=f'set_repeat_none_{reminder_id}')],
-            [InlineKeyboardButton('Ежедневно', callback_data=f'set_repeat_daily_{reminder_id}')],
-            [InlineKeyboardButton('Еженедельно', callback_data=f'set_repeat_weekly_{reminder_id}')],
+            [InlineKeyboardButton('Ежедневно', callback_data=f'set_repeat_daily_{reminder_id}'),
+             InlineKeyboardButton('По будням', callback_data=f'set_repeat_weekdays_{reminder_id}')],
+            [InlineKeyboardButton('Еженедельно', callback_data=f'set_repeat_weekly_{reminder_id}'),
+             InlineKeyboardButton('Раз в 2 недели', callback_data=f'set_repeat_biweekly_{reminder_id}')],
             [InlineKeyboardButton('Ежемесячно', callback_data=f'set_repeat_monthly_{reminder_id}')],
-            [InlineKeyboardButton('По будням', callback_data=f'set_repeat_weekdays_{reminder_id}')],
+            [InlineKeyboardButton('Ежемесячно в тот же день недели', callback_data=f'set_repeat_monthweekday_{reminder_id}')],
+            [InlineKeyboardButton('В последний день месяца', callback_data=f'set_repeat_monthlast_{reminder_id}')],
             [InlineKeyboardButton('⬅️ Назад', callback_data=f'view_reminder_{reminder_id}')]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
-        repeat_text = {
-            'none': 'Не повторяется',
-            'daily': 'Ежедневно',
-            'weekly': 'Еженедельно',
-            'monthly': 'Ежемесячно',
-            'weekdays': 'По будням'
-        }.get(current_repeat, 'Не повторяется')
-        
         message_text = f"🔁 Настройка повторения напоминания\n\nТекущая настройка: {repeat_text}\n\nВыберите вариант повторения:"
         await query.edit_message_text(text=message_text, reply_markup=reply_markup)
     else:
@@ -2134,12 +2081,12 @@ async def handle_repeat_reminder_callback(query, context: ContextTypes.DEFAULT_T
 # Handle delete reminder callback
 async def handle_delete_reminder_callback(query, context: ContextTypes.DEFAULT_TYPE, reminder_id: str) -> None:
     user_id = str(query.from_user.id)
-    user_data = load_user_data()
+    user_data = await user_store.get_all()
     
     if user_id in user_data and reminder_id in user_data[user_id]['reminders']:
         # Remove the reminder
         del user_data[user_id]['reminders'][reminder_id]
-        save_user_data(user_data)
+        await user_store.commit(user_id)
         
         keyboard = [[InlineKeyboardButton('⬅️ Назад', callback_data='reminders_menu')]]
         reply_markup = InlineKeyboardMarkup(keyboard)
@@ -2157,12 +2104,12 @@ async def handle_delete_reminder_callback(query, context: ContextTypes.DEFAULT_T
         )
 
 # Function to parse natural language dates
-def parse_natural_date(date_text):
-    """Parse natural language date text into a datetime object"""
+def parse_natural_date(date_text, tz=None):
+    """Parse natural language date text into a naive datetime, relative to today in `tz`"""
     import datetime
     import re
     
-    now = datetime.datetime.now()
+    now = datetime.datetime.now(tz or DEFAULT_TIMEZONE)
     date_text = date_text.lower().strip()
     
     # Default time is 13:00 if not specified
@@ -2246,11 +2193,10 @@ def parse_natural_date(date_text):
 # Handle reschedule reminder callback
 async def handle_reschedule_reminder_callback(query, context: ContextTypes.DEFAULT_TYPE, reminder_id: str) -> None:
     user_id = str(query.from_user.id)
-    user_states = load_user_states()
+    user_states = user_state_store
     
     # Set user state to 'reschedule_reminder_date' with reminder_id
     user_states[user_id] = f'reschedule_reminder_date_{reminder_id}'
-    save_user_states(user_states)
     
     # Provide quick date options
     keyboard = [
@@ -2271,8 +2217,8 @@ async def handle_reschedule_reminder_callback(query, context: ContextTypes.DEFAU
 # Handle reminder date selection
 async def handle_reminder_date_selection(query, context: ContextTypes.DEFAULT_TYPE, date_type: str, reminder_id: str) -> None:
     user_id = str(query.from_user.id)
-    user_data = load_user_data()
-    user_states = load_user_states()
+    user_data = await user_store.get_all()
+    user_states = user_state_store
     
     # Log for debugging
     logger.info(f"handle_reminder_date_selection called with user_id: {user_id}, date_type: {date_type}, reminder_id: {reminder_id}")
@@ -2281,13 +2227,10 @@ async def handle_reminder_date_selection(query, context: ContextTypes.DEFAULT_TY
         logger.info(f"User reminders: {user_data[user_id].get('reminders', {})}")
     
     import datetime
-    import pytz
-    
-    # Default timezone
-    DEFAULT_TIMEZONE = pytz.timezone('Europe/Moscow')
     
-    # Calculate the date and time based on selection
-    now = datetime.datetime.now(DEFAULT_TIMEZONE)
+    # Calculate the date and time based on selection, in the user's timezone
+    tz = user_timezone(user_data.get(user_id, {}))
+    now = datetime.datetime.now(tz)
     selected_time = datetime.time(13, 0)  # Default time
     
     if date_type == 'one_hour':
@@ -2344,7 +2287,6 @@ async def handle_reminder_date_selection(query, context: ContextTypes.DEFAULT_TY
         # For custom date, we need to ask user to input date and time
         # Set user state to wait for custom date input
         user_states[user_id] = f'add_reminder_date_{reminder_id}'
-        save_user_states(user_states)
         
         keyboard = [[InlineKeyboardButton('⬅️ Назад', callback_data='reminders_menu')]]
         reply_markup = InlineKeyboardMarkup(keyboard)
@@ -2360,10 +2302,8 @@ async def handle_reminder_date_selection(query, context: ContextTypes.DEFAULT_TY
     
     # Combine date and time
     combined_datetime = datetime.datetime.combine(selected_date, selected_time)
-    # Localize to default timezone
-    combined_datetime = DEFAULT_TIMEZONE.localize(combined_datetime)
-    # Convert to ISO format
-    iso_datetime = combined_datetime.isoformat()
+    # Localize to the user's timezone; normalize moves times in a DST gap forward
+    combined_datetime = tz.normalize(tz.localize(combined_datetime))
     
     # Save the date and time to the reminder
     logger.info(f"Checking if user_id {user_id} in user_data: {user_id in user_data}")
@@ -2389,14 +2329,13 @@ async def handle_reminder_date_selection(query, context: ContextTypes.DEFAULT_TY
             )
             return
         
-        user_data[user_id]['reminders'][reminder_id]['scheduled_at'] = iso_datetime
+        reschedule_reminder(user_data[user_id], user_data[user_id]['reminders'][reminder_id], combined_datetime)
         user_data[user_id]['reminders'][reminder_id]['sent'] = False  # Reset sent flag for rescheduled reminders
-        save_user_data(user_data)
+        await user_store.commit(user_id)
         
         # Clear user state
         if user_id in user_states:
             del user_states[user_id]
-            save_user_states(user_states)
         
         title = reminder.get('title', 'Без заголовка')
         
@@ -2421,23 +2360,17 @@ async def handle_reminder_date_selection(query, context: ContextTypes.DEFAULT_TY
 # Handle reminder reschedule for one hour
 async def handle_reminder_reschedule_one_hour(query, context: ContextTypes.DEFAULT_TYPE, reminder_id: str) -> None:
     user_id = str(query.from_user.id)
-    user_data = load_user_data()
+    user_data = await user_store.get_all()
     
     import datetime
-    import pytz
-    
-    # Default timezone
-    DEFAULT_TIMEZONE = pytz.timezone('Europe/Moscow')
     
     if user_id in user_data and reminder_id in user_data[user_id]['reminders']:
         # Calculate new date and time (one hour from now)
-        now = datetime.datetime.now(DEFAULT_TIMEZONE)
+        now = datetime.datetime.now(user_timezone(user_data[user_id]))
         new_datetime = now + datetime.timedelta(hours=1)
-        # Convert to ISO format
-        iso_datetime = new_datetime.isoformat()
         
         # Update reminder
-        user_data[user_id]['reminders'][reminder_id]['scheduled_at'] = iso_datetime
+        reschedule_reminder(user_data[user_id], user_data[user_id]['reminders'][reminder_id], new_datetime)
         user_data[user_id]['reminders'][reminder_id]['sent'] = False  # Reset sent flag
         
         # Handle repeat logic
@@ -2449,7 +2382,7 @@ async def handle_reminder_reschedule_one_hour(query, context: ContextTypes.DEFAU
             # For non-repeating reminders, mark as sent after sending
             user_data[user_id]['reminders'][reminder_id]['sent'] = True
             
-        save_user_data(user_data)
+        await user_store.commit(user_id)
         
         title = user_data[user_id]['reminders'][reminder_id]['title']
         
@@ -2466,23 +2399,18 @@ async def handle_reminder_reschedule_one_hour(query, context: ContextTypes.DEFAU
 # Handle reminder reschedule for tomorrow
 async def handle_reminder_reschedule_tomorrow(query, context: ContextTypes.DEFAULT_TYPE, reminder_id: str) -> None:
     user_id = str(query.from_user.id)
-    user_data = load_user_data()
+    user_data = await user_store.get_all()
     
     import datetime
-    import pytz
-    
-    # Default timezone
-    DEFAULT_TIMEZONE = pytz.timezone('Europe/Moscow')
     
     if user_id in user_data and reminder_id in user_data[user_id]['reminders']:
-        # Calculate new date and time (tomorrow at 9:00 AM)
-        now = datetime.datetime.now(DEFAULT_TIMEZONE)
-        new_datetime = (now + datetime.timedelta(days=1)).replace(hour=9, minute=0, second=0, microsecond=0)
-        # Convert to ISO format
-        iso_datetime = new_datetime.isoformat()
+        # Calculate new date and time (tomorrow at 9:00 AM local time)
+        tz = user_timezone(user_data[user_id])
+        tomorrow = datetime.datetime.now(tz).date() + datetime.timedelta(days=1)
+        new_datetime = tz.localize(datetime.datetime.combine(tomorrow, datetime.time(9, 0)))
         
         # Update reminder
-        user_data[user_id]['reminders'][reminder_id]['scheduled_at'] = iso_datetime
+        reschedule_reminder(user_data[user_id], user_data[user_id]['reminders'][reminder_id], new_datetime)
         user_data[user_id]['reminders'][reminder_id]['sent'] = False  # Reset sent flag
         
         # Handle repeat logic
@@ -2494,7 +2422,7 @@ async def handle_reminder_reschedule_tomorrow(query, context: ContextTypes.DEFAU
             # For non-repeating reminders, mark as sent after sending
             user_data[user_id]['reminders'][reminder_id]['sent'] = True
             
-        save_user_data(user_data)
+        await user_store.commit(user_id)
         
         title = user_data[user_id]['reminders'][reminder_id]['title']
         
@@ -2511,13 +2439,12 @@ async def handle_reminder_reschedule_tomorrow(query, context: ContextTypes.DEFAU
 # Handle reminder reschedule for custom date/time
 async def handle_reminder_reschedule_custom(query, context: ContextTypes.DEFAULT_TYPE, reminder_id: str) -> None:
     user_id = str(query.from_user.id)
-    user_data = load_user_data()
-    user_states = load_user_states()
+    user_data = await user_store.get_all()
+    user_states = user_state_store
     
     if user_id in user_data and reminder_id in user_data[user_id]['reminders']:
         # Set state to wait for custom date input
         user_states[user_id] = f'reschedule_reminder_date_{reminder_id}'
-        save_user_states(user_states)
         
         # Provide quick date options
         keyboard = [
@@ -2545,21 +2472,27 @@ async def handle_reminder_delete(query, context: ContextTypes.DEFAULT_TYPE, remi
 # Handle set repeat callback
 async def handle_set_repeat_callback(query, context: ContextTypes.DEFAULT_TYPE, repeat_type: str, reminder_id: str) -> None:
     user_id = str(query.from_user.id)
-    user_data = load_user_data()
+    user_data = await user_store.get_all()
     
     if user_id in user_data and reminder_id in user_data[user_id]['reminders']:
-        # Update repeat setting
-        user_data[user_id]['reminders'][reminder_id]['repeat'] = repeat_type
-        save_user_data(user_data)
+        # Update repeat setting; the rule is anchored at the reminder's
+        # local time, e.g. 'monthly' keeps its day of month
+        reminder = user_data[user_id]['reminders'][reminder_id]
+        tz = user_timezone(user_data[user_id])
+        if reminder.get('scheduled_at'):
+            local = datetime.fromisoformat(reminder['scheduled_at']).astimezone(tz).replace(tzinfo=None)
+        else:
+            local = datetime.now(tz).replace(tzinfo=None)
+        rule = preset(repeat_type, local)
+        reminder['repeat'] = repeat_type if rule is not None else 'none'
+        if rule is not None:
+            reminder['recurrence'] = rule.to_dict()
+        else:
+            reminder.pop('recurrence', None)
+        await user_store.commit(user_id)
         
         # Get repeat text
-        repeat_text = {
-            'none': 'Не повторяется',
-            'daily': 'Ежедневно',
-            'weekly': 'Еженедельно',
-            'monthly': 'Ежемесячно',
-            'weekdays': 'По будням'
-        }.get(repeat_type, 'Не повторяется')
+        repeat_text = describe_repeat(reminder)
         
         # Show confirmation and return to reminder view
         await query.answer(f"Повтор установлен: {repeat_text}")
@@ -2574,26 +2507,11 @@ async def handle_set_repeat_callback(query, context: ContextTypes.DEFAULT_TYPE,
             reply_markup=reply_markup
         )
 
-    user_id = str(query.from_user.id)
-    user_data = load_user_data()
-    
-    if user_id in user_data and reminder_id in user_data[user_id]['reminders']:
-        title = user_data[user_id]['reminders'][reminder_id]['title']
-        # Remove the reminder
-        del user_data[user_id]['reminders'][reminder_id]
-        save_user_data(user_data)
-        
-        await query.edit_message_text(
-            f'✅ Напоминание "{title}" удалено'
-        )
-    else:
-        await query.edit_message_text('❌ Ошибка: напоминание не найдено')
-
 # Handle reminder time input
 async def handle_reminder_time_input(update: Update, context: ContextTypes.DEFAULT_TYPE, reminder_id: str) -> None:
     user_id = str(update.effective_user.id)  # type: ignore
-    user_data = load_user_data()
-    user_states = load_user_states()
+    user_data = await user_store.get_all()
+    user_states = user_state_store
     
     time_input = update.message.text
     
@@ -2608,11 +2526,10 @@ async def handle_reminder_time_input(update: Update, context: ContextTypes.DEFAU
     # Save the time to the reminder
     if user_id in user_data and reminder_id in user_data[user_id]['reminders']:
         user_data[user_id]['reminders'][reminder_id]['time'] = time_input
-        save_user_data(user_data)
+        await user_store.commit(user_id)
         
         # Clear user state
         del user_states[user_id]
-        save_user_states(user_states)
         
         reminder = user_data[user_id]['reminders'][reminder_id]
         title = reminder.get('title', 'Без заголовка')
@@ -2633,8 +2550,7 @@ async def handle_add_shopping_item(update: Update, context: ContextTypes.DEFAULT
     if update.effective_user is None:
         return
     user_id = str(update.effective_user.id)
-    user_data = load_user_data()
-    user_states = load_user_states()
+    user_states = user_state_store
     
     if user_id not in user_states or not user_states[user_id].startswith('ADDING_ITEM_'):
         return
@@ -2642,20 +2558,12 @@ async def handle_add_shopping_item(update: Update, context: ContextTypes.DEFAULT
     clean_category = user_states[user_id].replace('ADDING_ITEM_', '')
     item = update.message.text
     
-    if user_id not in user_data:
-        user_data[user_id] = {'shopping_list': {}}
-    if 'shopping_list' not in user_data[user_id]:
-        user_data[user_id]['shopping_list'] = {}
-    if clean_category not in user_data[user_id]['shopping_list']:
-        user_data[user_id]['shopping_list'][clean_category] = []
-    
-    user_data[user_id]['shopping_list'][clean_category].append(item)
-    save_user_data(user_data)
+    async with user_store.transaction(user_id) as user:
+        user['shopping_list'].setdefault(clean_category, []).append(item)
     
     # Instead of deleting the state, keep it so user can add more items
     # Save state for adding more items
     user_states[user_id] = f'ADDING_ITEM_{clean_category}'
-    save_user_states(user_states)
     
     # Send confirmation message with option to add more items
     keyboard = [
@@ -2675,12 +2583,12 @@ async def handle_delete_shopping_item(update: Update, context: ContextTypes.DEFA
     if update.effective_user is None:
         return
     user_id = str(update.effective_user.id)
-    user_data = load_user_data()
+    user_data = await user_store.get_all()
     
     for category, items in user_data.get(user_id, {}).get('shopping_list', {}).items():
         if item_to_delete in items:
             items.remove(item_to_delete)
-            save_user_data(user_data)
+            await user_store.commit(user_id)
             
             # Send confirmation message
             keyboard = [
@@ -2702,18 +2610,17 @@ async def handle_clear_shopping_category(update: Update, context: ContextTypes.D
     if update.effective_user is None:
         return
     user_id = str(update.effective_user.id)
-    user_data = load_user_data()
-    user_states = load_user_states()
+    user_data = await user_store.get_all()
+    user_states = user_state_store
     
     if user_id not in user_states or not user_states[user_id].startswith('ADDING_ITEM_'):
         return
     
     clean_category = user_states[user_id].replace('ADDING_ITEM_', '')
     user_data[user_id]['shopping_list'][clean_category] = []
-    save_user_data(user_data)
+    await user_store.commit(user_id)
     
     del user_states[user_id]
-    save_user_states(user_states)
     
     # Send confirmation message
     keyboard = [
@@ -2732,8 +2639,8 @@ async def handle_deposit_to_piggy(update: Update, context: ContextTypes.DEFAULT_
     if update.effective_user is None:
         return
     user_id = str(update.effective_user.id)
-    user_states = load_user_states()
-    user_data = load_user_data()
+    user_states = user_state_store
+    user_data = await user_store.get_all()
     
     # Get current piggy bank from state
     if user_id not in user_states or not user_states[user_id].startswith('CURRENT_PIGGY_'):
@@ -2747,7 +2654,6 @@ async def handle_deposit_to_piggy(update: Update, context: ContextTypes.DEFAULT_
         return
     
     user_states[user_id] = f'DEPOSITING_{piggy_name}'
-    save_user_states(user_states)
     
     keyboard = [
         [InlineKeyboardButton('🏠 Главная', callback_data='main_menu')]
@@ -2764,8 +2670,8 @@ async def handle_withdraw_from_piggy(update: Update, context: ContextTypes.DEFAU
     if update.effective_user is None:
         return
     user_id = str(update.effective_user.id)
-    user_states = load_user_states()
-    user_data = load_user_data()
+    user_states = user_state_store
+    user_data = await user_store.get_all()
     
     # Get current piggy bank from state
     if user_id not in user_states or not user_states[user_id].startswith('CURRENT_PIGGY_'):
@@ -2779,7 +2685,6 @@ async def handle_withdraw_from_piggy(update: Update, context: ContextTypes.DEFAU
         return
     
     user_states[user_id] = f'WITHDRAWING_{piggy_name}'
-    save_user_states(user_states)
     
     keyboard = [
         [InlineKeyboardButton('🏠 Главная', callback_data='main_menu')]
@@ -2796,8 +2701,8 @@ async def handle_amount_input(update: Update, context: ContextTypes.DEFAULT_TYPE
     if update.effective_user is None:
         return
     user_id = str(update.effective_user.id)
-    user_data = load_user_data()
-    user_states = load_user_states()
+    user_data = await user_store.get_all()
+    user_states = user_state_store
     
     if user_id not in user_states:
         return
@@ -2811,9 +2716,8 @@ async def handle_amount_input(update: Update, context: ContextTypes.DEFAULT_TYPE
         elif user_states[user_id].startswith('WITHDRAWING_'):
             user_data[user_id]['piggy_banks'][piggy_name]['current'] -= amount
         
-        save_user_data(user_data)
+        await user_store.commit(user_id)
         del user_states[user_id]
-        save_user_states(user_states)
         
         await handle_piggy_bank_actions(update, context, piggy_name)
     except ValueError:
@@ -2824,8 +2728,8 @@ async def handle_edit_piggy_bank(update: Update, context: ContextTypes.DEFAULT_T
     if update.effective_user is None:
         return
     user_id = str(update.effective_user.id)
-    user_states = load_user_states()
-    user_data = load_user_data()
+    user_states = user_state_store
+    user_data = await user_store.get_all()
     
     if user_id not in user_states or not user_states[user_id].startswith('CURRENT_PIGGY_'):
         await update.message.reply_text('❌ Ошибка: не выбрана копилка')
@@ -2853,8 +2757,8 @@ async def handle_edit_piggy_name(update: Update, context: ContextTypes.DEFAULT_T
     if update.effective_user is None:
         return
     user_id = str(update.effective_user.id)
-    user_states = load_user_states()
-    user_data = load_user_data()
+    user_states = user_state_store
+    user_data = await user_store.get_all()
     
     if user_id not in user_states or not user_states[user_id].startswith('CURRENT_PIGGY_'):
         await update.message.reply_text('❌ Ошибка: не выбрана копилка')
@@ -2867,7 +2771,6 @@ async def handle_edit_piggy_name(update: Update, context: ContextTypes.DEFAULT_T
         return
     
     user_states[user_id] = f'EDITING_PIGGY_NAME_{piggy_name}'
-    save_user_states(user_states)
     
     await update.message.reply_text(
         f'📝 Введите новое название для копилки "{piggy_name}":',
@@ -2881,8 +2784,8 @@ async def handle_edit_piggy_name_input(update: Update, context: ContextTypes.DEF
     if update.effective_user is None:
         return
     user_id = str(update.effective_user.id)
-    user_data = load_user_data()
-    user_states = load_user_states()
+    user_data = await user_store.get_all()
+    user_states = user_state_store
     
     if user_id not in user_states or not user_states[user_id].startswith('EDITING_PIGGY_NAME_'):
         return
@@ -2895,10 +2798,9 @@ async def handle_edit_piggy_name_input(update: Update, context: ContextTypes.DEF
         return
     
     user_data[user_id]['piggy_banks'][new_name] = user_data[user_id]['piggy_banks'].pop(old_name)
-    save_user_data(user_data)
+    await user_store.commit(user_id)
     
     del user_states[user_id]
-    save_user_states(user_states)
     
     await handle_piggy_bank_actions(update, context, new_name)
 
@@ -2907,8 +2809,8 @@ async def handle_edit_piggy_target(update: Update, context: ContextTypes.DEFAULT
     if update.effective_user is None:
         return
     user_id = str(update.effective_user.id)
-    user_states = load_user_states()
-    user_data = load_user_data()
+    user_states = user_state_store
+    user_data = await user_store.get_all()
     
     if user_id not in user_states or not user_states[user_id].startswith('CURRENT_PIGGY_'):
         await update.message.reply_text('❌ Ошибка: не выбрана копилка')
@@ -2921,7 +2823,6 @@ async def handle_edit_piggy_target(update: Update, context: ContextTypes.DEFAULT
         return
     
     user_states[user_id] = f'EDITING_PIGGY_TARGET_{piggy_name}'
-    save_user_states(user_states)
     
     await update.message.reply_text(
         f'🎯 Введите новую целевую сумму для копилки "{piggy_name}":',
@@ -2935,8 +2836,8 @@ async def handle_edit_piggy_target_input(update: Update, context: ContextTypes.D
     if update.effective_user is None:
         return
     user_id = str(update.effective_user.id)
-    user_data = load_user_data()
-    user_states = load_user_states()
+    user_data = await user_store.get_all()
+    user_states = user_state_store
     
     if user_id not in user_states or not user_states[user_id].startswith('EDITING_PIGGY_TARGET_'):
         return
@@ -2950,10 +2851,9 @@ async def handle_edit_piggy_target_input(update: Update, context: ContextTypes.D
             return
         
         user_data[user_id]['piggy_banks'][piggy_name]['target'] = new_target
-        save_user_data(user_data)
+        await user_store.commit(user_id)
         
         del user_states[user_id]
-        save_user_states(user_states)
         
         await handle_piggy_bank_actions(update, context, piggy_name)
     except ValueError:
@@ -2964,7 +2864,7 @@ async def handle_delete_piggy_bank(update: Update, context: ContextTypes.DEFAULT
     if update.effective_user is None:
         return
     user_id = str(update.effective_user.id)
-    user_data = load_user_data()
+    user_data = await user_store.get_all()
     
     if user_id not in user_data:
         await update.message.reply_text('❌ Ошибка: не выбрана копилка')
@@ -2977,7 +2877,7 @@ async def handle_delete_piggy_bank(update: Update, context: ContextTypes.DEFAULT
         return
     
     del user_data[user_id]['piggy_banks']
-    save_user_data(user_data)
+    await user_store.commit(user_id)
     
     await update.message.reply_text('✅ Копилка удалена', reply_markup=main_menu())
 
@@ -3107,12 +3007,15 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
             await handle_reminder_delete(query, context, reminder_id)
         elif data == 'enter_api_keys':
             await handle_enter_api_keys_callback(query, context)
+        elif data == 'timezone_menu':
+            await handle_timezone_menu_callback(query, context)
+        elif data.startswith('set_timezone_'):
+            await handle_set_timezone_callback(query, context, data.replace('set_timezone_', ''))
         elif data.startswith('deposit_'):
             piggy_name = data.replace('deposit_', '')
             # Handle deposit logic
-            user_states = load_user_states()
+            user_states = user_state_store
             user_states[user_id] = f'DEPOSITING_{piggy_name}'
-            save_user_states(user_states)
                 
             keyboard = [
                 [InlineKeyboardButton('🏠 Главная', callback_data='main_menu')]
@@ -3126,9 +3029,8 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         elif data.startswith('withdraw_'):
             piggy_name = data.replace('withdraw_', '')
             # Handle withdraw logic
-            user_states = load_user_states()
+            user_states = user_state_store
             user_states[user_id] = f'WITHDRAWING_{piggy_name}'
-            save_user_states(user_states)
                 
             keyboard = [
                 [InlineKeyboardButton('🏠 Главная', callback_data='main_menu')]
@@ -3142,9 +3044,8 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         elif data.startswith('edit_name_'):
             piggy_name = data.replace('edit_name_', '')
             # Handle edit name logic
-            user_states = load_user_states()
+            user_states = user_state_store
             user_states[user_id] = f'EDITING_PIGGY_NAME_{piggy_name}'
-            save_user_states(user_states)
                 
             keyboard = [
                 [InlineKeyboardButton('🏠 Главная', callback_data='main_menu')]
@@ -3158,9 +3059,8 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         elif data.startswith('edit_target_'):
             piggy_name = data.replace('edit_target_', '')
             # Handle edit target logic
-            user_states = load_user_states()
+            user_states = user_state_store
             user_states[user_id] = f'EDITING_PIGGY_TARGET_{piggy_name}'
-            save_user_states(user_states)
                 
             keyboard = [
                 [InlineKeyboardButton('🏠 Главная', callback_data='main_menu')]
@@ -3174,9 +3074,8 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         elif data.startswith('edit_'):
             piggy_name = data.replace('edit_', '')
             # Handle edit logic
-            user_states = load_user_states()
+            user_states = user_state_store
             user_states[user_id] = f'EDITING_PIGGY_NAME_{piggy_name}'
-            save_user_states(user_states)
                 
             keyboard = [
                 [InlineKeyboardButton('🏠 Главная', callback_data='main_menu')]
@@ -3190,10 +3089,10 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         elif data.startswith('delete_'):
             piggy_name = data.replace('delete_', '')
             # Handle delete logic
-            user_data = load_user_data()
+            user_data = await user_store.get_all()
             if piggy_name in user_data.get(user_id, {}).get('piggy_banks', {}):
                 del user_data[user_id]['piggy_banks'][piggy_name]
-                save_user_data(user_data)
+                await user_store.commit(user_id)
                     
                 keyboard = [
                     [InlineKeyboardButton('Назад', callback_data='piggy_bank_menu'), InlineKeyboardButton('🏠 Главная', callback_data='main_menu')]
@@ -3209,9 +3108,8 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         elif data.startswith('add_item_'):
             category = data.replace('add_item_', '')
             # Handle add item logic
-            user_states = load_user_states()
+            user_states = user_state_store
             user_states[user_id] = f'ADDING_ITEM_{category}'
-            save_user_states(user_states)
                 
             keyboard = [
                 [InlineKeyboardButton('🏠 Главная', callback_data='main_menu')]
@@ -3225,9 +3123,8 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
             )
         elif data == 'add_shopping_list':
             # Handle add shopping list logic
-            user_states = load_user_states()
+            user_states = user_state_store
             user_states[user_id] = 'ADDING_SHOPPING_LIST'
-            save_user_states(user_states)
                 
             keyboard = [
                 [InlineKeyboardButton('🏠 Главная', callback_data='main_menu')]
@@ -3242,10 +3139,10 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         elif data.startswith('clear_category_'):
             category = data.replace('clear_category_', '')
             # Handle clear category logic
-            user_data = load_user_data()
+            user_data = await user_store.get_all()
             if category in user_data.get(user_id, {}).get('shopping_list', {}):
                 user_data[user_id]['shopping_list'][category] = []
-                save_user_data(user_data)
+                await user_store.commit(user_id)
                     
                 # Show updated category
                 await handle_shopping_category_callback(query, context, category)
@@ -3256,11 +3153,11 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
                 category = parts[2]
                 item_name = parts[3]
                 # Remove item from category
-                user_data = load_user_data()
+                user_data = await user_store.get_all()
                 if category in user_data.get(user_id, {}).get('shopping_list', {}):
                     if item_name in user_data[user_id]['shopping_list'][category]:
                         user_data[user_id]['shopping_list'][category].remove(item_name)
-                        save_user_data(user_data)
+                        await user_store.commit(user_id)
                             
                         # Show updated category
                         await handle_shopping_category_callback(query, context, category)
@@ -3338,396 +3235,538 @@ def main():
     if not TELEGRAM_BOT_TOKEN:
         logger.error("TELEGRAM_BOT_TOKEN is not set. Please check your .env file.")
         return
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    if SCHEDULER_MODE == 'partitioned' and not user_store.shared:
+        logger.error(f"SCHEDULER_MODE=partitioned runs several processes on the same user data, "
+                     f"which needs STORAGE_BACKEND=sqlite, not {STORAGE_BACKEND}.")
+        return
+    # Different users are served concurrently, see per_user()
+    application = Application.builder().token(TELEGRAM_BOT_TOKEN).concurrent_updates(True).build()
 
     # Register handlers
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_menu))
-    application.add_handler(CallbackQueryHandler(handle_callback_query))
+    application.add_handler(CommandHandler("start", per_user(start)))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, per_user(handle_menu)))
+    application.add_handler(CallbackQueryHandler(per_user(handle_callback_query)))
 
     # Schedule the reminder checking task to run after the bot starts
     async def post_init_callback(app):
-        # Process pending reminders on startup
-        await process_pending_reminders_on_startup(app)
-        app.create_task(check_and_send_reminders(app))
-    
+        if not user_store.shared:
+            # Only one process may use file-based user data: the holder of the scheduler lease
+            await wait_for_scheduler_lease()
+        # Load user data and states into memory and start the background flushers
+        await user_store.load_async()
+        # Bring every record to the current schema once
+        for user_id in migrate_all(await user_store.get_all()):
+            user_store.mark_dirty(user_id)
+        if not user_store.shared:
+            # The only process: no pass runs anywhere else. With shared data
+            # markers are dropped when a process takes reminders over instead
+            for user_id in clear_stale_deliveries(await user_store.get_all()):
+                user_store.mark_dirty(user_id)
+        await user_store.sync()
+        await asyncio.get_running_loop().run_in_executor(None, user_state_store.load)
+        app.create_task(user_store.run_flusher())
+        app.create_task(user_state_store.run_flusher())
+        if STORAGE_BACKEND == 'journal':
+            app.create_task(user_store.run_compactor(JOURNAL_COMPACT_INTERVAL))
+        if user_store.shared:
+            # Pick up users that other bot processes change
+            app.create_task(user_store.run_refresher(USER_DATA_REFRESH_INTERVAL))
+        # Queue every pending reminder; later changes reach the queue through the store listener
+        sync_reminder_queue()
+        if SCHEDULER_MODE == 'partitioned':
+            # Every process sends the reminders of the users it owns
+            app.create_task(scheduler_members.run(rebalance_reminders))
+            app.create_task(run_reminder_scheduler(app))
+        else:
+            # Only the process holding the scheduler lease sends reminders
+            app.create_task(scheduler_lease.run(functools.partial(lead_reminder_scheduler, app)))
+
+    # Write any remaining changes to disk before the process exits
+    async def post_shutdown_callback(app):
+        scheduler_lease.release()
+        scheduler_members.leave()
+        user_store.flush()
+        user_store.compact()
+        user_state_store.flush()
+
     application.post_init = post_init_callback
+    application.post_shutdown = post_shutdown_callback
 
     # Run the bot until the user presses Ctrl-C
     logger.info("Starting bot...")
     application.run_polling()
     logger.info("Bot started successfully!")
 
+# Outbox entry of a reminder's current occurrence: a reminder whose delivery
+# failed carries {'occurrence', 'attempts', 'last_error'} plus either
+# 'next_attempt_at' (a timestamp) or state 'dead' once it was given up
+def delivery_job(reminder):
+    job = reminder.get('delivery')
+    if job is not None and job.get('occurrence') == reminder.get('scheduled_at'):
+        return job
+    return None
+
+# Due timestamps of a user's reminders that still have to be sent
+def pending_reminder_times(user):
+    due_times = {}
+    # Users who blocked the bot get nothing until they write to it again
+    if user.get('reminders_blocked'):
+        return due_times
+    for reminder_id, reminder in user.get('reminders', {}).items():
+        # Reminders being delivered are back in the queue once the pass is saved
+        if reminder.get('sent', False) or reminder.get('scheduled_ts') is None or 'delivering' in reminder:
+            continue
+        job = delivery_job(reminder)
+        if job is not None:
+            if job.get('state') != 'dead':
+                due_times[reminder_id] = job['next_attempt_at']
+            continue
+        due_times[reminder_id] = reminder['scheduled_ts']
+    return due_times
+
+# 'delivering' markers only last for one pass. One written before the
+# process died would keep its reminder out of the queue for good, so they are
+# dropped when a process starts sending reminders; the delivery ledger tells
+# whether the occurrence was sent. Returns the users whose records changed.
+def clear_stale_deliveries(user_data):
+    changed = []
+    for user_id, user in user_data.items():
+        for reminder in user.get('reminders', {}).values():
+            if reminder.pop('delivering', None) is not None and user_id not in changed:
+                changed.append(user_id)
+    return changed
+
+# In partitioned mode every process sends the reminders of its own share of
+# users; the shares are rebalanced as processes join or leave
+scheduler_members = Membership(COORDINATION_DB, 'reminder_scheduler', ttl=SCHEDULER_LEASE_TTL)
+
+def owns_reminders(user_id):
+    """Whether this process sends the user's reminders (if it runs the scheduler at all)"""
+    return SCHEDULER_MODE != 'partitioned' or scheduler_members.owns(user_id)
+
+# Keep the scheduler queue in step with user data: called for every changed
+# user, so creating, rescheduling, repeating and deleting reminders all
+# update the queue
+def sync_reminder_queue(user_id=None):
+    user_data = user_store.data
+    if user_id is None:
+        for uid, user in user_data.items():
+            reminder_queue.replace_user(uid, pending_reminder_times(user) if owns_reminders(uid) else {})
+    elif owns_reminders(user_id):
+        reminder_queue.replace_user(user_id, pending_reminder_times(user_data.get(user_id, {})))
+    else:
+        reminder_queue.replace_user(user_id, {})
+
+# Partitions moved: reload the users this process gained from the shared
+# database, requeue its users and take its share of the bot's global
+# message rate
+async def rebalance_reminders(previous):
+    await user_store.refresh()
+    gained = [user_id for user_id in await user_store.get_all()
+              if owns_reminders(user_id) and partition_of(user_id) not in previous]
+    await take_over_reminders(gained)
+    sync_reminder_queue()
+    members = max(len(scheduler_members.members), 1)
+    reminder_dispatcher.set_global_rate(DELIVERY_GLOBAL_RATE / members)
+
+reminder_queue = TimingWheel() if REMINDER_SCHEDULER == 'wheel' else ReminderQueue()
+user_store.add_listener(sync_reminder_queue)
+
+# Sends reminder messages concurrently within Telegram's flood limits
+reminder_dispatcher = Dispatcher(
+    workers=DELIVERY_WORKERS,
+    global_rate=DELIVERY_GLOBAL_RATE,
+    chat_rate=DELIVERY_CHAT_RATE
+)
+
+# Occurrences already delivered, shared by every instance of the bot
+delivery_ledger = DeliveryLedger(DELIVERY_LEDGER_DB, retention=DELIVERY_LEDGER_RETENTION)
+
+# Recurrence rule of a reminder, None if it doesn't repeat. Rules are kept
+# in 'recurrence'; a reminder that only has a repeat setting gets the rule of
+# that setting, anchored at its local time `local`
+def reminder_recurrence(reminder, local):
+    if reminder.get('repeat', 'none') == 'none':
+        return None
+    if reminder.get('recurrence'):
+        return Recurrence.from_dict(reminder['recurrence'])
+    return preset(reminder['repeat'], local)
+
+# Move a reminder of `user` to the aware datetime `when`. Repeat presets are
+# anchored at the reminder's time (weekly ones on its weekday, monthly ones on
+# its day of the month), so the rule is rebuilt for the new time; when the
+# repetition ends (until / count) stays as it was
+def reschedule_reminder(user, reminder, when):
+    set_scheduled_time(reminder, when)
+    repeat = reminder.get('repeat', 'none')
+    if repeat == 'none' or not reminder.get('recurrence'):
+        return
+    rule = preset(repeat, when.astimezone(user_timezone(user)).replace(tzinfo=None))
+    if rule is None:
+        return
+    previous = Recurrence.from_dict(reminder['recurrence'])
+    rule.until, rule.count = previous.until, previous.count
+    reminder['recurrence'] = rule.to_dict()
+
+# Upcoming occurrences shown in the reminder view
+REMINDER_PREVIEW_SIZE = 3
+
+# Occurrences of a scheduled reminder from its current one on, as aware
+# datetimes in the user's timezone; generated lazily, so previews, exports
+# and forecasts take as many as they need
+def reminder_occurrences(reminder, tz):
+    current = datetime.fromisoformat(reminder['scheduled_at']).astimezone(tz)
+    rule = reminder_recurrence(reminder, current.replace(tzinfo=None))
+    if rule is None:
+        yield current
+        return
+    for occurrence in rule.occurrences(current.replace(tzinfo=None)):
+        yield tz.normalize(tz.localize(occurrence))
+
+# How many times a scheduled reminder fires between two aware datetimes
+def count_reminder_occurrences(reminder, tz, start, end):
+    current = datetime.fromisoformat(reminder['scheduled_at']).astimezone(tz)
+    rule = reminder_recurrence(reminder, current.replace(tzinfo=None))
+    if rule is None:
+        return 1 if start <= current <= end else 0
+    local = lambda moment: moment.astimezone(tz).replace(tzinfo=None)
+    return rule.count_between(local(current), local(start), local(end))
+
+# Repeat setting of a reminder as shown to the user
+def describe_repeat(reminder):
+    rule = reminder_recurrence(reminder, datetime.now(DEFAULT_TIMEZONE).replace(tzinfo=None))
+    return rule.describe() if rule is not None else 'Не повторяется'
+
+# Function to calculate next occurrence for repeating reminders
+def calculate_next_occurrence(current_time, rule, tz=None, after=None):
+    """
+    Next occurrence of a repeating reminder after `current_time` and `after`,
+    or None once its repetition has ended.
+
+    `rule` is a Recurrence (advanced past the occurrences it skips) or a
+    repeat setting such as 'daily'. Occurrences are found on the local wall
+    clock in `tz`, so a daily 9:00 reminder stays at 9:00 across daylight
+    saving changes.
+    """
+    tz = tz or DEFAULT_TIMEZONE
+    # Local wall-clock time of this occurrence
+    if current_time.tzinfo is not None:
+        current_time = current_time.astimezone(tz).replace(tzinfo=None)
+    if after is not None and after.tzinfo is not None:
+        after = after.astimezone(tz).replace(tzinfo=None)
+    if isinstance(rule, str):
+        rule = preset(rule, current_time)
+        if rule is None:
+            return None
+    
+    next_time = rule.advance(current_time, after)
+    if next_time is None:
+        return None
+    # Ambiguous times take standard time; normalize moves times in a DST gap forward
+    return tz.normalize(tz.localize(next_time))
+
+# Move a delivered reminder to its next occurrence, or mark it as sent.
+# Occurrences up to `now` are skipped, so a repeating reminder that was
+# missed for a while moves straight to its next future occurrence
+def finish_reminder_occurrence(reminder, scheduled_time, tz, now=None):
+    reminder.pop('delivering', None)
+    reminder.pop('delivery', None)
+    rule = reminder_recurrence(reminder, scheduled_time.astimezone(tz).replace(tzinfo=None))
+    next_time = calculate_next_occurrence(scheduled_time, rule, tz, after=now) if rule is not None else None
+    if next_time is not None:
+        # Update scheduled time for next occurrence; the rule has counted
+        # off the occurrences it moved past
+        reminder['recurrence'] = rule.to_dict()
+        set_scheduled_time(reminder, next_time)
+        # Keep sent as False for next occurrence
+        reminder['sent'] = False
+    else:
+        # Not repeating, or the repetition has ended
+        reminder['sent'] = True
+
+# Reminders more than this many seconds overdue are not sent any more
+REMINDER_SEND_WINDOW = 24 * 3600
+
+# Record a failed delivery in the outbox: schedule a retry with backoff, give
+# the occurrence up, or stop reminding a user who blocked the bot
+def record_delivery_failure(user, reminder, scheduled_time, error):
+    reminder.pop('delivering', None)
+    if is_permanent_failure(error):
+        user['reminders_blocked'] = {'error': str(error), 'since': time.time()}
+        return
+    job = delivery_job(reminder) or {'occurrence': reminder['scheduled_at'], 'attempts': 0}
+    job['attempts'] += 1
+    job['last_error'] = str(error)
+    next_attempt = time.time() + retry_delay(job['attempts'], DELIVERY_RETRY_BASE, DELIVERY_RETRY_MAX)
+    # Nothing is sent more than REMINDER_SEND_WINDOW late anyway
+    if job['attempts'] >= DELIVERY_MAX_ATTEMPTS or next_attempt - reminder['scheduled_ts'] >= REMINDER_SEND_WINDOW:
+        job['state'] = 'dead'
+        job.pop('next_attempt_at', None)
+    else:
+        job['next_attempt_at'] = next_attempt
+    reminder['delivery'] = job
+    if job.get('state') == 'dead' and reminder.get('repeat', 'none') != 'none':
+        # Skip this occurrence of a repeating reminder
+        finish_reminder_occurrence(reminder, scheduled_time, user_timezone(user), datetime.now(DEFAULT_TIMEZONE))
+
+# Send one pass of due reminders.
+#
+# The results of the whole pass are saved with one commit instead of one save
+# per message. Before anything is sent, the pass claims every occurrence it is
+# about to deliver in the delivery ledger, in one transaction; an occurrence
+# that is already in the ledger was sent by another instance or before a
+# restart, and is finished without being sent again. While a pass runs its
+# reminders carry a 'delivering' marker that keeps them out of the queue.
+# However the pass ends, it releases the claims of messages it didn't send
+# and removes the markers of whatever it didn't finish.
+async def deliver_reminders(application, due, now):
+    """Send the due (user_id, reminder_id) reminders; returns how many were sent"""
+    user_data = await user_store.get_all()
+    # Not truncated: retry times have fractions of a second
+    now_ts = now.timestamp()
+    claimed = []
+    recovered = False
+    # Users with reminders that were popped from the queue but aren't due yet
+    early = set()
+    # Ledger claims this pass made, and those of them it has settled: sent,
+    # or already released again
+    claiming = None
+    claims = None
+    settled = set()
+    try:
+        for user_id, reminder_id in due:
+            async with user_store.lock(user_id):
+                user = user_data.get(user_id, {})
+                reminder = user.get('reminders', {}).get(reminder_id)
+                if reminder is None or reminder.get('sent', False) or reminder.get('scheduled_ts') is None:
+                    continue
+                if user.get('reminders_blocked') or not owns_reminders(user_id):
+                    continue
+                # Check if reminder should be sent (with 24-hour window)
+                scheduled_ts = reminder['scheduled_ts']
+                if scheduled_ts > now_ts:
+                    early.add(user_id)
+                    continue
+                # Failed before: wait for the retry time, never retry a dead delivery
+                job = delivery_job(reminder)
+                if job is not None and job.get('state') == 'dead':
+                    continue
+                if job is not None and job['next_attempt_at'] > now_ts:
+                    early.add(user_id)
+                    continue
+                try:
+                    # Local time with timezone, for computing the next occurrence
+                    scheduled_time = datetime.fromisoformat(reminder['scheduled_at'])
+                except ValueError as e:
+                    logger.error(f"Error processing reminder {reminder_id} for user {user_id}: {e}")
+                    continue
+                if now_ts - scheduled_ts >= REMINDER_SEND_WINDOW:
+                    if reminder.get('repeat', 'none') != 'none':
+                        # Missed while the bot was down: skip to the next future occurrence
+                        finish_reminder_occurrence(reminder, scheduled_time, user_timezone(user), now)
+                        user_store.mark_dirty(user_id)
+                        recovered = True
+                    continue
+                reminder['delivering'] = reminder['scheduled_at']
+                user_store.mark_dirty(user_id)
+                claimed.append((user_id, reminder_id, reminder['scheduled_at'], scheduled_time))
+        # Put back what was popped too early; nothing else would requeue it
+        for user_id in early:
+            sync_reminder_queue(user_id)
+        loop = asyncio.get_running_loop()
+        if claimed:
+            entries = [(user_id, reminder_id, occurrence, int(scheduled_time.timestamp()))
+                       for user_id, reminder_id, occurrence, scheduled_time in claimed]
+            # Shielded, so the claims are known even if the pass is cancelled meanwhile
+            claiming = asyncio.ensure_future(loop.run_in_executor(None, delivery_ledger.claim, entries))
+            owned = await asyncio.shield(claiming)
+            claims = [entry for entry, is_new in zip(entries, owned) if is_new]
+            for (user_id, reminder_id, occurrence, scheduled_time), is_new in zip(claimed, owned):
+                if is_new:
+                    continue
+                # Already delivered: by another instance, or before a restart
+                async with user_store.lock(user_id):
+                    reminder = user_data.get(user_id, {}).get('reminders', {}).get(reminder_id)
+                    if reminder is not None and reminder.get('scheduled_at') == occurrence:
+                        finish_reminder_occurrence(reminder, scheduled_time, user_timezone(user_data[user_id]), now)
+                        user_store.mark_dirty(user_id)
+                        recovered = True
+            claimed = [entry for entry, is_new in zip(claimed, owned) if is_new]
+        if not claimed:
+            if recovered:
+                await user_store.sync()
+            return 0
+
+        # Build the messages; the reminder may have been changed or deleted
+        # since it was claimed
+        messages = []
+        pending = []
+        # Ledger claims of messages that end up not being sent
+        unsent = []
+        for user_id, reminder_id, occurrence, scheduled_time in claimed:
+            async with user_store.lock(user_id):
+                reminder = user_data.get(user_id, {}).get('reminders', {}).get(reminder_id)
+                if reminder is None or reminder.get('scheduled_at') != occurrence:
+                    # Deleted or rescheduled while the pass was running
+                    if reminder is not None:
+                        reminder.pop('delivering', None)
+                        user_store.mark_dirty(user_id)
+                    unsent.append((user_id, reminder_id, occurrence, None))
+                    continue
+                # Send reminder message to user in the required format
+                title = reminder.get('title', 'Напоминание')
+            
+                message = f"⏰ Вы просили напомнить \"{title}\""
+            
+                # Create inline keyboard with reschedule and delete options
+                keyboard = [
+                    [
+                        InlineKeyboardButton('Через час', callback_data=f'reminder_reschedule_one_hour_{reminder_id}'),
+                        InlineKeyboardButton('На завтра', callback_data=f'reminder_reschedule_tomorrow_{reminder_id}')
+                    ],
+                    [
+                        InlineKeyboardButton('Произвольно', callback_data=f'reminder_reschedule_custom_{reminder_id}'),
+                        InlineKeyboardButton('Удалить', callback_data=f'reminder_delete_{reminder_id}')
+                    ]
+                ]
+                reply_markup = InlineKeyboardMarkup(keyboard)
+                messages.append((int(user_id), {'text': message, 'reply_markup': reply_markup}))
+                pending.append((user_id, reminder_id, occurrence, scheduled_time, title))
+
+        # Send them concurrently within Telegram's rate limits
+        errors = await reminder_dispatcher.dispatch(
+            application.bot.send_message, messages, on_sent=lambda index: settled.add(pending[index][:3]))
+
+        sent = 0
+        for (user_id, reminder_id, occurrence, scheduled_time, title), error in zip(pending, errors):
+            if error is not None:
+                unsent.append((user_id, reminder_id, occurrence, None))
+            async with user_store.lock(user_id):
+                reminder = user_data.get(user_id, {}).get('reminders', {}).get(reminder_id)
+                if reminder is None:
+                    continue
+                if error is not None:
+                    logger.error(f"Failed to send reminder to user {user_id}: {error}")
+                    if reminder.get('scheduled_at') == occurrence:
+                        record_delivery_failure(user_data[user_id], reminder, scheduled_time, error)
+                    else:
+                        reminder.pop('delivering', None)
+                    user_store.mark_dirty(user_id)
+                    continue
+                if reminder.get('scheduled_at') == occurrence:
+                    finish_reminder_occurrence(reminder, scheduled_time, user_timezone(user_data[user_id]), now)
+                else:
+                    # Rescheduled while the message was being sent
+                    reminder.pop('delivering', None)
+                user_store.mark_dirty(user_id)
+                sent += 1
+                logger.info(f"Sent reminder '{title}' to user {user_id}")
+
+        # Unsent occurrences can be claimed again by a retry
+        await loop.run_in_executor(None, delivery_ledger.release, unsent)
+        settled.update(entry[:3] for entry in unsent)
+        # One commit for the whole pass
+        await user_store.sync()
+        return sent
+    finally:
+        # The pass failed or was cancelled (e.g. on shutdown or on losing the
+        # scheduler lease). Release the claims of messages that weren't
+        # confirmed sent, or the next pass would take them for delivered
+        # and never send them; one cut off mid-send may then go out twice
+        if claiming is not None and claims is None:
+            try:
+                owned = await claiming
+            except Exception:
+                # The claim itself failed, so nothing was claimed
+                owned = []
+            claims = [entry for entry, is_new in zip(entries, owned) if is_new]
+        unconfirmed = [entry for entry in claims or () if entry[:3] not in settled]
+        if unconfirmed:
+            try:
+                delivery_ledger.release(unconfirmed)
+            except Exception as e:
+                logger.error(f"Error releasing {len(unconfirmed)} delivery claims: {e}")
+        # Their reminders go back into the queue; the next pass finishes the
+        # ones that were sent without sending them again
+        for user_id, reminder_id in due:
+            reminder = user_data.get(user_id, {}).get('reminders', {}).get(reminder_id)
+            occurrence = reminder.pop('delivering', None) if reminder is not None else None
+            if occurrence is None:
+                continue
+            if (user_id, reminder_id, occurrence) in settled:
+                logger.warning(f"Reminder {reminder_id} of user {user_id} was sent but not finished, requeueing it")
+            else:
+                logger.warning(f"Reminder {reminder_id} of user {user_id} was not delivered, requeueing it")
+            user_store.mark_dirty(user_id)
+
+# Several bot processes may run at once; the one holding this lease runs the
+# reminder scheduler and another takes over within SCHEDULER_LEASE_TTL
+# seconds if it dies
+scheduler_lease = Lease(COORDINATION_DB, 'reminder_scheduler', ttl=SCHEDULER_LEASE_TTL)
+
+# A process that can't share user data with others starts only once it holds
+# the scheduler lease, i.e. once no other process runs
+async def wait_for_scheduler_lease():
+    loop = asyncio.get_running_loop()
+    if await loop.run_in_executor(None, scheduler_lease.try_acquire):
+        return
+    logger.warning(f"Another bot process is running and {STORAGE_BACKEND} user data can't be shared "
+                   f"between processes; waiting for it to exit (use STORAGE_BACKEND=sqlite to run several)")
+    while not await loop.run_in_executor(None, scheduler_lease.try_acquire):
+        await asyncio.sleep(scheduler_lease.ttl / 3)
+
+# This process starts sending the reminders of some users (all of them for
+# None) that another one may have been sending: take in their latest
+# records, and drop the 'delivering' markers of passes that the other process
+# never finished (the delivery ledger knows what it sent)
+async def take_over_reminders(user_ids=None):
+    await user_store.refresh()
+    if user_ids is not None:
+        await user_store.reload(user_ids)
+    user_data = await user_store.get_all()
+    taken = user_data if user_ids is None else {
+        user_id: user_data[user_id] for user_id in user_ids if user_id in user_data}
+    for user_id in clear_stale_deliveries(taken):
+        user_store.mark_dirty(user_id)
+
+# Runs while this process holds the scheduler lease
+async def lead_reminder_scheduler(application):
+    if user_store.shared:
+        await take_over_reminders()
+    await run_reminder_scheduler(application)
+
+# One engine sends both live and missed reminders. At startup (or when this
+# process takes the scheduler over) the queue already holds every pending
+# reminder of the store, so whatever came due while no process was sending
+# is popped first, oldest first, in batches of REMINDER_BATCH_SIZE that go
+# through the rate-limited dispatcher; each batch is committed once. It runs
+# as a background task, so the bot answers updates while it catches up.
+async def run_reminder_scheduler(application):
+    """Send missed reminders oldest first, then keep sending them as they come due"""
+    overdue = reminder_queue.count_due(time.time())
+    if overdue:
+        logger.info(f"Catching up on {overdue} overdue reminders")
+    await check_and_send_reminders(application)
+
 # Function to check and send reminders
 async def check_and_send_reminders(application) -> None:
-    """Check for reminders that should be sent and send them"""
+    """Send reminders from the queue as they become due"""
     import datetime
     import asyncio
-    import pytz
-    
-    # Default timezone (can be changed to user's timezone)
-    DEFAULT_TIMEZONE = pytz.timezone('Europe/Moscow')
     
     while True:
         try:
+            # Sleep until the earliest reminder is due; after downtime the
+            # backlog comes out one batch at a time
+            due = await reminder_queue.wait_due(REMINDER_BATCH_SIZE)
+            
             # Get current date and time with timezone
             now = datetime.datetime.now(DEFAULT_TIMEZONE)
             
-            # Load user data
-            user_data = load_user_data()
-            
-            # Check each user's reminders
-            for user_id, data in user_data.items():
-                if 'reminders' in data:
-                    for reminder_id, reminder in data['reminders'].items():
-                        try:
-                            # Check if reminder has ISO format with timezone
-                            if 'scheduled_at' in reminder and reminder['scheduled_at']:
-                                # Parse the scheduled time with timezone
-                                scheduled_time = datetime.datetime.fromisoformat(reminder['scheduled_at'])
-                                
-                                # Check if reminder should be sent (with 24-hour window)
-                                if (scheduled_time <= now and 
-                                    not reminder.get('sent', False) and
-                                    now - scheduled_time < timedelta(hours=24)):
-                                    try:
-                                        # Send reminder message to user in the required format
-                                        title = reminder.get('title', 'Напоминание')
-                                        
-                                        message = f"⏰ Вы просили напомнить \"{title}\""
-                                        
-                                        # Create inline keyboard with reschedule and delete options
-                                        keyboard = [
-                                            [
-                                                InlineKeyboardButton('Через час', callback_data=f'reminder_reschedule_one_hour_{reminder_id}'),
-                                                InlineKeyboardButton('На завтра', callback_data=f'reminder_reschedule_tomorrow_{reminder_id}')
-                                            ],
-                                            [
-                                                InlineKeyboardButton('Произвольно', callback_data=f'reminder_reschedule_custom_{reminder_id}'),
-                                                InlineKeyboardButton('Удалить', callback_data=f'reminder_delete_{reminder_id}')
-                                            ]
-                                        ]
-                                        reply_markup = InlineKeyboardMarkup(keyboard)
-                                        
-                                        # Send message to user
-                                        await application.bot.send_message(
-                                            chat_id=int(user_id),
-                                            text=message,
-                                            reply_markup=reply_markup
-                                        )
-                                        
-                                        # Handle repeat logic
-                                        repeat = reminder.get('repeat', 'none')
-                                        if repeat != 'none':
-                                            # For repeating reminders, calculate next occurrence
-                                            next_time = calculate_next_occurrence(scheduled_time, repeat)
-                                            if next_time:
-                                                # Update scheduled time for next occurrence
-                                                user_data[user_id]['reminders'][reminder_id]['scheduled_at'] = next_time.isoformat()
-                                                # Keep sent as False for next occurrence
-                                                user_data[user_id]['reminders'][reminder_id]['sent'] = False
-                                            else:
-                                                # If can't calculate next occurrence, mark as sent
-                                                user_data[user_id]['reminders'][reminder_id]['sent'] = True
-                                        else:
-                                            # For non-repeating reminders, mark as sent
-                                            user_data[user_id]['reminders'][reminder_id]['sent'] = True
-                                            
-                                        save_user_data(user_data)
-                                        
-                                        logger.info(f"Sent reminder '{title}' to user {user_id}")
-                                    except Exception as e:
-                                        logger.error(f"Failed to send reminder to user {user_id}: {e}")
-                            
-                            # For backward compatibility with old format
-                            elif (reminder.get('date') and reminder.get('time') and
-                                  not reminder.get('sent', False)):
-                                # Parse old format
-                                date_str = reminder.get('date', '')
-                                time_str = reminder.get('time', '')
-                                
-                                if date_str and time_str:
-                                    # Combine date and time
-                                    datetime_str = f"{date_str} {time_str}"
-                                    try:
-                                        # Parse the datetime string
-                                        reminder_datetime = datetime.datetime.strptime(datetime_str, '%d.%m.%Y %H:%M')
-                                        # Localize to default timezone
-                                        reminder_datetime = DEFAULT_TIMEZONE.localize(reminder_datetime)
-                                        
-                                        # Check if reminder should be sent (with 24-hour window)
-                                        if (reminder_datetime <= now and 
-                                            now - reminder_datetime < timedelta(hours=24)):
-                                            try:
-                                                # Send reminder message to user in the required format
-                                                title = reminder.get('title', 'Напоминание')
-                                                
-                                                message = f"⏰ Вы просили напомнить \"{title}\""
-                                                
-                                                # Create inline keyboard with reschedule and delete options
-                                                keyboard = [
-                                                    [
-                                                        InlineKeyboardButton('Через час', callback_data=f'reminder_reschedule_one_hour_{reminder_id}'),
-                                                        InlineKeyboardButton('На завтра', callback_data=f'reminder_reschedule_tomorrow_{reminder_id}')
-                                                    ],
-                                                    [
-                                                        InlineKeyboardButton('Произвольно', callback_data=f'reminder_reschedule_custom_{reminder_id}'),
-                                                        InlineKeyboardButton('Удалить', callback_data=f'reminder_delete_{reminder_id}')
-                                                    ]
-                                                ]
-                                                reply_markup = InlineKeyboardMarkup(keyboard)
-                                                
-                                                # Send message to user
-                                                await application.bot.send_message(
-                                                    chat_id=int(user_id),
-                                                    text=message,
-                                                    reply_markup=reply_markup
-                                                )
-                                                
-                                                # Handle repeat logic
-                                                repeat = reminder.get('repeat', 'none')
-                                                if repeat != 'none':
-                                                    # For repeating reminders, calculate next occurrence
-                                                    next_time = calculate_next_occurrence(reminder_datetime, repeat)
-                                                    if next_time:
-                                                        # Update scheduled time for next occurrence
-                                                        user_data[user_id]['reminders'][reminder_id]['scheduled_at'] = next_time.isoformat()
-                                                        # Convert old format to new format
-                                                        user_data[user_id]['reminders'][reminder_id]['date'] = ''
-                                                        user_data[user_id]['reminders'][reminder_id]['time'] = ''
-                                                        # Keep sent as False for next occurrence
-                                                        user_data[user_id]['reminders'][reminder_id]['sent'] = False
-                                                    else:
-                                                        # If can't calculate next occurrence, mark as sent
-                                                        user_data[user_id]['reminders'][reminder_id]['sent'] = True
-                                                else:
-                                                    # For non-repeating reminders, mark as sent
-                                                    user_data[user_id]['reminders'][reminder_id]['sent'] = True
-                                                    
-                                                save_user_data(user_data)
-                                                
-                                                logger.info(f"Sent reminder '{title}' to user {user_id}")
-                                            except Exception as e:
-                                                logger.error(f"Failed to send reminder to user {user_id}: {e}")
-                                    except ValueError:
-                                        # Invalid date/time format
-                                        logger.error(f"Invalid date/time format for reminder {reminder_id} of user {user_id}")
-                        except Exception as e:
-                            logger.error(f"Error processing reminder {reminder_id} for user {user_id}: {e}")
-            
-            # Wait for 60 seconds before checking again
-            await asyncio.sleep(60)
+            await deliver_reminders(application, due, now)
         except Exception as e:
             logger.error(f"Error in check_and_send_reminders: {e}")
-            await asyncio.sleep(60)
+            await asyncio.sleep(1)
 
 if __name__ == "__main__":
     main()
-
-# Function to process pending reminders on startup
-async def process_pending_reminders_on_startup(application) -> None:
-    """Process all pending reminders on bot startup"""
-    import datetime
-    import pytz
-    
-    try:
-        logger.info("Processing pending reminders on startup...")
-        
-        # Default timezone (can be changed to user's timezone)
-        DEFAULT_TIMEZONE = pytz.timezone('Europe/Moscow')
-        
-        # Get current date and time with timezone
-        now = datetime.datetime.now(DEFAULT_TIMEZONE)
-        
-        # Load user data
-        user_data = load_user_data()
-        
-        # Track if any reminders were processed
-        reminders_processed = False
-        
-        # Check each user's reminders
-        for user_id, data in user_data.items():
-            if 'reminders' in data:
-                for reminder_id, reminder in data['reminders'].items():
-                    try:
-                        # Check if reminder has ISO format with timezone
-                        if 'scheduled_at' in reminder and reminder['scheduled_at']:
-                            # Parse the scheduled time with timezone
-                            scheduled_time = datetime.datetime.fromisoformat(reminder['scheduled_at'])
-                            
-                            # Check if reminder should be sent (with 24-hour window)
-                            if (scheduled_time <= now and 
-                                not reminder.get('sent', False) and
-                                now - scheduled_time < timedelta(hours=24)):
-                                try:
-                                    # Send reminder message to user in the required format
-                                    title = reminder.get('title', 'Напоминание')
-                                    
-                                    message = f"⏰ Вы просили напомнить \"{title}\""
-                                    
-                                    # Create inline keyboard with reschedule and delete options
-                                    keyboard = [
-                                        [
-                                            InlineKeyboardButton('Через час', callback_data=f'reminder_reschedule_one_hour_{reminder_id}'),
-                                            InlineKeyboardButton('На завтра', callback_data=f'reminder_reschedule_tomorrow_{reminder_id}')
-                                        ],
-                                        [
-                                            InlineKeyboardButton('Произвольно', callback_data=f'reminder_reschedule_custom_{reminder_id}'),
-                                            InlineKeyboardButton('Удалить', callback_data=f'reminder_delete_{reminder_id}')
-                                        ]
-                                    ]
-                                    reply_markup = InlineKeyboardMarkup(keyboard)
-                                    
-                                    # Send message to user
-                                    await application.bot.send_message(
-                                        chat_id=int(user_id),
-                                        text=message,
-                                        reply_markup=reply_markup
-                                    )
-                                    
-                                    # Handle repeat logic
-                                    repeat = reminder.get('repeat', 'none')
-                                    if repeat != 'none':
-                                        # For repeating reminders, calculate next occurrence
-                                        next_time = calculate_next_occurrence(scheduled_time, repeat)
-                                        if next_time:
-                                            # Update scheduled time for next occurrence
-                                            user_data[user_id]['reminders'][reminder_id]['scheduled_at'] = next_time.isoformat()
-                                            # Keep sent as False for next occurrence
-                                            user_data[user_id]['reminders'][reminder_id]['sent'] = False
-                                        else:
-                                            # If can't calculate next occurrence, mark as sent
-                                            user_data[user_id]['reminders'][reminder_id]['sent'] = True
-                                    else:
-                                        # For non-repeating reminders, mark as sent
-                                        user_data[user_id]['reminders'][reminder_id]['sent'] = True
-                                        
-                                    save_user_data(user_data)
-                                    
-                                    logger.info(f"Sent pending reminder '{title}' to user {user_id} on startup")
-                                    reminders_processed = True
-                                except Exception as e:
-                                    logger.error(f"Failed to send pending reminder to user {user_id}: {e}")
-                        
-                        # For backward compatibility with old format
-                        elif (reminder.get('date') and reminder.get('time') and
-                              not reminder.get('sent', False)):
-                            # Parse old format
-                            date_str = reminder.get('date', '')
-                            time_str = reminder.get('time', '')
-                            
-                            if date_str and time_str:
-                                # Combine date and time
-                                datetime_str = f"{date_str} {time_str}"
-                                try:
-                                    # Parse the datetime string
-                                    reminder_datetime = datetime.datetime.strptime(datetime_str, '%d.%m.%Y %H:%M')
-                                    # Localize to default timezone
-                                    reminder_datetime = DEFAULT_TIMEZONE.localize(reminder_datetime)
-                                    
-                                    # Check if reminder should be sent (with 24-hour window)
-                                    if (reminder_datetime <= now and 
-                                        now - reminder_datetime < timedelta(hours=24)):
-                                        try:
-                                            # Send reminder message to user in the required format
-                                            title = reminder.get('title', 'Напоминание')
-                                            
-                                            message = f"⏰ Вы просили напомнить \"{title}\""
-                                            
-                                            # Create inline keyboard with reschedule and delete options
-                                            keyboard = [
-                                                [
-                                                    InlineKeyboardButton('Через час', callback_data=f'reminder_reschedule_one_hour_{reminder_id}'),
-                                                    InlineKeyboardButton('На завтра', callback_data=f'reminder_reschedule_tomorrow_{reminder_id}')
-                                                ],
-                                                [
-                                                    InlineKeyboardButton('Произвольно', callback_data=f'reminder_reschedule_custom_{reminder_id}'),
-                                                    InlineKeyboardButton('Удалить', callback_data=f'reminder_delete_{reminder_id}')
-                                                ]
-                                            ]
-                                            reply_markup = InlineKeyboardMarkup(keyboard)
-                                            
-                                            # Send message to user
-                                            await application.bot.send_message(
-                                                chat_id=int(user_id),
-                                                text=message,
-                                                reply_markup=reply_markup
-                                            )
-                                            
-                                            # Handle repeat logic
-                                            repeat = reminder.get('repeat', 'none')
-                                            if repeat != 'none':
-                                                # For repeating reminders, calculate next occurrence
-                                                next_time = calculate_next_occurrence(reminder_datetime, repeat)
-                                                if next_time:
-                                                    # Update scheduled time for next occurrence
-                                                    user_data[user_id]['reminders'][reminder_id]['scheduled_at'] = next_time.isoformat()
-                                                    # Convert old format to new format
-                                                    user_data[user_id]['reminders'][reminder_id]['date'] = ''
-                                                    user_data[user_id]['reminders'][reminder_id]['time'] = ''
-                                                    # Keep sent as False for next occurrence
-                                                    user_data[user_id]['reminders'][reminder_id]['sent'] = False
-                                                else:
-                                                    # If can't calculate next occurrence, mark as sent
-                                                    user_data[user_id]['reminders'][reminder_id]['sent'] = True
-                                            else:
-                                                # For non-repeating reminders, mark as sent
-                                                user_data[user_id]['reminders'][reminder_id]['sent'] = True
-                                                
-                                            save_user_data(user_data)
-                                            
-                                            logger.info(f"Sent pending reminder '{title}' to user {user_id} on startup")
-                                            reminders_processed = True
-                                        except Exception as e:
-                                            logger.error(f"Failed to send pending reminder to user {user_id}: {e}")
-                                except ValueError:
-                                    # Invalid date/time format
-                                    logger.error(f"Invalid date/time format for reminder {reminder_id} of user {user_id}")
-                    except Exception as e:
-                        logger.error(f"Error processing reminder {reminder_id} for user {user_id}: {e}")
-        
-        if reminders_processed:
-            logger.info("Finished processing pending reminders on startup")
-        else:
-            logger.info("No pending reminders found on startup")
-            
-    except Exception as e:
-        logger.error(f"Error in process_pending_reminders_on_startup: {e}")
-
-# Function to calculate next occurrence for repeating reminders
-def calculate_next_occurrence(current_time, repeat_type):
-    """Calculate next occurrence time for repeating reminders"""
-    import datetime
-    import pytz
-    
-    try:
-        # Default timezone
-        DEFAULT_TIMEZONE = pytz.timezone('Europe/Moscow')
-        
-        # Make sure current_time is timezone-aware
-        if current_time.tzinfo is None:
-            current_time = DEFAULT_TIMEZONE.localize(current_time)
-        
-        next_time = None
-        
-        if repeat_type == 'daily':
-            next_time = current_time + timedelta(days=1)
-        elif repeat_type == 'weekly':
-            next_time = current_time + timedelta(weeks=1)
-        elif repeat_type == 'monthly':
-            # Add one month
-            if current_time.month == 12:
-                next_time = current_time.replace(year=current_time.year + 1, month=1)
-            else:
-                next_time = current_time.replace(month=current_time.month + 1)
-        elif repeat_type == 'weekdays':
-            # Next weekday (Mon-Fri)
-            next_time = current_time + timedelta(days=1)
-            # Skip weekends
-            while next_time.weekday() >= 5:  # 5 = Saturday, 6 = Sunday
-                next_time += timedelta(days=1)
-        
-        return next_time
-    except Exception as e:
-        logger.error(f"Error calculating next occurrence: {e}")
-        return None
@@ -7,6 +7,77 @@ load_dotenv()
 # Telegram Bot Token - loaded from environment variables
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 
+# Bybit API base URL
+BYBIT_API_URL = os.getenv("BYBIT_API_URL", "https://api.bybit.com")
+
 # Data files
 USER_DATA_FILE = "user_data.json"
-USER_STATES_FILE = "user_states.json"
\ No newline at end of file
+USER_STATES_FILE = "user_states.json"
+
+# Storage layout for user data:
+#   "json"    - a single USER_DATA_FILE
+#   "sharded" - one file per user (or per hash bucket) under USER_DATA_DIR
+#   "sqlite"  - an SQLite database in WAL mode at USER_DATA_DB
+#   "journal" - USER_DATA_FILE as a snapshot plus an append-only USER_DATA_JOURNAL
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json")
+USER_DATA_DIR = os.getenv("USER_DATA_DIR", "user_data")
+USER_DATA_DB = os.getenv("USER_DATA_DB", "user_data.db")
+# Number of hash buckets for the sharded layout, 0 means one file per user
+USER_DATA_SHARDS = int(os.getenv("USER_DATA_SHARDS", "0"))
+USER_DATA_JOURNAL = os.getenv("USER_DATA_JOURNAL", "user_data.journal")
+# How often (in seconds) the journal is folded into the snapshot
+JOURNAL_COMPACT_INTERVAL = float(os.getenv("JOURNAL_COMPACT_INTERVAL", "300"))
+
+# How often (in seconds) changed user data is written to disk
+USER_DATA_FLUSH_INTERVAL = float(os.getenv("USER_DATA_FLUSH_INTERVAL", "5"))
+# Saves arriving within this many seconds are written to disk together
+USER_DATA_COMMIT_WINDOW = float(os.getenv("USER_DATA_COMMIT_WINDOW", "0.1"))
+
+# Reminder scheduler engine:
+#   "heap"  - a priority queue ordered by due time
+#   "wheel" - a hierarchical timing wheel, O(1) inserts and cancels for
+#             deployments with hundreds of thousands of active reminders
+REMINDER_SCHEDULER = os.getenv("REMINDER_SCHEDULER", "heap")
+
+# Most reminders sent in one scheduler pass; a backlog of missed reminders is
+# sent oldest first in passes of this size, each saved with one commit
+REMINDER_BATCH_SIZE = int(os.getenv("REMINDER_BATCH_SIZE", "100"))
+
+# Reminder messages are sent by DELIVERY_WORKERS concurrent workers, at most
+# DELIVERY_GLOBAL_RATE messages per second overall and DELIVERY_CHAT_RATE per chat
+DELIVERY_WORKERS = int(os.getenv("DELIVERY_WORKERS", "8"))
+DELIVERY_GLOBAL_RATE = float(os.getenv("DELIVERY_GLOBAL_RATE", "30"))
+DELIVERY_CHAT_RATE = float(os.getenv("DELIVERY_CHAT_RATE", "1"))
+# Failed deliveries are retried with jittered exponential backoff starting at
+# DELIVERY_RETRY_BASE seconds and capped at DELIVERY_RETRY_MAX seconds; after
+# DELIVERY_MAX_ATTEMPTS attempts the delivery is given up (dead-lettered)
+DELIVERY_RETRY_BASE = float(os.getenv("DELIVERY_RETRY_BASE", "30"))
+DELIVERY_RETRY_MAX = float(os.getenv("DELIVERY_RETRY_MAX", "3600"))
+DELIVERY_MAX_ATTEMPTS = int(os.getenv("DELIVERY_MAX_ATTEMPTS", "8"))
+# Ledger of delivered reminder occurrences shared by all bot instances; entries
+# are kept DELIVERY_LEDGER_RETENTION seconds, longer than the 24-hour window
+# in which a reminder can still be sent
+DELIVERY_LEDGER_DB = os.getenv("DELIVERY_LEDGER_DB", "delivery_ledger.db")
+DELIVERY_LEDGER_RETENTION = float(os.getenv("DELIVERY_LEDGER_RETENTION", "90000"))
+
+# Bot processes on one machine coordinate through COORDINATION_DB. Only the
+# process holding the scheduler lease sends reminders; if it dies another one
+# takes over within SCHEDULER_LEASE_TTL seconds
+COORDINATION_DB = os.getenv("COORDINATION_DB", "coordination.db")
+SCHEDULER_LEASE_TTL = float(os.getenv("SCHEDULER_LEASE_TTL", "15"))
+# Only the sqlite storage backend can be shared by several processes; they
+# reload the users the others changed every USER_DATA_REFRESH_INTERVAL
+# seconds. With any other backend one process at a time uses the data and
+# the next one waits for the scheduler lease before it starts
+USER_DATA_REFRESH_INTERVAL = float(os.getenv("USER_DATA_REFRESH_INTERVAL", "2"))
+# How reminder sending is shared between processes:
+#   "leader"      - one process (the lease holder) sends all reminders
+#   "partitioned" - every process sends the reminders of its own range of
+#                   user id hashes, rebalanced as processes join or leave;
+#                   needs STORAGE_BACKEND=sqlite
+SCHEDULER_MODE = os.getenv("SCHEDULER_MODE", "leader")
+
+# Conversation states expire after USER_STATE_TTL seconds of inactivity and
+# are snapshotted to USER_STATES_FILE every USER_STATES_FLUSH_INTERVAL seconds
+USER_STATE_TTL = float(os.getenv("USER_STATE_TTL", "3600"))
+USER_STATES_FLUSH_INTERVAL = float(os.getenv("USER_STATES_FLUSH_INTERVAL", "60"))
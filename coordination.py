@@ -0,0 +1,270 @@
+"""
+Coordination between several bot processes
+
+Processes on the same machine coordinate through a small SQLite database.
+A Lease is held by at most one process at a time and expires unless its
+holder renews it, so when the holder dies another process takes over within
+one lease period. A Membership splits work between all live processes: users
+are hashed into PARTITIONS partitions and each member owns a contiguous range
+of them, rebalanced whenever a member joins or leaves.
+"""
+
+import asyncio
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+
+logger = logging.getLogger(__name__)
+
+COORDINATION_SCHEMA = """
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS members (
+    group_name TEXT NOT NULL,
+    member TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    PRIMARY KEY (group_name, member)
+);
+"""
+
+PARTITIONS = 256
+
+
+def partition_of(user_id):
+    """Stable partition of a user, the same in every process"""
+    return zlib.crc32(str(user_id).encode('utf-8')) % PARTITIONS
+
+
+def _connect(path):
+    conn = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(COORDINATION_SCHEMA)
+    return conn
+
+
+def process_id():
+    """Name of this process, unique across restarts"""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class Lease:
+    """
+    A named lease in the coordination database.
+
+    try_acquire() takes the lease if it is free or expired and renews it if
+    this process already holds it. run() keeps renewing it every ttl / 3
+    seconds and runs a task only while the lease is held.
+    """
+
+    def __init__(self, path, name, owner=None, ttl=15.0):
+        self.path = path
+        self.name = name
+        self.owner = owner or process_id()
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = None
+        # Monotonic deadline until which this process may act as the holder
+        self._valid_until = 0.0
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = _connect(self.path)
+        return self._conn
+
+    @property
+    def held(self):
+        return time.monotonic() < self._valid_until
+
+    def try_acquire(self):
+        """Take or renew the lease; returns whether this process holds it"""
+        started = time.monotonic()
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                acquired = conn.execute(
+                    "UPDATE leases SET owner = ?, expires_at = ? "
+                    "WHERE name = ? AND (owner = ? OR expires_at <= ?)",
+                    (self.owner, now + self.ttl, self.name, self.owner, now)
+                ).rowcount == 1
+                if not acquired:
+                    acquired = conn.execute(
+                        "INSERT OR IGNORE INTO leases (name, owner, expires_at) VALUES (?, ?, ?)",
+                        (self.name, self.owner, now + self.ttl)
+                    ).rowcount == 1
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        # Count the lease from before the write, in case it was slow
+        self._valid_until = started + self.ttl if acquired else 0.0
+        return acquired
+
+    def release(self):
+        """Give the lease up if this process holds it"""
+        self._valid_until = 0.0
+        with self._lock:
+            self._connection().execute(
+                "DELETE FROM leases WHERE name = ? AND owner = ?", (self.name, self.owner))
+
+    def holder(self):
+        """Owner of an unexpired lease, or None"""
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT owner FROM leases WHERE name = ? AND expires_at > ?", (self.name, time.time())
+            ).fetchone()
+        return row[0] if row else None
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    async def run(self, work):
+        """
+        Run the coroutine function `work` while this process holds the lease:
+        start it once the lease is acquired, cancel it when the lease is lost,
+        and give the lease up on exit.
+        """
+        loop = asyncio.get_running_loop()
+        task = None
+        try:
+            while True:
+                try:
+                    held = await loop.run_in_executor(None, self.try_acquire)
+                except sqlite3.Error as e:
+                    logger.error(f"Error renewing lease {self.name}: {e}")
+                    held = self.held
+                if held and task is None:
+                    logger.info(f"Acquired lease {self.name} as {self.owner}")
+                    task = asyncio.ensure_future(work())
+                elif not held and task is not None:
+                    logger.warning(f"Lost lease {self.name}, stopping")
+                    task.cancel()
+                    task = None
+                if task is not None and task.done():
+                    # Start it again on the next renewal
+                    if not task.cancelled() and task.exception() is not None:
+                        logger.error(f"Task under lease {self.name} failed: {task.exception()}")
+                    task = None
+                await asyncio.sleep(self.ttl / 3)
+        finally:
+            if task is not None:
+                task.cancel()
+            await loop.run_in_executor(None, self.release)
+
+
+class Membership:
+    """
+    Live members of a group of processes sharing work by user partition.
+
+    heartbeat() refreshes this process's row and reads the live members in a
+    fixed order; member i of n owns partitions [i * P / n, (i + 1) * P / n).
+    A member that misses heartbeats for `ttl` seconds drops out and the
+    others take its partitions over; it stops owning anything itself at the
+    same time, so two members only overlap while a change is being noticed.
+    """
+
+    def __init__(self, path, group, member=None, ttl=15.0):
+        self.path = path
+        self.group = group
+        self.member = member or process_id()
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = None
+        self.members = []
+        self._partitions = range(0)
+        self._valid_until = 0.0
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = _connect(self.path)
+        return self._conn
+
+    def heartbeat(self):
+        """Refresh this member and recompute its partitions; returns whether they changed"""
+        started = time.monotonic()
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(
+                    "INSERT OR REPLACE INTO members (group_name, member, expires_at) VALUES (?, ?, ?)",
+                    (self.group, self.member, now + self.ttl)
+                )
+                conn.execute("DELETE FROM members WHERE group_name = ? AND expires_at <= ?", (self.group, now))
+                members = [row[0] for row in conn.execute(
+                    "SELECT member FROM members WHERE group_name = ? ORDER BY member", (self.group,))]
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        self._valid_until = started + self.ttl
+        if members == self.members:
+            return False
+        self.members = members
+        index = members.index(self.member)
+        self._partitions = range(index * PARTITIONS // len(members), (index + 1) * PARTITIONS // len(members))
+        return True
+
+    @property
+    def partitions(self):
+        """Partitions this member owns, empty if its heartbeat has lapsed"""
+        return self._partitions if time.monotonic() < self._valid_until else range(0)
+
+    def owns(self, user_id):
+        return partition_of(user_id) in self.partitions
+
+    def leave(self):
+        """Drop out of the group so the others take over right away"""
+        self._valid_until = 0.0
+        self.members = []
+        with self._lock:
+            self._connection().execute(
+                "DELETE FROM members WHERE group_name = ? AND member = ?", (self.group, self.member))
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    async def run(self, on_change):
+        """
+        Heartbeat every ttl / 3 seconds and, whenever the partitions move,
+        await the coroutine function on_change(previous) with the partitions
+        owned until then
+        """
+        loop = asyncio.get_running_loop()
+        owned = self.partitions
+        try:
+            while True:
+                try:
+                    await loop.run_in_executor(None, self.heartbeat)
+                except sqlite3.Error as e:
+                    logger.error(f"Error sending heartbeat for {self.group}: {e}")
+                if self.partitions != owned:
+                    previous, owned = owned, self.partitions
+                    if owned:
+                        logger.info(f"{self.group}: {len(self.members)} members, "
+                                    f"this one owns partitions {owned.start}-{owned.stop - 1}")
+                    else:
+                        logger.warning(f"{self.group}: this member owns no partitions")
+                    try:
+                        await on_change(previous)
+                    except Exception as e:
+                        logger.error(f"Error rebalancing {self.group}: {e}")
+                await asyncio.sleep(self.ttl / 3)
+        finally:
+            await loop.run_in_executor(None, self.leave)
@@ -0,0 +1,233 @@
+"""
+Rate-limited concurrent message delivery
+
+Telegram allows a bot roughly 30 messages per second overall and about one
+per second to the same chat. The dispatcher sends a batch of messages with a
+bounded pool of workers, pacing them with one global token bucket and one
+bucket per chat, and re-queues a message when Telegram answers with
+RetryAfter, holding back all sends for the delay it asks for. retry_delay() and is_permanent_failure() decide what happens to
+messages that still fail, and DeliveryLedger makes sure each reminder
+occurrence is sent once even across restarts and several bot instances.
+"""
+
+import asyncio
+import logging
+import random
+import sqlite3
+import threading
+import time
+from datetime import timedelta
+
+from telegram.error import BadRequest, Forbidden, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+
+def retry_delay(attempts, base, cap):
+    """Jittered exponential backoff before retry number `attempts` (1-based)"""
+    delay = min(cap, base * 2 ** (attempts - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def is_permanent_failure(error):
+    """Whether retrying can't help: the user blocked the bot or the chat is gone"""
+    if isinstance(error, Forbidden):
+        return True
+    return isinstance(error, BadRequest) and 'chat not found' in str(error).lower()
+
+
+class TokenBucket:
+    """Token bucket refilled at `rate` tokens per second, holding at most `burst`"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self):
+        """Take a token, possibly ahead of time; returns how long to wait before using it"""
+        self._refill()
+        self._tokens -= 1
+        return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def pause(self, seconds):
+        """Hand out no tokens for the next `seconds`"""
+        self._refill()
+        self._tokens = min(self._tokens, -seconds * self.rate)
+
+    def idle_for(self):
+        """Seconds the bucket has been full, 0 if it isn't"""
+        full_at = self._updated + (self.burst - self._tokens) / self.rate
+        return max(0.0, time.monotonic() - full_at)
+
+
+class Dispatcher:
+    """
+    Sends messages concurrently within the global and per-chat rate limits.
+
+    The buckets live as long as the dispatcher, so the limits hold across
+    batches; per-chat buckets are dropped once they have been idle a while.
+    """
+
+    # Per-chat buckets idle this many seconds are forgotten
+    IDLE_BUCKET_TTL = 60.0
+
+    def __init__(self, workers=8, global_rate=30.0, chat_rate=1.0, max_retries=3):
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate)
+        self._chats = {}
+
+    async def dispatch(self, send, messages, on_sent=None):
+        """
+        Send `messages`, a list of (chat_id, send kwargs), with `send`
+        (e.g. bot.send_message). Returns one entry per message in the same
+        order: None if it was sent, otherwise the exception it failed with.
+        on_sent(index), if given, is called as soon as a message went out,
+        so a caller that gets cancelled still knows what was sent.
+        """
+        self._drop_idle_buckets()
+        results = [None] * len(messages)
+        queue = asyncio.Queue()
+        for index in range(len(messages)):
+            queue.put_nowait((index, 0))
+
+        async def worker():
+            while True:
+                try:
+                    index, attempt = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                chat_id, kwargs = messages[index]
+                bucket = self._bucket(chat_id)
+                try:
+                    await asyncio.sleep(bucket.reserve())
+                    await asyncio.sleep(self._global.reserve())
+                    await send(chat_id=chat_id, **kwargs)
+                    if on_sent is not None:
+                        on_sent(index)
+                except RetryAfter as e:
+                    delay = e.retry_after
+                    if isinstance(delay, timedelta):
+                        delay = delay.total_seconds()
+                    # Flood limits are mostly bot-wide, so every chat waits
+                    self._global.pause(delay)
+                    if attempt < self.max_retries:
+                        logger.warning(f"Flood limit for chat {chat_id}, retrying in {delay}s")
+                        bucket.pause(delay)
+                        queue.put_nowait((index, attempt + 1))
+                    else:
+                        results[index] = e
+                except Exception as e:
+                    results[index] = e
+
+        await asyncio.gather(*(worker() for _ in range(min(self.workers, len(messages)))))
+        return results
+
+    def set_global_rate(self, rate):
+        """Change the overall limit, e.g. when several processes share the bot"""
+        self._global.rate = rate
+
+    def _bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate)
+        return bucket
+
+    def _drop_idle_buckets(self):
+        for chat_id, bucket in list(self._chats.items()):
+            if bucket.idle_for() > self.IDLE_BUCKET_TTL:
+                del self._chats[chat_id]
+
+
+LEDGER_SCHEMA = """
+CREATE TABLE IF NOT EXISTS deliveries (
+    user_id TEXT NOT NULL,
+    reminder_id TEXT NOT NULL,
+    occurrence TEXT NOT NULL,
+    occurrence_ts REAL NOT NULL,
+    claimed_at REAL NOT NULL,
+    PRIMARY KEY (user_id, reminder_id, occurrence)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_deliveries_occurrence ON deliveries(occurrence_ts);
+"""
+
+
+class DeliveryLedger:
+    """
+    Record of reminder occurrences that have been (or are being) delivered,
+    in an SQLite database shared by every bot instance.
+
+    claim() inserts (user_id, reminder_id, occurrence) keys with INSERT OR
+    IGNORE in one transaction; only the caller whose insert went through may
+    send that occurrence. Keys of messages that could not be sent are
+    released so they can be claimed again, and entries older than
+    `retention` seconds are pruned, since such occurrences are never sent.
+    """
+
+    # Prune at most this often (seconds)
+    PRUNE_INTERVAL = 3600.0
+
+    def __init__(self, path, retention=25 * 3600):
+        self.path = path
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pruned_at = 0.0
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(LEDGER_SCHEMA)
+        return self._conn
+
+    def claim(self, entries):
+        """
+        Atomically claim (user_id, reminder_id, occurrence, occurrence_ts)
+        entries; returns one bool per entry, False if it was already claimed
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                claimed = [
+                    conn.execute(
+                        "INSERT OR IGNORE INTO deliveries VALUES (?, ?, ?, ?, ?)",
+                        (str(user_id), str(reminder_id), occurrence, occurrence_ts, now)
+                    ).rowcount == 1
+                    for user_id, reminder_id, occurrence, occurrence_ts in entries
+                ]
+                if now - self._pruned_at >= self.PRUNE_INTERVAL:
+                    conn.execute("DELETE FROM deliveries WHERE occurrence_ts < ?", (now - self.retention,))
+                    self._pruned_at = now
+        return claimed
+
+    def release(self, entries):
+        """Forget claims whose messages were not sent"""
+        if not entries:
+            return
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.executemany(
+                    "DELETE FROM deliveries WHERE user_id = ? AND reminder_id = ? AND occurrence = ?",
+                    [(str(user_id), str(reminder_id), occurrence) for user_id, reminder_id, occurrence, _ in entries]
+                )
+
+    def __len__(self):
+        with self._lock:
+            return self._connection().execute("SELECT COUNT(*) FROM deliveries").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+"""
+One-shot migration of user_data.json into another storage layout
+
+Usage:
+    python migrate_user_data.py sharded [--shards N]
+    python migrate_user_data.py sqlite [--db PATH]
+"""
+
+import argparse
+import os
+import sys
+
+from config import USER_DATA_FILE, USER_DATA_DIR, USER_DATA_SHARDS, USER_DATA_DB
+from storage import migrate_json_to_shards, migrate_json_to_sqlite
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate user_data.json to another storage layout")
+    parser.add_argument('target', choices=['sharded', 'sqlite'], help="storage layout to migrate to")
+    parser.add_argument('--source', default=USER_DATA_FILE, help="monolithic JSON file to read")
+    parser.add_argument('--dir', default=USER_DATA_DIR, help="directory for the sharded layout")
+    parser.add_argument('--shards', type=int, default=USER_DATA_SHARDS,
+                        help="number of hash buckets, 0 for one file per user")
+    parser.add_argument('--db', default=USER_DATA_DB, help="database file for the sqlite layout")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.source):
+        print(f"❌ Файл {args.source} не найден")
+        sys.exit(1)
+
+    if args.target == 'sqlite':
+        count = migrate_json_to_sqlite(args.source, args.db)
+        destination = args.db
+    else:
+        count = migrate_json_to_shards(args.source, args.dir, args.shards)
+        destination = f"{args.dir}/"
+    print(f"✅ Перенесено пользователей: {count} ({args.source} -> {destination})")
+    print(f"Установите STORAGE_BACKEND={args.target} в файле .env, чтобы бот использовал новый формат.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Versioned schema migrations for user records
+
+Every record carries a `schema_version`. migrate_all() upgrades each record
+step by step to SCHEMA_VERSION once at startup, so handlers can rely on the
+canonical shape produced by new_user_record() instead of repairing records
+on every request.
+"""
+
+import functools
+import logging
+from datetime import datetime
+
+import pytz
+
+from recurrence import preset
+
+logger = logging.getLogger(__name__)
+
+# Resolved once; handlers and the scheduler share it
+DEFAULT_TIMEZONE = pytz.timezone('Europe/Moscow')
+DEFAULT_SHOPPING_CATEGORIES = ('Продукты', 'Аптека', 'Остальное')
+
+
+def _add_missing_collections(record):
+    """v0 -> v1: every user has all collections and default shopping categories"""
+    record.setdefault('bybit_api_key', '')
+    record.setdefault('bybit_api_secret', '')
+    record.setdefault('piggy_banks', {})
+    record.setdefault('notes', {})
+    record.setdefault('reminders', {})
+    shopping_list = record.setdefault('shopping_list', {})
+    for category in DEFAULT_SHOPPING_CATEGORIES:
+        shopping_list.setdefault(category, [])
+
+
+def _convert_legacy_reminders(record):
+    """v1 -> v2: reminders with separate date/time fields get scheduled_at"""
+    for reminder_id, reminder in record['reminders'].items():
+        if reminder.get('scheduled_at') or not (reminder.get('date') and reminder.get('time')):
+            continue
+        try:
+            scheduled = datetime.strptime(f"{reminder['date']} {reminder['time']}", '%d.%m.%Y %H:%M')
+        except ValueError:
+            logger.warning(f"Leaving reminder {reminder_id} with unreadable date/time as is")
+            continue
+        reminder['scheduled_at'] = DEFAULT_TIMEZONE.localize(scheduled).isoformat()
+        reminder['date'] = ''
+        reminder['time'] = ''
+
+
+def _add_scheduled_timestamps(record):
+    """v2 -> v3: reminders keep their due time as UTC epoch seconds in scheduled_ts"""
+    for reminder_id, reminder in record['reminders'].items():
+        if not reminder.get('scheduled_at'):
+            continue
+        try:
+            set_scheduled_time(reminder, datetime.fromisoformat(reminder['scheduled_at']))
+        except ValueError:
+            logger.warning(f"Leaving reminder {reminder_id} with unreadable scheduled_at as is")
+
+
+def _add_timezone(record):
+    """v3 -> v4: every user has a timezone, existing users keep Moscow time"""
+    record.setdefault('timezone', DEFAULT_TIMEZONE.zone)
+
+
+def _add_recurrence_rules(record):
+    """v4 -> v5: repeating reminders keep their rule in 'recurrence', anchored at their current time"""
+    for reminder in record['reminders'].values():
+        if reminder.get('repeat', 'none') == 'none' or not reminder.get('scheduled_at'):
+            continue
+        try:
+            local = datetime.fromisoformat(reminder['scheduled_at']).replace(tzinfo=None)
+        except ValueError:
+            continue
+        rule = preset(reminder['repeat'], local)
+        if rule is not None:
+            reminder['recurrence'] = rule.to_dict()
+
+
+# MIGRATIONS[n] upgrades a record from version n to n + 1
+MIGRATIONS = [
+    _add_missing_collections,
+    _convert_legacy_reminders,
+    _add_scheduled_timestamps,
+    _add_timezone,
+    _add_recurrence_rules,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+@functools.lru_cache(maxsize=None)
+def get_timezone(name):
+    """Timezone object for an IANA name, resolved once per name; None if unknown"""
+    try:
+        return pytz.timezone(name)
+    except pytz.UnknownTimeZoneError:
+        return None
+
+
+def user_timezone(record):
+    """The user's timezone, Moscow if it isn't set or is unknown"""
+    return get_timezone(record.get('timezone') or DEFAULT_TIMEZONE.zone) or DEFAULT_TIMEZONE
+
+
+def set_scheduled_time(reminder, when):
+    """
+    Schedule a reminder at an aware datetime: scheduled_at keeps the local
+    time for display, scheduled_ts the UTC epoch seconds used for due checks
+    """
+    reminder['scheduled_at'] = when.isoformat()
+    reminder['scheduled_ts'] = int(when.timestamp())
+
+
+def new_user_record():
+    """A fresh user in the current schema"""
+    record = {'schema_version': 0}
+    migrate_user(record)
+    return record
+
+
+def migrate_user(record):
+    """Upgrade one record in place; returns True if anything was applied"""
+    version = record.get('schema_version', 0)
+    if version >= SCHEMA_VERSION:
+        return False
+    for migration in MIGRATIONS[version:]:
+        migration(record)
+    record['schema_version'] = SCHEMA_VERSION
+    return True
+
+
+def migrate_all(data):
+    """Upgrade every user in a user_id -> record mapping; returns the ids that changed"""
+    migrated = [user_id for user_id, record in data.items() if migrate_user(record)]
+    if migrated:
+        logger.info(f"Migrated {len(migrated)} users to schema version {SCHEMA_VERSION}")
+    return migrated
@@ -0,0 +1,271 @@
+"""
+Recurrence rules for repeating reminders
+
+A Recurrence says on which local wall-clock times a reminder repeats, in the
+spirit of iCalendar RRULEs: every `interval` days, weeks or months, on a set
+of weekdays, on a day of the month (or its last day) or on the nth weekday
+of the month, until a given time or for a number of occurrences.
+
+Occurrences are computed arithmetically from the current one. Days, weeks
+and months are numbered, so the next occurrence after any moment is found by
+jumping straight to the right period instead of stepping through the ones in
+between, and a reminder that missed many occurrences while the bot was down
+moves to the next future one in a single step. occurrences() previews a
+series lazily and count_between() counts it over a date range without
+expanding it. All times are naive local datetimes; callers localize them in
+the user's timezone.
+"""
+
+import calendar
+from datetime import date, datetime
+
+FREQUENCIES = ('daily', 'weekly', 'monthly')
+WEEKDAYS = (0, 1, 2, 3, 4)
+
+WEEKDAY_NAMES = ('пн', 'вт', 'ср', 'чт', 'пт', 'сб', 'вс')
+
+
+class Recurrence:
+    """
+    A repetition rule.
+
+    freq is 'daily', 'weekly' or 'monthly'. Weekly rules repeat on
+    `weekdays` (0 is Monday). Monthly rules repeat either on `monthday`
+    (-1 for the last day; a day past the end of a short month falls on its
+    last day) or, with `setpos`, on the setpos-th (1-4, or -1 for the last)
+    `weekdays[0]` of the month. `until` is the latest local time an
+    occurrence may have and `count` the number of occurrences left,
+    including the current one. The time of day is that of the current
+    occurrence.
+    """
+
+    def __init__(self, freq, interval=1, weekdays=(), monthday=None, setpos=None, until=None, count=None):
+        if freq not in FREQUENCIES:
+            raise ValueError(f"Unknown frequency: {freq}")
+        if interval < 1:
+            raise ValueError(f"Interval must be positive: {interval}")
+        weekdays = tuple(sorted(set(weekdays)))
+        if any(not 0 <= weekday <= 6 for weekday in weekdays):
+            raise ValueError(f"Weekdays must be 0-6: {weekdays}")
+        if freq == 'weekly' and not weekdays:
+            raise ValueError("Weekly rules need weekdays")
+        if freq == 'monthly':
+            if (monthday is None) == (setpos is None):
+                raise ValueError("Monthly rules need either monthday or setpos")
+            if monthday is not None and not (1 <= monthday <= 31 or monthday == -1):
+                raise ValueError(f"Day of month must be 1-31 or -1: {monthday}")
+            if setpos is not None and (setpos not in (1, 2, 3, 4, -1) or len(weekdays) != 1):
+                raise ValueError("setpos must be 1-4 or -1, with exactly one weekday")
+        self.freq = freq
+        self.interval = interval
+        self.weekdays = weekdays
+        self.monthday = monthday
+        self.setpos = setpos
+        self.until = until
+        self.count = count
+
+    @classmethod
+    def from_dict(cls, data):
+        until = data.get('until')
+        return cls(
+            data['freq'],
+            interval=data.get('interval', 1),
+            weekdays=data.get('weekdays', ()),
+            monthday=data.get('monthday'),
+            setpos=data.get('setpos'),
+            until=datetime.fromisoformat(until) if until else None,
+            count=data.get('count'),
+        )
+
+    def to_dict(self):
+        data = {'freq': self.freq, 'interval': self.interval}
+        if self.weekdays:
+            data['weekdays'] = list(self.weekdays)
+        if self.monthday is not None:
+            data['monthday'] = self.monthday
+        if self.setpos is not None:
+            data['setpos'] = self.setpos
+        if self.until is not None:
+            data['until'] = self.until.isoformat()
+        if self.count is not None:
+            data['count'] = self.count
+        return data
+
+    def __eq__(self, other):
+        return isinstance(other, Recurrence) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return f"Recurrence({self.to_dict()})"
+
+    def _period(self, day):
+        """Number of the day, week or month containing `day`"""
+        if self.freq == 'daily':
+            return day.toordinal()
+        if self.freq == 'weekly':
+            # Day 1 (0001-01-01) is a Monday
+            return (day.toordinal() - 1) // 7
+        return day.year * 12 + day.month - 1
+
+    def _days(self, period):
+        """Dates of the occurrences within a period, in order"""
+        if self.freq == 'daily':
+            return [date.fromordinal(period)]
+        if self.freq == 'weekly':
+            monday = period * 7 + 1
+            return [date.fromordinal(monday + weekday) for weekday in self.weekdays]
+        year, month = divmod(period, 12)
+        month += 1
+        length = calendar.monthrange(year, month)[1]
+        if self.setpos is None:
+            day = length if self.monthday == -1 else min(self.monthday, length)
+        else:
+            first = (self.weekdays[0] - date(year, month, 1).weekday()) % 7 + 1
+            if self.setpos == -1:
+                day = first + (length - first) // 7 * 7
+            else:
+                day = first + (self.setpos - 1) * 7
+        return [date(year, month, day)]
+
+    def _per_period(self):
+        return len(self.weekdays) if self.freq == 'weekly' else 1
+
+    def _position(self, current, moment, inclusive=True):
+        """
+        Number of occurrences of the series through `current` from the start
+        of current's period up to `moment` (up to and including it if
+        `inclusive`)
+        """
+        first = self._period(current.date())
+        period = self._period(moment.date())
+        if period < first:
+            return 0
+        # Whole repeating periods before moment's period
+        position = -(-(period - first) // self.interval) * self._per_period()
+        if (period - first) % self.interval == 0:
+            for day in self._days(period):
+                occurrence = datetime.combine(day, current.time())
+                if occurrence < moment or (inclusive and occurrence == moment):
+                    position += 1
+        return position
+
+    def next_after(self, current, after=None):
+        """
+        First occurrence after both `current` (an occurrence of the rule) and
+        `after`, or None if the rule ends before it; ignores `count`
+        """
+        if after is None or after < current:
+            after = current
+        first = self._period(current.date())
+        period = max(self._period(after.date()), first)
+        # Round up to a period the rule repeats in
+        period = first + -(-(period - first) // self.interval) * self.interval
+        for candidate in (period, period + self.interval):
+            following = [datetime.combine(day, current.time()) for day in self._days(candidate)]
+            following = [occurrence for occurrence in following if occurrence > after]
+            if following:
+                break
+        occurrence = following[0]
+        if self.until is not None and occurrence > self.until:
+            return None
+        return occurrence
+
+    def advance(self, current, after=None):
+        """
+        Move from the occurrence `current` to the first one after `after`
+        (or right after current), counting the skipped ones off `count`.
+        Returns the new occurrence, or None if the rule has ended.
+        """
+        occurrence = self.next_after(current, after)
+        if occurrence is None:
+            return None
+        if self.count is not None:
+            steps = self._position(current, occurrence) - self._position(current, current)
+            if steps >= self.count:
+                return None
+            self.count -= steps
+        return occurrence
+
+    def occurrences(self, current):
+        """
+        Lazily yield `current` and the occurrences after it until the rule
+        ends; the rule itself is left unchanged
+        """
+        remaining = self.count
+        occurrence = current
+        while occurrence is not None and (remaining is None or remaining > 0):
+            if self.until is not None and occurrence > self.until:
+                return
+            yield occurrence
+            if remaining is not None:
+                remaining -= 1
+            occurrence = self.next_after(occurrence)
+
+    def count_between(self, current, start, end):
+        """
+        Number of occurrences() from `current` on that fall between `start`
+        and `end` inclusive, computed without generating them
+        """
+        if self.until is not None:
+            end = min(end, self.until)
+        if end < start or end < current or (self.count is not None and self.count <= 0):
+            return 0
+        total = 1 if start <= current else 0
+        # Occurrences after current are numbered base + 1, base + 2, ...
+        base = self._position(current, current)
+        low = max(base, self._position(current, start, inclusive=False))
+        high = self._position(current, end)
+        if self.count is not None:
+            high = min(high, base + self.count - 1)
+        return total + max(0, high - low)
+
+    def describe(self):
+        """Short description for the reminder view, in Russian"""
+        if self.freq == 'daily':
+            text = 'Ежедневно' if self.interval == 1 else f'Каждые {self.interval} дн.'
+        elif self.freq == 'weekly':
+            if self.weekdays == WEEKDAYS and self.interval == 1:
+                text = 'По будням'
+            else:
+                days = ', '.join(WEEKDAY_NAMES[weekday] for weekday in self.weekdays)
+                text = f'Еженедельно: {days}' if self.interval == 1 else f'Раз в {self.interval} нед.: {days}'
+        else:
+            text = 'Ежемесячно' if self.interval == 1 else f'Раз в {self.interval} мес.'
+            weekday = WEEKDAY_NAMES[self.weekdays[0]] if self.weekdays else ''
+            if self.setpos == -1:
+                text += f', в последний {weekday}'
+            elif self.setpos is not None:
+                text += f', {self.setpos}-й {weekday}'
+            elif self.monthday == -1:
+                text += ', в последний день'
+            else:
+                text += f', {self.monthday} числа'
+        if self.until is not None:
+            text += f', до {self.until.strftime("%d.%m.%Y")}'
+        if self.count is not None:
+            text += f', осталось {self.count}'
+        return text
+
+
+# Repeat settings offered in the reminder menu; none has an underscore, as
+# they travel in callback data
+REPEAT_PRESETS = ('daily', 'weekdays', 'weekly', 'biweekly', 'monthly', 'monthweekday', 'monthlast')
+
+
+def preset(name, start):
+    """The rule behind a `repeat` setting for a reminder first due at local time `start`; None for 'none'"""
+    if name == 'daily':
+        return Recurrence('daily')
+    if name == 'weekdays':
+        return Recurrence('weekly', weekdays=WEEKDAYS)
+    if name == 'weekly':
+        return Recurrence('weekly', weekdays=(start.weekday(),))
+    if name == 'biweekly':
+        return Recurrence('weekly', interval=2, weekdays=(start.weekday(),))
+    if name == 'monthly':
+        return Recurrence('monthly', monthday=start.day)
+    if name == 'monthlast':
+        return Recurrence('monthly', monthday=-1)
+    if name == 'monthweekday':
+        setpos = (start.day - 1) // 7 + 1
+        return Recurrence('monthly', weekdays=(start.weekday(),), setpos=setpos if setpos <= 4 else -1)
+    return None
@@ -0,0 +1,284 @@
+"""
+Reminder scheduling queues
+
+Pending reminders are kept in a queue ordered by due time, so the scheduler
+task can sleep until the earliest one is due instead of polling every user.
+Due reminders are popped oldest first, in batches if a limit is given, so a
+backlog left by downtime drains in due order.
+Two engines share one interface:
+
+  ReminderQueue - a binary heap, O(log n) inserts
+  TimingWheel   - a hierarchical timing wheel, O(1) inserts and cancels
+"""
+
+import asyncio
+import heapq
+import math
+import time
+
+
+class _ReminderScheduler:
+    """Bookkeeping and the waiting loop shared by both engines"""
+
+    # Longest single sleep, so wall clock changes are noticed eventually
+    MAX_SLEEP = 60.0
+
+    def __init__(self):
+        # (user_id, reminder_id) -> due timestamp of the live entry
+        self._due = {}
+        # user_id -> reminder ids with a live entry
+        self._by_user = {}
+        self._wakeup = asyncio.Event()
+        # When the waiter is due to wake up on its own
+        self._sleep_until = None
+
+    def __len__(self):
+        return len(self._due)
+
+    def __contains__(self, key):
+        return key in self._due
+
+    def count_due(self, now_ts):
+        """How many reminders are due at now_ts"""
+        return sum(1 for due_ts in self._due.values() if due_ts <= now_ts)
+
+    def replace_user(self, user_id, due_times):
+        """Make the queue hold exactly `due_times` (reminder_id -> timestamp) for one user"""
+        user_id = str(user_id)
+        for reminder_id in self._by_user.get(user_id, set()) - set(due_times):
+            self.cancel(user_id, reminder_id)
+        for reminder_id, due_ts in due_times.items():
+            self.schedule(user_id, reminder_id, due_ts)
+
+    async def wait_due(self, limit=None):
+        """Sleep until at least one reminder is due, then pop up to `limit` of them, oldest first"""
+        while True:
+            now = time.time()
+            due = self.pop_due(now, limit)
+            if due:
+                return due
+            head = self.next_due()
+            timeout = self.MAX_SLEEP if head is None else min(max(head - now, 0), self.MAX_SLEEP)
+            self._sleep_until = now + timeout
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self._sleep_until = None
+
+    def _remember(self, key, due_ts):
+        self._due[key] = due_ts
+        self._by_user.setdefault(key[0], set()).add(key[1])
+        # Wake the waiter if it would otherwise oversleep this reminder
+        if self._sleep_until is not None and due_ts < self._sleep_until:
+            self._wakeup.set()
+
+    def _forget(self, key):
+        del self._due[key]
+        reminders = self._by_user.get(key[0])
+        if reminders is not None:
+            reminders.discard(key[1])
+            if not reminders:
+                del self._by_user[key[0]]
+
+
+class ReminderQueue(_ReminderScheduler):
+    """
+    Min-heap of (due timestamp, (user_id, reminder_id)).
+
+    Each reminder has at most one live entry. Rescheduling pushes a new heap
+    entry and cancelling only forgets the reminder; superseded entries are
+    skipped when they reach the head and purged when they pile up.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._heap = []
+
+    def schedule(self, user_id, reminder_id, due_ts):
+        """Add or move a reminder; wakes the scheduler if it becomes the head"""
+        key = (str(user_id), str(reminder_id))
+        if self._due.get(key) == due_ts:
+            return
+        self._remember(key, due_ts)
+        heapq.heappush(self._heap, (due_ts, key))
+        if len(self._heap) > 2 * len(self._due) + 64:
+            self._purge()
+
+    def cancel(self, user_id, reminder_id):
+        key = (str(user_id), str(reminder_id))
+        if key in self._due:
+            self._forget(key)
+
+    def next_due(self):
+        """Due timestamp of the earliest reminder, or None when the queue is empty"""
+        self._drop_stale_head()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now_ts, limit=None):
+        """Remove and return (user_id, reminder_id) of up to `limit` reminders due at now_ts, oldest first"""
+        due = []
+        while limit is None or len(due) < limit:
+            self._drop_stale_head()
+            if not self._heap or self._heap[0][0] > now_ts:
+                break
+            _, key = heapq.heappop(self._heap)
+            self._forget(key)
+            due.append(key)
+        return due
+
+    def _drop_stale_head(self):
+        while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def _purge(self):
+        self._heap = [(due_ts, key) for due_ts, key in self._heap if self._due.get(key) == due_ts]
+        heapq.heapify(self._heap)
+
+
+class TimingWheel(_ReminderScheduler):
+    """
+    Hierarchical timing wheel with second, minute, hour and day slots.
+
+    A reminder goes into the finest wheel whose range covers its due second
+    and moves down a wheel each time the clock reaches its slot, so inserts
+    and cancels are O(1) dict operations however many reminders are queued.
+    Reminders beyond the day wheel wait in an overflow set that is revisited
+    once a day; reminders already due go straight to the ready set.
+    """
+
+    # (seconds per slot, slots) from the finest wheel up
+    WHEELS = ((1, 60), (60, 60), (3600, 24), (86400, 30))
+
+    def __init__(self, now_ts=None):
+        super().__init__()
+        # Every second before _tick has been processed
+        self._tick = math.floor(time.time() if now_ts is None else now_ts)
+        self._slots = [[{} for _ in range(size)] for _, size in self.WHEELS]
+        self._counts = [0] * len(self.WHEELS)
+        self._ready = {}
+        self._overflow = {}
+        # key -> (level, slot), "ready" or "overflow"
+        self._where = {}
+
+    def schedule(self, user_id, reminder_id, due_ts):
+        """Add or move a reminder"""
+        key = (str(user_id), str(reminder_id))
+        if self._due.get(key) == due_ts:
+            return
+        if key in self._due:
+            self._unplace(key)
+        self._remember(key, due_ts)
+        self._place(key, due_ts)
+
+    def cancel(self, user_id, reminder_id):
+        key = (str(user_id), str(reminder_id))
+        if key in self._due:
+            self._unplace(key)
+            self._forget(key)
+
+    def next_due(self):
+        """
+        When the wheel next needs attention: the earliest due second in the
+        second wheel, or the start of the earliest occupied coarser slot,
+        which is when its reminders move down. None when the wheel is empty.
+        """
+        if self._ready:
+            return min(self._ready.values())
+        candidates = []
+        for level, (resolution, size) in enumerate(self.WHEELS):
+            if not self._counts[level]:
+                continue
+            # Slot indexes are absolute, so scan forward from the current one
+            first = self._tick // resolution
+            for index in range(first, first + size):
+                if self._slots[level][index % size]:
+                    candidates.append(index * resolution)
+                    break
+        if self._overflow:
+            day = self.WHEELS[-1][0]
+            candidates.append((self._tick // day + 1) * day)
+        return max(min(candidates), self._tick) if candidates else None
+
+    def pop_due(self, now_ts, limit=None):
+        """Advance the wheel to now_ts and return up to `limit` due reminders, oldest first"""
+        target = math.floor(now_ts)
+        while self._tick <= target:
+            step = self._skip()
+            if step:
+                self._tick = min(self._tick + step, target + 1)
+                continue
+            self._cascade(self._tick)
+            slot = self._slots[0][self._tick % self.WHEELS[0][1]]
+            if slot:
+                self._counts[0] -= len(slot)
+                for key in slot:
+                    self._where[key] = 'ready'
+                self._ready.update(slot)
+                slot.clear()
+            self._tick += 1
+        # Many reminders are ready at once only while catching up after downtime
+        due = sorted(self._ready, key=self._ready.get)[:limit]
+        for key in due:
+            del self._ready[key]
+            del self._where[key]
+            self._forget(key)
+        return due
+
+    def _skip(self):
+        """Seconds that can be skipped from _tick without anything happening"""
+        for level, (resolution, _) in enumerate(self.WHEELS):
+            if self._counts[level]:
+                return -self._tick % resolution if level else 0
+        # Only the overflow set is left, it's revisited at the next day boundary
+        if self._overflow:
+            return -self._tick % self.WHEELS[-1][0]
+        return math.inf
+
+    def _cascade(self, tick):
+        """Move reminders whose coarse slot starts at `tick` down to finer wheels"""
+        day = self.WHEELS[-1][0]
+        if tick % day == 0 and self._overflow:
+            overflow, self._overflow = self._overflow, {}
+            for key, due_ts in overflow.items():
+                self._place(key, due_ts)
+        for level in range(len(self.WHEELS) - 1, 0, -1):
+            resolution, size = self.WHEELS[level]
+            if tick % resolution or not self._counts[level]:
+                continue
+            slot = self._slots[level][tick // resolution % size]
+            if slot:
+                self._counts[level] -= len(slot)
+                moved = dict(slot)
+                slot.clear()
+                for key, due_ts in moved.items():
+                    self._place(key, due_ts)
+
+    def _place(self, key, due_ts):
+        tick = math.ceil(due_ts)
+        if tick < self._tick:
+            self._ready[key] = due_ts
+            self._where[key] = 'ready'
+            return
+        for level, (resolution, size) in enumerate(self.WHEELS):
+            if tick // resolution - self._tick // resolution < size:
+                slot = tick // resolution % size
+                self._slots[level][slot][key] = due_ts
+                self._counts[level] += 1
+                self._where[key] = (level, slot)
+                return
+        self._overflow[key] = due_ts
+        self._where[key] = 'overflow'
+
+    def _unplace(self, key):
+        where = self._where.pop(key)
+        if where == 'ready':
+            del self._ready[key]
+        elif where == 'overflow':
+            del self._overflow[key]
+        else:
+            level, slot = where
+            del self._slots[level][slot][key]
+            self._counts[level] -= 1
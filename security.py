@@ -1,6 +1,10 @@
 import base64
+import hashlib
 import os
 import secrets
+import threading
+import time
+from collections import OrderedDict
 from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
@@ -95,6 +99,88 @@ def decrypt_data(encrypted_data: str) -> str:
         # Return a special marker to indicate decryption failure
         return "__DECRYPTION_FAILED__"
 
+class CredentialCache:
+    """
+    Small in-memory cache of decrypted credentials
+
+    Entries are keyed by user id and a digest of the ciphertext, so a changed
+    key never hits a stale entry. Each entry expires after `ttl` seconds and
+    the least recently used entries are dropped beyond `max_size`, so
+    plaintext secrets don't stay in process memory indefinitely.
+    """
+
+    def __init__(self, ttl=300, max_size=256):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id, encrypted_data: str) -> str:
+        """
+        Return the decrypted value, decrypting on a miss
+
+        Failed decryptions are returned as "__DECRYPTION_FAILED__" and are
+        not cached.
+        """
+        if not encrypted_data:
+            return ""
+        key = (str(user_id), hashlib.sha256(encrypted_data.encode()).hexdigest())
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    return value
+                del self._entries[key]
+
+        value = decrypt_data(encrypted_data)
+        if value == "__DECRYPTION_FAILED__":
+            return value
+
+        with self._lock:
+            self._entries[key] = (value, now + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, user_id=None):
+        """Drop cached values for one user, or for everyone when user_id is None"""
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+                return
+            for key in [key for key in self._entries if key[0] == str(user_id)]:
+                del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+# Shared cache for decrypted exchange credentials
+credential_cache = CredentialCache(
+    ttl=float(os.getenv("CREDENTIAL_CACHE_TTL", "300")),
+    max_size=int(os.getenv("CREDENTIAL_CACHE_SIZE", "256"))
+)
+
+def decrypt_cached(user_id, encrypted_data: str) -> str:
+    """
+    Decrypt a user's credential through the shared credential cache
+
+    Args:
+        user_id: Owner of the credential
+        encrypted_data (str): Base64 encoded encrypted data
+
+    Returns:
+        str: Decrypted data
+    """
+    return credential_cache.get(user_id, encrypted_data)
+
+def invalidate_credentials(user_id=None):
+    """Forget cached credentials after a user's keys change"""
+    credential_cache.invalidate(user_id)
+
 def generate_secure_key():
     """
     Generate a cryptographically secure random key for production use
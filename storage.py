@@ -0,0 +1,1041 @@
+"""
+In-memory user data repository with write-behind persistence
+"""
+
+import asyncio
+import copy
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import weakref
+import zlib
+from collections.abc import MutableMapping
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+try:
+    import portalocker
+except ImportError:
+    portalocker = None
+
+logger = logging.getLogger(__name__)
+
+
+def _write_text_atomic(path, text):
+    """Write text to path through a locked temporary file and an atomic rename"""
+    temp_file = path + ".tmp"
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        if portalocker is not None:
+            portalocker.lock(f, portalocker.LOCK_EX)
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+        if portalocker is not None:
+            portalocker.unlock(f)
+    os.replace(temp_file, path)
+
+
+def _write_json_atomic(path, data):
+    """Write data to path as indented JSON, atomically"""
+    _write_text_atomic(path, json.dumps(data, indent=2, ensure_ascii=False))
+
+
+def _dump_user_fragment(record):
+    """Serialize one user the way json.dump(indent=2) nests it in the file"""
+    # JSON strings never contain raw newlines, so re-indenting is safe
+    return json.dumps(record, indent=2, ensure_ascii=False).replace('\n', '\n  ')
+
+
+def _join_user_fragments(fragments):
+    """Assemble serialized users into the text of a top-level JSON object"""
+    if not fragments:
+        return '{}'
+    body = ',\n'.join(
+        f"  {json.dumps(user_id, ensure_ascii=False)}: {fragment}"
+        for user_id, fragment in fragments.items()
+    )
+    return '{\n' + body + '\n}'
+
+
+class JsonFileBackend:
+    """Keeps every user in one JSON file (the original user_data.json layout)"""
+
+    def __init__(self, path):
+        self.path = path
+        # Serialized form of every user as it appears in the file, so a save
+        # re-serializes only the users that actually changed
+        self._fragments = {}
+
+    def load_all(self):
+        if not os.path.exists(self.path):
+            self._fragments = {}
+            return {}
+        with open(self.path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        self._fragments = {user_id: _dump_user_fragment(record) for user_id, record in data.items()}
+        return data
+
+    def save(self, changes):
+        for user_id, record in changes.items():
+            self._fragments[user_id] = _dump_user_fragment(record)
+        _write_text_atomic(self.path, _join_user_fragments(self._fragments))
+
+
+class ShardedJsonBackend:
+    """
+    Keeps users in many small JSON files under one directory.
+
+    With shard_count == 0 every user gets its own file, otherwise users are
+    spread over shard_count hash buckets. A save rewrites only the files
+    that contain changed users.
+    """
+
+    def __init__(self, directory, shard_count=0):
+        self.directory = directory
+        self.shard_count = shard_count
+        # shard file name -> {user_id: persisted record}
+        self._shards = {}
+
+    def shard_name(self, user_id):
+        user_id = str(user_id)
+        if self.shard_count:
+            return f"shard_{zlib.crc32(user_id.encode()) % self.shard_count:04d}.json"
+        if user_id.isalnum():
+            return f"user_{user_id}.json"
+        # Keep odd ids out of the file system namespace
+        return f"user_x{zlib.crc32(user_id.encode()):08x}.json"
+
+    def load_all(self):
+        self._shards = {}
+        data = {}
+        if not os.path.isdir(self.directory):
+            return data
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith('.json'):
+                continue
+            with open(os.path.join(self.directory, name), 'r', encoding='utf-8') as f:
+                shard = json.load(f)
+            self._shards[name] = shard
+            data.update(copy.deepcopy(shard))
+        return data
+
+    def save(self, changes):
+        os.makedirs(self.directory, exist_ok=True)
+        touched = set()
+        for user_id, record in changes.items():
+            name = self.shard_name(user_id)
+            self._shards.setdefault(name, {})[user_id] = record
+            touched.add(name)
+        for name in touched:
+            _write_json_atomic(os.path.join(self.directory, name), self._shards[name])
+
+
+def migrate_json_to_shards(source_path, directory, shard_count=0):
+    """One-shot copy of a monolithic user_data.json into a sharded directory"""
+    with open(source_path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    backend = ShardedJsonBackend(directory, shard_count)
+    # Merge into whatever is already there instead of clobbering shared buckets
+    backend.load_all()
+    backend.save(data)
+    return len(data)
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    bybit_api_key TEXT,
+    bybit_api_secret TEXT,
+    extra TEXT NOT NULL DEFAULT '{}'
+);
+CREATE TABLE IF NOT EXISTS piggy_banks (
+    user_id TEXT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    current,
+    target,
+    extra TEXT NOT NULL DEFAULT '{}',
+    PRIMARY KEY (user_id, name)
+);
+CREATE TABLE IF NOT EXISTS shopping_categories (
+    user_id TEXT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+    category TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (user_id, category)
+);
+CREATE TABLE IF NOT EXISTS shopping_items (
+    id INTEGER PRIMARY KEY,
+    user_id TEXT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+    category TEXT NOT NULL,
+    item TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_shopping_items_user_category ON shopping_items(user_id, category);
+CREATE TABLE IF NOT EXISTS notes (
+    id INTEGER PRIMARY KEY,
+    user_id TEXT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+    note_id TEXT NOT NULL,
+    title TEXT,
+    content TEXT,
+    extra TEXT NOT NULL DEFAULT '{}',
+    UNIQUE (user_id, note_id)
+);
+CREATE INDEX IF NOT EXISTS idx_notes_user ON notes(user_id);
+CREATE TABLE IF NOT EXISTS reminders (
+    id INTEGER PRIMARY KEY,
+    user_id TEXT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+    reminder_id TEXT NOT NULL,
+    title TEXT,
+    content TEXT,
+    repeat TEXT,
+    scheduled_at TEXT,
+    scheduled_ts REAL NOT NULL DEFAULT 0,
+    sent INTEGER NOT NULL DEFAULT 0,
+    extra TEXT NOT NULL DEFAULT '{}',
+    UNIQUE (user_id, reminder_id)
+);
+CREATE INDEX IF NOT EXISTS idx_reminders_due ON reminders(sent, scheduled_ts);
+CREATE INDEX IF NOT EXISTS idx_reminders_user ON reminders(user_id);
+CREATE TABLE IF NOT EXISTS user_changes (
+    user_id TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_user_changes_seq ON user_changes(seq);
+"""
+
+
+def _split_fields(record, columns):
+    """Split a dict into the values of known columns and a JSON blob of the rest"""
+    values = [record.get(column) for column in columns]
+    extra = {key: value for key, value in record.items() if key not in columns}
+    return values, json.dumps(extra, ensure_ascii=False)
+
+
+def _join_fields(columns, values, extra):
+    record = {column: value for column, value in zip(columns, values) if value is not None}
+    record.update(json.loads(extra))
+    return record
+
+
+def _reminder_timestamp(reminder):
+    """Epoch seconds of the due time for the scheduled_ts column, 0 when it is unknown"""
+    if reminder.get('scheduled_ts') is not None:
+        return reminder['scheduled_ts']
+    try:
+        return datetime.fromisoformat(reminder['scheduled_at']).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return 0
+
+
+class SqliteBackend:
+    """
+    Keeps users in an SQLite database (WAL mode) with one table per kind of
+    record; reminders are indexed by sent flag and due time.
+
+    A save compares each user with the rows last written for it and only
+    inserts, updates or deletes the piggy banks, notes, reminders and
+    shopping categories that changed; adding one shopping item rewrites the
+    items of that category and nothing else.
+
+    Several processes can share one database. Every save stamps the users it
+    wrote with the next change number, and poll_changes() tells a process
+    which users the others saved since it last looked, so it can reload just
+    those with load_users().
+    """
+
+    USER_COLUMNS = ('bybit_api_key', 'bybit_api_secret')
+    COLLECTIONS = ('piggy_banks', 'shopping_list', 'notes', 'reminders')
+    PIGGY_COLUMNS = ('current', 'target')
+    NOTE_COLUMNS = ('title', 'content')
+    REMINDER_COLUMNS = ('title', 'content', 'repeat', 'scheduled_at')
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # A commit() is acknowledged as durable, so each transaction is fsynced
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        self._conn.executescript(SQLITE_SCHEMA)
+        # user_id -> rows as last written (see _rows), so a save touches only
+        # the rows that changed
+        self._written = {}
+        # Rows of records from load_users() that haven't been adopted yet
+        self._loaded = {}
+        # Highest change number seen, and the number of this process's last
+        # save of each user
+        self._seen_seq = 0
+        self._stamped = {}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _select(self, sql, user_ids, order):
+        if user_ids is None:
+            return self._conn.execute(f"{sql} ORDER BY {order}")
+        marks = ', '.join('?' * len(user_ids))
+        return self._conn.execute(f"{sql} WHERE user_id IN ({marks}) ORDER BY {order}", list(user_ids))
+
+    def _load(self, user_ids=None):
+        """Records of the given users (all of them for None), read in one snapshot"""
+        data = {}
+        for user_id, api_key, api_secret, extra in self._select(
+                "SELECT user_id, bybit_api_key, bybit_api_secret, extra FROM users", user_ids, "rowid"):
+            record = _join_fields(self.USER_COLUMNS, (api_key, api_secret), extra)
+            record.update({'piggy_banks': {}, 'shopping_list': {}, 'notes': {}, 'reminders': {}})
+            data[user_id] = record
+        for user_id, name, current, target, extra in self._select(
+                "SELECT user_id, name, current, target, extra FROM piggy_banks", user_ids, "rowid"):
+            data[user_id]['piggy_banks'][name] = _join_fields(self.PIGGY_COLUMNS, (current, target), extra)
+        for user_id, category in self._select(
+                "SELECT user_id, category FROM shopping_categories", user_ids, "user_id, position"):
+            data[user_id]['shopping_list'][category] = []
+        for user_id, category, item in self._select(
+                "SELECT user_id, category, item FROM shopping_items", user_ids, "id"):
+            data[user_id]['shopping_list'].setdefault(category, []).append(item)
+        for user_id, note_id, title, content, extra in self._select(
+                "SELECT user_id, note_id, title, content, extra FROM notes", user_ids, "id"):
+            data[user_id]['notes'][note_id] = _join_fields(self.NOTE_COLUMNS, (title, content), extra)
+        for row in self._select(
+                "SELECT user_id, reminder_id, title, content, repeat, scheduled_at, sent, extra FROM reminders",
+                user_ids, "id"):
+            reminder = _join_fields(self.REMINDER_COLUMNS, row[2:6], row[7])
+            reminder['sent'] = bool(row[6])
+            data[row[0]]['reminders'][row[1]] = reminder
+        return data
+
+    def load_all(self):
+        with self._lock:
+            # One read transaction, so the change number matches the data
+            self._conn.execute("BEGIN")
+            try:
+                self._seen_seq = self._conn.execute("SELECT COALESCE(MAX(seq), 0) FROM user_changes").fetchone()[0]
+                data = self._load()
+            finally:
+                self._conn.execute("COMMIT")
+            self._written = {user_id: self._rows(record) for user_id, record in data.items()}
+            self._loaded = {}
+            return data
+
+    def load_users(self, user_ids):
+        """
+        Records of some users as they are now in the database; unknown users
+        are left out. Saves are diffed against the records they replace
+        until adopt() says they are in use.
+        """
+        user_ids = list(user_ids)
+        data = {}
+        with self._lock:
+            # Stay well below SQLite's limit on query parameters
+            for start in range(0, len(user_ids), 500):
+                self._conn.execute("BEGIN")
+                try:
+                    data.update(self._load(user_ids[start:start + 500]))
+                finally:
+                    self._conn.execute("COMMIT")
+            self._loaded.update((user_id, self._rows(record)) for user_id, record in data.items())
+        return data
+
+    def adopt(self, user_ids):
+        """The records load_users() returned for these users replaced the old ones"""
+        with self._lock:
+            for user_id in user_ids:
+                if user_id in self._loaded:
+                    self._written[user_id] = self._loaded.pop(user_id)
+
+    def _unseen_changes(self, user_ids):
+        unseen = set()
+        for start in range(0, len(user_ids), 500):
+            chunk = user_ids[start:start + 500]
+            marks = ', '.join('?' * len(chunk))
+            for user_id, seq in self._conn.execute(
+                    f"SELECT user_id, seq FROM user_changes WHERE user_id IN ({marks}) AND seq > ?",
+                    (*chunk, self._seen_seq)):
+                if self._stamped.get(user_id) != seq:
+                    unseen.add(user_id)
+        return unseen
+
+    def poll_changes(self):
+        """Users that other processes saved since the last load_all() or poll_changes()"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT user_id, seq FROM user_changes WHERE seq > ?", (self._seen_seq,)).fetchall()
+        changed = []
+        for user_id, seq in rows:
+            self._seen_seq = max(self._seen_seq, seq)
+            if self._stamped.get(user_id) != seq:
+                changed.append(user_id)
+        return changed
+
+    def _rows(self, record):
+        """Row values of one user per table, keyed the way the rows are addressed"""
+        user_values, user_extra = _split_fields(
+            {key: value for key, value in record.items() if key not in self.COLLECTIONS},
+            self.USER_COLUMNS
+        )
+        rows = {
+            'users': {None: (*user_values, user_extra)},
+            'piggy_banks': {},
+            'shopping_categories': {},
+            'shopping_items': {},
+            'notes': {},
+            'reminders': {},
+        }
+        for name, piggy in record.get('piggy_banks', {}).items():
+            values, extra = _split_fields(piggy, self.PIGGY_COLUMNS)
+            rows['piggy_banks'][name] = (*values, extra)
+        for position, (category, items) in enumerate(record.get('shopping_list', {}).items()):
+            rows['shopping_categories'][category] = (position,)
+            # Items have no key of their own; a category's items are rewritten together
+            rows['shopping_items'][category] = tuple(items)
+        for note_id, note in record.get('notes', {}).items():
+            values, extra = _split_fields(note, self.NOTE_COLUMNS)
+            rows['notes'][note_id] = (*values, extra)
+        for reminder_id, reminder in record.get('reminders', {}).items():
+            values, extra = _split_fields(
+                {key: value for key, value in reminder.items() if key != 'sent'},
+                self.REMINDER_COLUMNS
+            )
+            rows['reminders'][reminder_id] = (
+                *values, _reminder_timestamp(reminder), int(bool(reminder.get('sent', False))), extra)
+        return rows
+
+    def _save_user(self, user_id, rows):
+        """Write only the rows of a user that differ from what was last written; returns whether any did"""
+        conn = self._conn
+        old = self._written.get(user_id)
+        if old == rows:
+            return False
+        if old is None:
+            # Not loaded by this backend: whatever is stored is replaced
+            for table in ('piggy_banks', 'shopping_categories', 'shopping_items', 'notes', 'reminders'):
+                conn.execute(f"DELETE FROM {table} WHERE user_id = ?", (user_id,))
+            old = {table: {} for table in rows}
+        if rows['users'] != old.get('users'):
+            conn.execute(
+                "INSERT INTO users (user_id, bybit_api_key, bybit_api_secret, extra) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET bybit_api_key = excluded.bybit_api_key, "
+                "bybit_api_secret = excluded.bybit_api_secret, extra = excluded.extra",
+                (user_id, *rows['users'][None])
+            )
+
+        def changed(table):
+            removed = [key for key in old[table] if key not in rows[table]]
+            updated = [(key, row) for key, row in rows[table].items() if old[table].get(key) != row]
+            return removed, updated
+
+        removed, updated = changed('piggy_banks')
+        conn.executemany("DELETE FROM piggy_banks WHERE user_id = ? AND name = ?",
+                         [(user_id, name) for name in removed])
+        conn.executemany(
+            "INSERT INTO piggy_banks VALUES (?, ?, ?, ?, ?) ON CONFLICT(user_id, name) DO UPDATE SET "
+            "current = excluded.current, target = excluded.target, extra = excluded.extra",
+            [(user_id, name, *row) for name, row in updated]
+        )
+        removed, updated = changed('shopping_categories')
+        conn.executemany("DELETE FROM shopping_categories WHERE user_id = ? AND category = ?",
+                         [(user_id, category) for category in removed])
+        conn.executemany(
+            "INSERT INTO shopping_categories VALUES (?, ?, ?) ON CONFLICT(user_id, category) DO UPDATE SET "
+            "position = excluded.position",
+            [(user_id, category, *row) for category, row in updated]
+        )
+        removed, updated = changed('shopping_items')
+        conn.executemany("DELETE FROM shopping_items WHERE user_id = ? AND category = ?",
+                         [(user_id, category) for category in removed + [category for category, _ in updated]])
+        conn.executemany(
+            "INSERT INTO shopping_items (user_id, category, item) VALUES (?, ?, ?)",
+            [(user_id, category, item) for category, items in updated for item in items]
+        )
+        removed, updated = changed('notes')
+        conn.executemany("DELETE FROM notes WHERE user_id = ? AND note_id = ?",
+                         [(user_id, note_id) for note_id in removed])
+        conn.executemany(
+            "INSERT INTO notes (user_id, note_id, title, content, extra) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(user_id, note_id) DO UPDATE SET title = excluded.title, content = excluded.content, "
+            "extra = excluded.extra",
+            [(user_id, note_id, *row) for note_id, row in updated]
+        )
+        removed, updated = changed('reminders')
+        conn.executemany("DELETE FROM reminders WHERE user_id = ? AND reminder_id = ?",
+                         [(user_id, reminder_id) for reminder_id in removed])
+        conn.executemany(
+            "INSERT INTO reminders (user_id, reminder_id, title, content, repeat, scheduled_at, "
+            "scheduled_ts, sent, extra) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(user_id, reminder_id) DO UPDATE SET title = excluded.title, "
+            "content = excluded.content, repeat = excluded.repeat, scheduled_at = excluded.scheduled_at, "
+            "scheduled_ts = excluded.scheduled_ts, sent = excluded.sent, extra = excluded.extra",
+            [(user_id, reminder_id, *row) for reminder_id, row in updated]
+        )
+        return True
+
+    def save(self, changes):
+        rows = {user_id: self._rows(record) for user_id, record in changes.items()}
+        with self._lock:
+            with self._conn:
+                # Take the write lock up front, so change numbers follow commit order
+                self._conn.execute("BEGIN IMMEDIATE")
+                changed = [user_id for user_id, user_rows in rows.items() if self._save_user(user_id, user_rows)]
+                # Users another process saved since the last poll still have
+                # to be reloaded here, even though this save is the latest
+                unseen = self._unseen_changes(changed)
+                seq = self._conn.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM user_changes").fetchone()[0]
+                self._conn.executemany(
+                    "INSERT INTO user_changes (user_id, seq) VALUES (?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET seq = excluded.seq",
+                    [(user_id, seq) for user_id in changed]
+                )
+            # Only once the transaction is in
+            self._written.update(rows)
+            self._stamped.update((user_id, seq) for user_id in changed if user_id not in unseen)
+            for user_id in unseen:
+                self._stamped.pop(user_id, None)
+
+
+def migrate_json_to_sqlite(source_path, db_path):
+    """One-shot copy of a monolithic user_data.json into an SQLite database"""
+    with open(source_path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    backend = SqliteBackend(db_path)
+    try:
+        backend.save(data)
+    finally:
+        backend.close()
+    return len(data)
+
+
+def _diff_ops(old, new, path=()):
+    """Minimal list of set/del operations that turn old into new"""
+    if not (isinstance(old, dict) and isinstance(new, dict)):
+        return [] if old == new else [['set', list(path), new]]
+    ops = [['del', [*path, key]] for key in old if key not in new]
+    for key, value in new.items():
+        if key not in old:
+            ops.append(['set', [*path, key], value])
+        elif old[key] != value:
+            ops.extend(_diff_ops(old[key], value, (*path, key)))
+    return ops
+
+
+def _apply_ops(record, ops):
+    """Apply operations produced by _diff_ops; returns the (possibly new) record"""
+    for op, path, *value in ops:
+        if not path:
+            record = value[0] if op == 'set' else None
+            continue
+        target = record
+        for key in path[:-1]:
+            target = target.setdefault(key, {})
+        if op == 'set':
+            target[path[-1]] = value[0]
+        else:
+            target.pop(path[-1], None)
+    return record
+
+
+class JournalBackend:
+    """
+    Keeps users in a JSON snapshot plus an append-only journal of changes.
+
+    A save appends one line per changed user with just the fields that
+    changed, e.g. ["set", ["piggy_banks", "Отпуск", "current"], 500].
+    compact() folds the journal into a new snapshot; loading replays the
+    snapshot and then the journal tail.
+    """
+
+    def __init__(self, snapshot_path, journal_path):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self._records = {}
+        self._journal_entries = 0
+
+    def load_all(self):
+        data = {}
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        self._journal_entries = 0
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'rb+') as f:
+                good_end = 0
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A torn last line from a crash mid-append; cut it off
+                        # so the next append starts on a clean line
+                        logger.warning(f"Dropping unreadable journal tail in {self.journal_path}")
+                        f.truncate(good_end)
+                        break
+                    good_end += len(line)
+                    record = _apply_ops(data.get(entry['user_id']), entry['ops'])
+                    if record is None:
+                        data.pop(entry['user_id'], None)
+                    else:
+                        data[entry['user_id']] = record
+                    self._journal_entries += 1
+        self._records = copy.deepcopy(data)
+        return data
+
+    def save(self, changes):
+        lines = []
+        for user_id, record in changes.items():
+            old = self._records.get(user_id)
+            ops = [['set', [], record]] if old is None else _diff_ops(old, record)
+            if ops:
+                lines.append(json.dumps({'user_id': user_id, 'ops': ops}, ensure_ascii=False) + '\n')
+        if lines:
+            with open(self.journal_path, 'a', encoding='utf-8') as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            self._journal_entries += len(lines)
+        # Only once the changes are durable, so a failed append is diffed
+        # against what the journal really holds when it is retried
+        self._records.update(changes)
+
+    def compact(self):
+        """Write a fresh snapshot and truncate the journal"""
+        if not self._journal_entries:
+            return
+        _write_json_atomic(self.snapshot_path, self._records)
+        # Replaying the old journal over the new snapshot is harmless, so a
+        # crash between these two steps loses nothing
+        with open(self.journal_path, 'w', encoding='utf-8'):
+            pass
+        logger.info(f"Compacted {self._journal_entries} journal entries into {self.snapshot_path}")
+        self._journal_entries = 0
+
+
+class UserLock:
+    """
+    Per-user asyncio lock that the task holding it may acquire again, so a
+    handler running under the lock can call helpers that take it too.
+    """
+
+    def __init__(self):
+        self._lock = asyncio.Lock()
+        self._owner = None
+        self._depth = 0
+
+    async def __aenter__(self):
+        task = asyncio.current_task()
+        if self._owner is not task:
+            await self._lock.acquire()
+            self._owner = task
+        self._depth += 1
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._depth -= 1
+        if not self._depth:
+            self._owner = None
+            self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+
+class UserDataStore:
+    """
+    Process-wide user data repository.
+
+    Users are loaded once and then served from memory. commit() group-commits
+    changes and returns once they are durable; users only marked dirty are
+    persisted by the flusher on an interval, and flush() is called once
+    more at shutdown. With a shared backend, refresh() reloads the users
+    that other processes saved in the meantime.
+    """
+
+    def __init__(self, backend, flush_interval=5.0, commit_window=0.1, new_record=dict):
+        self.backend = backend
+        # Factory for the record of a user seen for the first time
+        self.new_record = new_record
+        self.flush_interval = flush_interval
+        # commit() calls arriving within this many seconds share one write
+        self.commit_window = commit_window
+        self._data = None
+        self._dirty = set()
+        self._seq = 0
+        self._written_seq = {}
+        self._write_lock = threading.Lock()
+        self._loading = None
+        # user_id -> UserLock, dropped once nobody holds or waits for it
+        self._locks = weakref.WeakValueDictionary()
+        # Called with the user_id (None for everyone) whenever data changes
+        self._listeners = []
+        # Users changed by another process that still have to be reloaded
+        self._stale = set()
+        # Future of the group commit that new commit() calls join
+        self._batch = None
+        self._batch_task = None
+        # Writes from the loop run one at a time, so a finished write really
+        # covers everything that was dirty when it started
+        self._flush_lock = asyncio.Lock()
+
+    @property
+    def data(self):
+        """Live mapping of user_id -> user record"""
+        if self._data is None:
+            self.load()
+        return self._data
+
+    def _install(self, data):
+        self._data = data
+        self._dirty.clear()
+        logger.info(f"Loaded {len(data)} users from {type(self.backend).__name__}")
+        return data
+
+    def load(self):
+        return self._install(self.backend.load_all())
+
+    @property
+    def shared(self):
+        """Whether several processes can use the backend at once (it writes users one by one)"""
+        return hasattr(self.backend, 'poll_changes')
+
+    async def reload(self, user_ids):
+        """
+        Re-read users that another process may have changed; shared backends
+        only. A user with changes that aren't written yet, or whose lock is
+        held, keeps its record here and is tried again by the next
+        refresh(). Returns the reloaded user_ids.
+        """
+        loop = asyncio.get_running_loop()
+        data = await self.get_all()
+        # No write runs meanwhile, so nothing read can be older than what is in memory
+        async with self._flush_lock:
+            records = await loop.run_in_executor(None, self.backend.load_users, list(user_ids))
+            reloaded = []
+            for user_id, record in records.items():
+                lock = self._locks.get(user_id)
+                if user_id in self._dirty or (lock is not None and lock.locked()):
+                    self._stale.add(user_id)
+                    continue
+                data[user_id] = record
+                self._stale.discard(user_id)
+                reloaded.append(user_id)
+            self.backend.adopt(reloaded)
+        for user_id in reloaded:
+            for callback in self._listeners:
+                try:
+                    callback(user_id)
+                except Exception as e:
+                    logger.error(f"Error in user data listener: {e}")
+        return reloaded
+
+    async def refresh(self):
+        """Reload the users other processes saved since the last load or refresh"""
+        if not self.shared:
+            return []
+        await self.get_all()
+        changed = await asyncio.get_running_loop().run_in_executor(None, self.backend.poll_changes)
+        changed = self._stale.union(changed)
+        return await self.reload(changed) if changed else []
+
+    async def load_async(self):
+        """Load every user from an executor thread"""
+        if self._loading is None:
+            self._loading = asyncio.get_running_loop().run_in_executor(None, self.backend.load_all)
+        try:
+            data = await self._loading
+        finally:
+            self._loading = None
+        # Concurrent callers share one read; only the first installs it
+        if self._data is None:
+            self._install(data)
+        return self._data
+
+    async def get_all(self):
+        """Live mapping of user_id -> user record; never blocks the event loop"""
+        if self._data is None:
+            await self.load_async()
+        return self._data
+
+    async def get_user(self, user_id):
+        """Live record of one user, or None if the user is unknown"""
+        return (await self.get_all()).get(str(user_id))
+
+    async def commit(self, user_id=None):
+        """Record that a user (or every user) changed and wait until it is on disk"""
+        await self.get_all()
+        self.mark_dirty(user_id)
+        await self.sync()
+
+    async def sync(self):
+        """
+        Wait until every change marked so far is durable.
+
+        Callers arriving within commit_window seconds share one group
+        commit: a single backend write (and fsync) for all of them. Raises
+        if that write fails; the changes stay dirty and are retried.
+        """
+        if self._batch is None:
+            self._batch = asyncio.get_running_loop().create_future()
+            self._batch_task = asyncio.ensure_future(self._group_commit(self._batch))
+        await asyncio.shield(self._batch)
+
+    async def _group_commit(self, batch):
+        await asyncio.sleep(self.commit_window)
+        # Commits from now on go into the next batch
+        self._batch = None
+        try:
+            await self._persist()
+        except Exception as e:
+            logger.error(f"Error committing user data: {e}")
+            batch.set_exception(e)
+        else:
+            batch.set_result(None)
+
+    def lock(self, user_id):
+        """The user's lock; updates of different users never wait for each other"""
+        user_id = str(user_id)
+        lock = self._locks.get(user_id)
+        if lock is None:
+            lock = self._locks[user_id] = UserLock()
+        return lock
+
+    @asynccontextmanager
+    async def transaction(self, user_id):
+        """
+        Atomic read-modify-write of one user:
+
+            async with user_store.transaction(user_id) as user:
+                user.setdefault('notes', {})[note_id] = note
+
+        The user's lock is held for the whole block and the record (created
+        with new_record() for a new user) is committed when the block exits.
+        If the block raises, the record is put back the way it was (a user
+        created for the block is removed again) and nothing is written.
+        """
+        user_id = str(user_id)
+        async with self.lock(user_id):
+            data = await self.get_all()
+            original = copy.deepcopy(data[user_id]) if user_id in data else None
+            if original is None:
+                data[user_id] = self.new_record()
+            try:
+                yield data[user_id]
+            except BaseException:
+                if original is None:
+                    data.pop(user_id, None)
+                else:
+                    data[user_id] = original
+                raise
+            self.mark_dirty(user_id)
+            await self.sync()
+
+    def add_listener(self, callback):
+        """Call callback(user_id) after a user (or, with None, every user) changes"""
+        self._listeners.append(callback)
+
+    def mark_dirty(self, user_id=None):
+        """Schedule a user (or every user when user_id is None) for the next flush"""
+        if user_id is None:
+            self._dirty.update(self.data.keys())
+        else:
+            user_id = str(user_id)
+            self._dirty.add(user_id)
+        for callback in self._listeners:
+            try:
+                callback(user_id)
+            except Exception as e:
+                logger.error(f"Error in user data listener: {e}")
+
+    def _take_dirty(self):
+        """Copy the dirty users; must run on the thread that mutates the data"""
+        dirty, self._dirty = self._dirty, set()
+        self._seq += 1
+        changes = {}
+        for user_id in dirty:
+            if user_id in self.data:
+                changes[user_id] = copy.deepcopy(self.data[user_id])
+        return self._seq, changes
+
+    def _write(self, seq, changes):
+        with self._write_lock:
+            # A slower, older snapshot must never overwrite a newer one
+            changes = {
+                user_id: record for user_id, record in changes.items()
+                if self._written_seq.get(user_id, 0) < seq
+            }
+            if not changes:
+                return
+            self.backend.save(changes)
+            for user_id in changes:
+                self._written_seq[user_id] = seq
+
+    def flush(self):
+        """Synchronously persist all dirty users"""
+        seq, changes = self._take_dirty()
+        if not changes:
+            return
+        try:
+            self._write(seq, changes)
+        except Exception as e:
+            logger.error(f"Error flushing user data: {e}")
+            self._dirty.update(changes)
+
+    async def _persist(self):
+        """Write all dirty users from an executor thread; raises on failure"""
+        async with self._flush_lock:
+            seq, changes = self._take_dirty()
+            if not changes:
+                return
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self._write, seq, changes)
+            except Exception:
+                self._dirty.update(changes)
+                raise
+
+    async def flush_async(self):
+        """Persist all dirty users from an executor thread"""
+        try:
+            await self._persist()
+        except Exception as e:
+            logger.error(f"Error flushing user data: {e}")
+
+    def compact(self):
+        """Fold the backend's journal into its snapshot, if it keeps one"""
+        if hasattr(self.backend, 'compact'):
+            with self._write_lock:
+                self.backend.compact()
+
+    async def run_compactor(self, interval):
+        """Background task that compacts the backend every interval seconds"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await loop.run_in_executor(None, self.compact)
+            except Exception as e:
+                logger.error(f"Error compacting user data: {e}")
+
+    async def run_flusher(self):
+        """Background task that persists dirty users every flush_interval seconds"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush_async()
+
+    async def run_refresher(self, interval):
+        """Background task that picks up other processes' changes every interval seconds"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Error refreshing user data: {e}")
+
+
+class StateStore(MutableMapping):
+    """
+    In-memory conversation states (user_id -> state string) with expiry.
+
+    Every state expires `ttl` seconds after it was set, so abandoned flows
+    don't linger. The mapping is snapshotted to `path` periodically and at
+    shutdown; reads and writes never touch the disk.
+    """
+
+    def __init__(self, path, ttl=3600.0, flush_interval=60.0):
+        self.path = path
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        # user_id -> (state, expires_at as a unix timestamp)
+        self._entries = None
+        self._changed = False
+
+    def load(self):
+        entries = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    snapshot = json.load(f)
+            except ValueError as e:
+                logger.error(f"Ignoring unreadable state snapshot {self.path}: {e}")
+                snapshot = {}
+            now = time.time()
+            for user_id, entry in snapshot.items():
+                if isinstance(entry, dict):
+                    entries[user_id] = (entry['state'], entry['expires_at'])
+                else:
+                    # Plain strings from before states had an expiry
+                    entries[user_id] = (entry, now + self.ttl)
+        self._entries = entries
+        self._changed = False
+        return self
+
+    def _live(self):
+        if self._entries is None:
+            self.load()
+        return self._entries
+
+    def __getitem__(self, user_id):
+        entries = self._live()
+        state, expires_at = entries[user_id]
+        if expires_at <= time.time():
+            del entries[user_id]
+            self._changed = True
+            raise KeyError(user_id)
+        return state
+
+    def __setitem__(self, user_id, state):
+        self._live()[user_id] = (state, time.time() + self.ttl)
+        self._changed = True
+
+    def __delitem__(self, user_id):
+        del self._live()[user_id]
+        self._changed = True
+
+    def __iter__(self):
+        now = time.time()
+        return iter([user_id for user_id, (_, expires_at) in self._live().items() if expires_at > now])
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def expire(self):
+        """Drop expired states; returns how many were removed"""
+        now = time.time()
+        entries = self._live()
+        expired = [user_id for user_id, (_, expires_at) in entries.items() if expires_at <= now]
+        for user_id in expired:
+            del entries[user_id]
+        if expired:
+            self._changed = True
+        return len(expired)
+
+    def _take_snapshot(self):
+        """Copy live states for writing; must run on the thread that mutates them"""
+        self.expire()
+        self._changed = False
+        return {
+            user_id: {'state': state, 'expires_at': expires_at}
+            for user_id, (state, expires_at) in self._live().items()
+        }
+
+    def flush(self):
+        """Synchronously write a snapshot if anything changed"""
+        if not self._changed:
+            return
+        try:
+            _write_json_atomic(self.path, self._take_snapshot())
+        except Exception as e:
+            logger.error(f"Error saving user states: {e}")
+            self._changed = True
+
+    async def run_flusher(self):
+        """Background task that snapshots states every flush_interval seconds"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if not self._changed and not self.expire():
+                continue
+            snapshot = self._take_snapshot()
+            try:
+                await loop.run_in_executor(None, _write_json_atomic, self.path, snapshot)
+            except Exception as e:
+                logger.error(f"Error saving user states: {e}")
+                self._changed = True
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+Test script for the scheduler lease and user data shared by several bot processes
+"""
+
+import asyncio
+import os
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+# Add the current directory to Python path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from unittest import mock
+
+from coordination import PARTITIONS, Lease, Membership, partition_of
+from storage import SqliteBackend, UserDataStore
+
+# A process that keeps competing for the lease until it is killed
+CONTENDER = """
+import sys, time
+sys.path.insert(0, {root!r})
+from coordination import PARTITIONS, Lease, Membership, partition_of
+lease = Lease({path!r}, 'reminder_scheduler', ttl=0.6)
+while True:
+    lease.try_acquire()
+    time.sleep(0.2)
+"""
+
+
+def wait_for(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        result = condition()
+        if result:
+            return result
+        time.sleep(0.05)
+    return None
+
+
+def test_one_holder_at_a_time():
+    """Only one process holds the lease; a second one gets it after expiry or release"""
+    path = os.path.join(tempfile.mkdtemp(), 'coordination.db')
+    first = Lease(path, 'scheduler', ttl=0.3)
+    second = Lease(path, 'scheduler', ttl=0.3)
+    assert first.try_acquire() and first.held
+    assert not second.try_acquire() and not second.held
+    assert first.try_acquire()
+    assert second.holder() == first.owner
+
+    time.sleep(0.35)
+    assert not first.held
+    assert second.try_acquire()
+    assert not first.try_acquire()
+    second.release()
+    assert first.try_acquire()
+
+
+def test_failover_between_processes():
+    """When the holding process is killed another one takes over within the lease period"""
+    path = os.path.join(tempfile.mkdtemp(), 'coordination.db')
+    code = CONTENDER.format(root=os.path.dirname(os.path.abspath(__file__)), path=path)
+    processes = [subprocess.Popen([sys.executable, '-c', code]) for _ in range(3)]
+    try:
+        observer = Lease(path, 'reminder_scheduler')
+        leader = wait_for(observer.holder, 10)
+        assert leader is not None
+        # The holder stays the same while it keeps renewing
+        time.sleep(1)
+        assert observer.holder() == leader
+
+        os.kill(int(leader.split(':')[1]), signal.SIGKILL)
+        killed_at = time.monotonic()
+        successor = wait_for(lambda: observer.holder() not in (None, leader) and observer.holder(), 5)
+        assert successor is not None
+        # Lease period plus one renewal interval
+        assert time.monotonic() - killed_at < 0.6 + 0.2 + 0.5
+    finally:
+        for process in processes:
+            process.kill()
+            process.wait()
+
+
+def test_run_stops_work_when_lease_is_lost():
+    """run() starts the work once the lease is held and cancels it when it's taken over"""
+    path = os.path.join(tempfile.mkdtemp(), 'coordination.db')
+
+    async def run():
+        lease = Lease(path, 'scheduler', ttl=0.3)
+        started, cancelled = asyncio.Event(), asyncio.Event()
+
+        async def work():
+            started.set()
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        runner = asyncio.create_task(lease.run(work))
+        await asyncio.wait_for(started.wait(), 2)
+
+        # Another process took the lease over while this one was stalled
+        with sqlite3.connect(path) as conn:
+            conn.execute("UPDATE leases SET owner = 'someone-else', expires_at = ?", (time.time() + 60,))
+        await asyncio.wait_for(cancelled.wait(), 2)
+
+        runner.cancel()
+        try:
+            await runner
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(run())
+
+
+def test_membership_partitions_users():
+    """Live members split the partitions between them and rebalance when one drops out"""
+    path = os.path.join(tempfile.mkdtemp(), 'coordination.db')
+    members = [Membership(path, 'scheduler', member=name, ttl=0.5) for name in ('a', 'b', 'c')]
+    for member in members:
+        member.heartbeat()
+    # Earlier members learn about the later ones on their next heartbeat
+    assert [member.heartbeat() for member in members] == [True, True, False]
+
+    owned = [set(member.partitions) for member in members]
+    assert set.union(*owned) == set(range(PARTITIONS))
+    assert sum(len(partitions) for partitions in owned) == PARTITIONS
+    users = [str(user_id) for user_id in range(1000)]
+    assert all(sum(member.owns(user_id) for member in members) == 1 for user_id in users)
+    assert all(0 < sum(member.owns(user_id) for user_id in users) < 500 for member in members)
+    assert partition_of('42') == partition_of(42)
+
+    # 'c' stops sending heartbeats: it owns nothing once they lapse, and the
+    # other two take its partitions over
+    time.sleep(0.3)
+    members[0].heartbeat()
+    members[1].heartbeat()
+    time.sleep(0.3)
+    assert not members[2].partitions
+    assert members[0].heartbeat() and members[1].heartbeat()
+    assert set(members[0].partitions) | set(members[1].partitions) == set(range(PARTITIONS))
+
+    members[1].leave()
+    assert members[0].heartbeat()
+    assert members[0].partitions == range(PARTITIONS)
+
+
+
+def test_processes_share_sqlite_user_data():
+    """Each process picks up the users the others saved, and writes don't undo theirs"""
+    path = os.path.join(tempfile.mkdtemp(), 'user_data.db')
+    SqliteBackend(path).save({'1': {'notes': {}, 'reminders': {}}})
+    first = UserDataStore(SqliteBackend(path), commit_window=0)
+    second = UserDataStore(SqliteBackend(path), commit_window=0)
+    assert first.shared
+    changed = []
+    first.add_listener(changed.append)
+
+    async def scenario():
+        await first.get_all()
+        await second.get_all()
+        async with second.transaction('1') as user:
+            user['reminders']['r'] = {'title': 'Хлеб'}
+        async with second.transaction('2') as user:
+            user['notes'] = {'n': {'title': 'Новый'}}
+        # Not refreshed yet: a save of another part of the user keeps the reminder
+        async with first.transaction('1') as user:
+            user['notes']['a'] = {'title': 'Заметка'}
+        assert sorted(await first.refresh()) == ['1', '2']
+        assert first.data['1']['notes'] == {'a': {'title': 'Заметка'}}
+        assert first.data['1']['reminders'].keys() == {'r'}
+        assert first.data['2']['notes'] == {'n': {'title': 'Новый'}}
+        assert changed[-2:] in (['1', '2'], ['2', '1'])
+        # Its own saves are not reloaded
+        assert await first.refresh() == []
+        assert await second.refresh() == ['1']
+
+        # A user with unsaved changes keeps them and is reloaded later
+        async with second.transaction('2') as user:
+            user['notes']['m'] = {'title': 'Ещё'}
+        first.data['2']['notes']['local'] = {}
+        first.mark_dirty('2')
+        assert await first.refresh() == []
+        await first.sync()
+        assert await first.refresh() == ['2']
+        assert first.data['2']['notes'].keys() == {'n', 'm', 'local'}
+
+    asyncio.run(scenario())
+
+
+def test_new_leader_sends_what_other_processes_changed():
+    """Taking the scheduler over reloads users and drops the old leader's delivery markers"""
+    import bot
+
+    path = os.path.join(tempfile.mkdtemp(), 'user_data.db')
+    now = bot.datetime.now(bot.DEFAULT_TIMEZONE)
+    standby = UserDataStore(SqliteBackend(path), commit_window=0)
+    leader = UserDataStore(SqliteBackend(path), commit_window=0)
+
+    async def scenario():
+        await standby.get_all()
+        await leader.get_all()
+        async with leader.transaction('1') as user:
+            user['reminders'] = {'a': {'title': 'Хлеб', 'sent': False, 'repeat': 'none'}}
+            bot.set_scheduled_time(user['reminders']['a'], now)
+            # The leader dies in the middle of a pass
+            user['reminders']['a']['delivering'] = user['reminders']['a']['scheduled_at']
+        with mock.patch.object(bot, 'user_store', standby):
+            await bot.take_over_reminders()
+            await standby.sync()
+        reminder = standby.data['1']['reminders']['a']
+        assert 'delivering' not in reminder
+        assert bot.pending_reminder_times(standby.data['1']) == {'a': reminder['scheduled_ts']}
+        assert 'delivering' not in SqliteBackend(path).load_all()['1']['reminders']['a']
+
+    asyncio.run(scenario())
+
+
+def test_rebalance_reloads_gained_users():
+    """Users a worker takes over come from the database with the reminders other processes added"""
+    import bot
+    from scheduler import ReminderQueue
+
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'user_data.db')
+    now = bot.datetime.now(bot.DEFAULT_TIMEZONE)
+    users = [str(user_id) for user_id in range(40)]
+    SqliteBackend(path).save({user_id: {'reminders': {}} for user_id in users})
+    worker = UserDataStore(SqliteBackend(path), commit_window=0)
+    other = UserDataStore(SqliteBackend(path), commit_window=0)
+    members = Membership(os.path.join(tmp, 'coordination.db'), 'scheduler', member='a')
+    members.heartbeat()
+    previous = range(PARTITIONS // 2)
+    kept = [user_id for user_id in users if partition_of(user_id) in previous]
+    gained = [user_id for user_id in users if partition_of(user_id) not in previous]
+    assert kept and gained
+
+    async def scenario():
+        await worker.get_all()
+        worker.add_listener(bot.sync_reminder_queue)
+        # Another process adds reminders, one of its passes in flight
+        await other.get_all()
+        for user_id in users:
+            async with other.transaction(user_id) as user:
+                user['reminders']['a'] = {'title': 'Хлеб', 'sent': False, 'repeat': 'none'}
+                bot.set_scheduled_time(user['reminders']['a'], now)
+                user['reminders']['a']['delivering'] = user['reminders']['a']['scheduled_at']
+        with mock.patch.object(bot, 'user_store', worker), \
+                mock.patch.object(bot, 'scheduler_members', members), \
+                mock.patch.object(bot, 'SCHEDULER_MODE', 'partitioned'), \
+                mock.patch.object(bot, 'reminder_queue', ReminderQueue()) as queue:
+            await bot.rebalance_reminders(previous)
+            # Only the gained users' markers are the other process's leftovers
+            assert queue.count_due(now.timestamp() + 1) == len(gained)
+        assert all('delivering' in worker.data[user_id]['reminders']['a'] for user_id in kept)
+        assert not any('delivering' in worker.data[user_id]['reminders']['a'] for user_id in gained)
+
+    asyncio.run(scenario())
+
+if __name__ == "__main__":
+    test_one_holder_at_a_time()
+    test_failover_between_processes()
+    test_run_stops_work_when_lease_is_lost()
+    test_membership_partitions_users()
+    test_processes_share_sqlite_user_data()
+    test_new_leader_sends_what_other_processes_changed()
+    test_rebalance_reloads_gained_users()
+    print("All coordination tests passed")
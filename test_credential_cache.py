@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Test script for the decrypted credential cache
+"""
+
+import os
+import sys
+import time
+from unittest import mock
+
+# Add the current directory to Python path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import security
+from security import CredentialCache, encrypt_data
+
+
+def test_cache_decrypts_once():
+    """Repeated reads of the same ciphertext hit the cache"""
+    cache = CredentialCache(ttl=60, max_size=10)
+    encrypted = encrypt_data("api-key-123")
+    with mock.patch.object(security, 'decrypt_data', wraps=security.decrypt_data) as decrypt:
+        assert cache.get('1', encrypted) == "api-key-123"
+        assert cache.get('1', encrypted) == "api-key-123"
+        assert decrypt.call_count == 1
+
+        # A new ciphertext for the same user is a different entry
+        assert cache.get('1', encrypt_data("api-key-456")) == "api-key-456"
+        assert decrypt.call_count == 2
+
+
+def test_cache_expires_and_is_bounded():
+    """Entries expire after the TTL and the least recently used are evicted"""
+    cache = CredentialCache(ttl=0.05, max_size=2)
+    first, second, third = (encrypt_data(value) for value in ("a", "b", "c"))
+    cache.get('1', first)
+    cache.get('2', second)
+    cache.get('1', first)
+    cache.get('3', third)
+    assert len(cache) == 2
+    assert ('2', security.hashlib.sha256(second.encode()).hexdigest()) not in cache._entries
+
+    time.sleep(0.1)
+    with mock.patch.object(security, 'decrypt_data', wraps=security.decrypt_data) as decrypt:
+        assert cache.get('1', first) == "a"
+        assert decrypt.call_count == 1
+
+
+def test_cache_invalidation_and_failures():
+    """invalidate() drops a user's entries and failed decryptions aren't cached"""
+    cache = CredentialCache(ttl=60, max_size=10)
+    cache.get('1', encrypt_data("key"))
+    cache.get('2', encrypt_data("key"))
+    cache.invalidate('1')
+    assert len(cache) == 1
+    cache.invalidate()
+    assert len(cache) == 0
+
+    assert cache.get('1', "not-a-token") == "__DECRYPTION_FAILED__"
+    assert len(cache) == 0
+    assert cache.get('1', "") == ""
+
+
+if __name__ == "__main__":
+    test_cache_decrypts_once()
+    test_cache_expires_and_is_bounded()
+    test_cache_invalidation_and_failures()
+    print("All credential cache tests passed")
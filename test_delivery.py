@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Test script for the rate-limited message dispatcher
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+# Add the current directory to Python path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from telegram.error import Forbidden, RetryAfter
+
+from delivery import Dispatcher, TokenBucket
+
+
+def test_token_bucket():
+    """Tokens are handed out at the configured rate and pause() holds them back"""
+    bucket = TokenBucket(rate=10, burst=2)
+    assert bucket.reserve() == 0 and bucket.reserve() == 0
+    assert abs(bucket.reserve() - 0.1) < 0.01
+    assert abs(bucket.reserve() - 0.2) < 0.01
+
+    bucket = TokenBucket(rate=10)
+    bucket.pause(0.5)
+    assert 0.5 < bucket.reserve() <= 0.61
+    assert bucket.idle_for() == 0
+
+
+def test_dispatch_respects_limits():
+    """Messages to different chats go out concurrently, one chat is paced"""
+    sends = []
+
+    async def send(chat_id, text):
+        sends.append((chat_id, time.monotonic()))
+        await asyncio.sleep(0.05)
+
+    async def run():
+        dispatcher = Dispatcher(workers=8, global_rate=1000, chat_rate=10)
+        started = time.monotonic()
+        messages = [(chat_id, {'text': 'hi'}) for chat_id in range(8)] + [(0, {'text': 'again'})] * 2
+        assert await dispatcher.dispatch(send, messages) == [None] * 10
+        return time.monotonic() - started
+
+    elapsed = asyncio.run(run())
+    assert len(sends) == 10
+    # Eight round trips overlapped instead of taking 0.4s one after another
+    assert elapsed < 0.4
+    chat_zero = sorted(at for chat_id, at in sends if chat_id == 0)
+    assert chat_zero[1] - chat_zero[0] >= 0.09 and chat_zero[2] - chat_zero[1] >= 0.09
+
+
+def test_dispatch_retries_after_flood_limit():
+    """RetryAfter re-queues the message after the server's delay; other errors are returned"""
+    attempts = []
+
+    async def send(chat_id, text):
+        attempts.append((chat_id, time.monotonic()))
+        if chat_id == 1 and len([c for c, _ in attempts if c == 1]) == 1:
+            raise RetryAfter(0.2)
+        if chat_id == 2:
+            raise Forbidden("bot was blocked by the user")
+
+    async def run():
+        dispatcher = Dispatcher(workers=4, global_rate=1000, chat_rate=100)
+        return await dispatcher.dispatch(send, [(1, {'text': 'a'}), (2, {'text': 'b'}), (3, {'text': 'c'})])
+
+    errors = asyncio.run(run())
+    assert errors[0] is None and errors[2] is None
+    assert isinstance(errors[1], Forbidden)
+    first, second = [at for chat_id, at in attempts if chat_id == 1]
+    assert second - first >= 0.19
+
+
+
+def test_flood_limit_pauses_every_chat():
+    """A RetryAfter holds back messages to other chats too"""
+    attempts = []
+
+    async def send(chat_id, text):
+        attempts.append((chat_id, time.monotonic()))
+        if chat_id == 1 and len(attempts) == 1:
+            raise RetryAfter(0.2)
+
+    async def run():
+        # One worker, so chat 2 is sent after chat 1 was refused
+        dispatcher = Dispatcher(workers=1, global_rate=1000, chat_rate=100)
+        return await dispatcher.dispatch(send, [(1, {'text': 'a'}), (2, {'text': 'b'})])
+
+    assert asyncio.run(run()) == [None, None]
+    refused, other = attempts[0][1], [at for chat_id, at in attempts if chat_id == 2][0]
+    assert other - refused >= 0.19
+
+if __name__ == "__main__":
+    test_token_bucket()
+    test_dispatch_respects_limits()
+    test_dispatch_retries_after_flood_limit()
+    test_flood_limit_pauses_every_chat()
+    print("All delivery tests passed")
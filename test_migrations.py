@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Test script for user record schema migrations
+"""
+
+import os
+import sys
+
+# Add the current directory to Python path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from migrations import SCHEMA_VERSION, migrate_all, migrate_user, new_user_record
+
+
+def test_new_user_record_is_current():
+    """New users start in the canonical shape and need no migration"""
+    record = new_user_record()
+    assert record['schema_version'] == SCHEMA_VERSION
+    assert record['shopping_list'] == {'Продукты': [], 'Аптека': [], 'Остальное': []}
+    assert record['notes'] == {} and record['reminders'] == {} and record['piggy_banks'] == {}
+    assert not migrate_user(record)
+
+
+def test_legacy_record_is_upgraded_once():
+    """Missing collections are added, reminders get scheduled_at, scheduled_ts and recurrence rules"""
+    data = {
+        '1': {
+            'bybit_api_key': 'enc',
+            'shopping_list': {'Продукты': ['Молоко']},
+            'reminders': {
+                'old': {'title': 'Хлеб', 'date': '18.09.2025', 'time': '09:30', 'sent': False},
+                'bad': {'title': 'Сыр', 'date': 'завтра', 'time': '09:30'},
+                'new': {'title': 'Чай', 'scheduled_at': '2025-09-18T10:00:00+03:00'},
+                'rent': {'title': 'Аренда', 'scheduled_at': '2025-01-31T10:00:00+03:00', 'repeat': 'monthly'}
+            }
+        },
+        '2': new_user_record()
+    }
+    assert migrate_all(data) == ['1']
+
+    user = data['1']
+    assert user['schema_version'] == SCHEMA_VERSION
+    assert user['bybit_api_key'] == 'enc'
+    assert user['shopping_list'] == {'Продукты': ['Молоко'], 'Аптека': [], 'Остальное': []}
+    assert user['notes'] == {} and user['piggy_banks'] == {}
+    assert user['reminders']['old'] == {
+        'title': 'Хлеб', 'date': '', 'time': '', 'sent': False,
+        'scheduled_at': '2025-09-18T09:30:00+03:00', 'scheduled_ts': 1758177000
+    }
+    assert 'scheduled_at' not in user['reminders']['bad'] and 'scheduled_ts' not in user['reminders']['bad']
+    assert user['reminders']['new']['scheduled_at'] == '2025-09-18T10:00:00+03:00'
+    assert user['reminders']['new']['scheduled_ts'] == 1758178800
+    assert 'recurrence' not in user['reminders']['new']
+    # The day of month is kept in the rule, so short months don't move it
+    assert user['reminders']['rent']['recurrence'] == {'freq': 'monthly', 'interval': 1, 'monthday': 31}
+
+    assert migrate_all(data) == []
+
+
+if __name__ == "__main__":
+    test_new_user_record_is_current()
+    test_legacy_record_is_upgraded_once()
+    print("All migration tests passed")
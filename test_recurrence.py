@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Test script for reminder recurrence rules
+"""
+
+import asyncio
+import itertools
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from unittest import mock
+
+# Add the current directory to Python path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import pytz
+
+import bot
+from delivery import DeliveryLedger
+from migrations import new_user_record, set_scheduled_time
+from recurrence import Recurrence, preset
+from storage import JsonFileBackend, UserDataStore
+
+MOSCOW = pytz.timezone('Europe/Moscow')
+
+
+def occurrences(rule, current, n):
+    result = [current]
+    for _ in range(n - 1):
+        current = rule.advance(current)
+        if current is None:
+            break
+        result.append(current)
+    return result
+
+
+def test_monthly_keeps_day_of_month():
+    """A reminder on the 31st falls on the last day of shorter months and comes back to the 31st"""
+    rule = preset('monthly', datetime(2025, 1, 31, 9, 0))
+    assert [o.date().isoformat() for o in occurrences(rule, datetime(2025, 1, 31, 9, 0), 4)] == [
+        '2025-01-31', '2025-02-28', '2025-03-31', '2025-04-30']
+
+    last = Recurrence('monthly', monthday=-1)
+    assert last.next_after(datetime(2024, 1, 31, 9, 0)) == datetime(2024, 2, 29, 9, 0)
+
+    # Second Tuesday of the month, and the last Friday
+    second_tuesday = preset('monthweekday', datetime(2025, 9, 9, 18, 0))
+    assert [o.day for o in occurrences(second_tuesday, datetime(2025, 9, 9, 18, 0), 3)] == [9, 14, 11]
+    last_friday = preset('monthweekday', datetime(2025, 10, 31, 18, 0))
+    assert last_friday.setpos == -1
+    assert last_friday.next_after(datetime(2025, 10, 31, 18, 0)) == datetime(2025, 11, 28, 18, 0)
+
+
+def test_intervals_weekdays_and_limits():
+    """Intervals, weekday sets, until and count"""
+    every_three_days = Recurrence('daily', interval=3)
+    assert every_three_days.next_after(datetime(2025, 1, 1, 8, 0), datetime(2025, 1, 5, 12, 0)) == \
+        datetime(2025, 1, 7, 8, 0)
+
+    # Mondays and Thursdays every other week
+    rule = Recurrence('weekly', interval=2, weekdays=(3, 0))
+    assert [o.strftime('%a %d') for o in occurrences(rule, datetime(2025, 9, 1, 7, 0), 5)] == [
+        'Mon 01', 'Thu 04', 'Mon 15', 'Thu 18', 'Mon 29']
+
+    weekdays = preset('weekdays', datetime(2025, 9, 19, 9, 0))
+    assert weekdays.next_after(datetime(2025, 9, 19, 9, 0)) == datetime(2025, 9, 22, 9, 0)
+
+    until = Recurrence('daily', until=datetime(2025, 1, 3, 23, 59))
+    assert len(occurrences(until, datetime(2025, 1, 1, 9, 0), 10)) == 3
+
+    # Skipped occurrences are counted off too
+    counted = Recurrence('daily', count=5)
+    assert counted.advance(datetime(2025, 1, 1, 9, 0), datetime(2025, 1, 3, 12, 0)) == datetime(2025, 1, 4, 9, 0)
+    assert counted.count == 2
+    assert counted.advance(datetime(2025, 1, 4, 9, 0)) == datetime(2025, 1, 5, 9, 0)
+    assert counted.advance(datetime(2025, 1, 5, 9, 0)) is None
+    assert Recurrence.from_dict(counted.to_dict()) == counted
+
+
+def test_missed_occurrences_are_skipped():
+    """After a long downtime a repeating reminder moves to its next future occurrence without firing"""
+    now = datetime.now(MOSCOW)
+    scheduled = MOSCOW.localize(datetime.combine(now.date() - timedelta(days=30), now.time().replace(microsecond=0)))
+    scheduled -= timedelta(minutes=5)
+    reminder = {'title': 'Таблетки', 'sent': False, 'repeat': 'daily'}
+    set_scheduled_time(reminder, scheduled)
+    data = {'1': new_user_record()}
+    data['1']['reminders'] = {'a': reminder}
+
+    backend = JsonFileBackend(os.path.join(tempfile.mkdtemp(), 'user_data.json'))
+    backend.save(data)
+    store = UserDataStore(backend, commit_window=0)
+    store.load()
+    app = mock.MagicMock()
+    app.bot.send_message = mock.AsyncMock()
+    ledger = DeliveryLedger(os.path.join(tempfile.mkdtemp(), 'delivery_ledger.db'))
+    with mock.patch.object(bot, 'user_store', store), mock.patch.object(bot, 'delivery_ledger', ledger):
+        sent = asyncio.run(bot.deliver_reminders(app, [('1', 'a')], now))
+    assert sent == 0 and app.bot.send_message.call_count == 0
+
+    reminder = backend.load_all()['1']['reminders']['a']
+    next_time = datetime.fromisoformat(reminder['scheduled_at'])
+    assert reminder['sent'] is False
+    assert now < next_time <= now + timedelta(days=1)
+    assert next_time.astimezone(MOSCOW).time() == scheduled.time()
+
+
+def test_preview_and_count():
+    """Occurrences are generated lazily and counted over a range without expanding them"""
+    rule = Recurrence('weekly', weekdays=(0, 2, 4))
+    current = datetime(2025, 9, 1, 8, 0)
+    assert [o.day for o in itertools.islice(rule.occurrences(current), 5)] == [1, 3, 5, 8, 10]
+    # September 2025 has 13 Mondays, Wednesdays and Fridays, over a century about 15,650
+    assert rule.count_between(current, datetime(2025, 9, 1), datetime(2025, 9, 30, 23, 59)) == 13
+    assert 15000 < rule.count_between(current, current, datetime(2125, 9, 1)) < 16000
+
+    limited = Recurrence('daily', count=10)
+    assert len(list(limited.occurrences(current))) == 10
+    assert limited.count_between(current, datetime(2025, 9, 5), datetime(2025, 12, 31)) == 6
+    assert limited.count == 10
+
+
+def test_reminder_view_shows_preview():
+    """The reminder view lists the next occurrences and how many are left this month"""
+    tz = MOSCOW
+    now = datetime.now(tz)
+    reminder = {'title': 'Полив', 'content': 'Цветы', 'sent': False, 'repeat': 'daily',
+                'recurrence': Recurrence('daily').to_dict()}
+    set_scheduled_time(reminder, now + timedelta(hours=1))
+    upcoming = list(itertools.islice(bot.reminder_occurrences(reminder, tz), 4))
+    assert [o - upcoming[0] for o in upcoming] == [timedelta(days=day) for day in range(4)]
+
+    data = {'1': new_user_record()}
+    data['1']['reminders'] = {'a': reminder}
+    backend = JsonFileBackend(os.path.join(tempfile.mkdtemp(), 'user_data.json'))
+    backend.save(data)
+    store = UserDataStore(backend, commit_window=0)
+    store.load()
+    query = mock.MagicMock()
+    query.from_user.id = 1
+    query.edit_message_text = mock.AsyncMock()
+    with mock.patch.object(bot, 'user_store', store):
+        asyncio.run(bot.handle_view_reminder_callback(query, None, 'a'))
+    text = query.edit_message_text.call_args.kwargs['text']
+    assert 'Следующие: ' + upcoming[1].strftime('%d.%m %H:%M') in text
+    month_end = tz.localize(datetime(now.year + now.month // 12, now.month % 12 + 1, 1)) - timedelta(seconds=1)
+    left = sum(1 for day in range(32) if upcoming[0] + timedelta(days=day) <= month_end)
+    assert f'До конца месяца: {left} раз' in text
+
+
+
+def test_reschedule_moves_the_rule():
+    """A rescheduled weekly or monthly reminder repeats from its new day, keeping its end"""
+    user = new_user_record()
+    monday = MOSCOW.localize(datetime(2025, 9, 15, 10, 0))
+    weekly = {'title': 'Спорт', 'sent': False, 'repeat': 'weekly'}
+    set_scheduled_time(weekly, monday)
+    weekly['recurrence'] = dict(preset('weekly', monday.replace(tzinfo=None)).to_dict(), count=5)
+    bot.reschedule_reminder(user, weekly, monday + timedelta(days=2))
+    rule = Recurrence.from_dict(weekly['recurrence'])
+    assert rule.weekdays == (2,) and rule.count == 5
+    assert bot.calculate_next_occurrence(monday + timedelta(days=2), rule, MOSCOW) == monday + timedelta(days=9)
+
+    fifth = MOSCOW.localize(datetime(2025, 9, 5, 9, 0))
+    monthly = {'title': 'Аренда', 'sent': False, 'repeat': 'monthly',
+               'recurrence': dict(preset('monthly', fifth.replace(tzinfo=None)).to_dict(),
+                                  until='2026-06-30T00:00:00')}
+    set_scheduled_time(monthly, fifth)
+    bot.reschedule_reminder(user, monthly, fifth.replace(day=20))
+    rule = Recurrence.from_dict(monthly['recurrence'])
+    assert rule.monthday == 20 and rule.until == datetime(2026, 6, 30)
+    assert bot.calculate_next_occurrence(fifth.replace(day=20), rule, MOSCOW) == MOSCOW.localize(datetime(2025, 10, 20, 9, 0))
+
+    # The same through the "tomorrow" button
+    data = {'1': new_user_record()}
+    data['1']['reminders'] = {'a': weekly}
+    backend = JsonFileBackend(os.path.join(tempfile.mkdtemp(), 'user_data.json'))
+    backend.save(data)
+    store = UserDataStore(backend, commit_window=0)
+    store.load()
+    query = mock.MagicMock()
+    query.from_user.id = 1
+    query.edit_message_text = mock.AsyncMock()
+    with mock.patch.object(bot, 'user_store', store):
+        asyncio.run(bot.handle_reminder_reschedule_tomorrow(query, None, 'a'))
+    tomorrow = datetime.now(MOSCOW).date() + timedelta(days=1)
+    rule = Recurrence.from_dict(store.data['1']['reminders']['a']['recurrence'])
+    assert rule.weekdays == (tomorrow.weekday(),) and rule.count == 5
+
+
+def test_set_repeat_keeps_the_reminder():
+    """Choosing a repeat option stores its rule and leaves the reminder in place"""
+    fifth = MOSCOW.localize(datetime(2025, 9, 5, 9, 0))
+    reminder = {'title': 'Аренда', 'content': 'Аренда', 'sent': False, 'repeat': 'none'}
+    set_scheduled_time(reminder, fifth)
+    data = {'1': new_user_record()}
+    data['1']['reminders'] = {'a': reminder}
+    path = os.path.join(tempfile.mkdtemp(), 'user_data.json')
+    backend = JsonFileBackend(path)
+    backend.save(data)
+    store = UserDataStore(backend, commit_window=0)
+    store.load()
+    query = mock.MagicMock()
+    query.from_user.id = 1
+    query.answer = mock.AsyncMock()
+    query.edit_message_text = mock.AsyncMock()
+    with mock.patch.object(bot, 'user_store', store):
+        asyncio.run(bot.handle_set_repeat_callback(query, None, 'monthly', 'a'))
+
+    saved = JsonFileBackend(path).load_all()['1']['reminders']
+    assert 'a' in saved and saved['a']['repeat'] == 'monthly'
+    assert Recurrence.from_dict(saved['a']['recurrence']).monthday == 5
+    assert 'удалено' not in query.edit_message_text.call_args.kwargs.get('text', '')
+
+if __name__ == "__main__":
+    test_monthly_keeps_day_of_month()
+    test_intervals_weekdays_and_limits()
+    test_missed_occurrences_are_skipped()
+    test_preview_and_count()
+    test_reminder_view_shows_preview()
+    test_reschedule_moves_the_rule()
+    test_set_repeat_keeps_the_reminder()
+    print("All recurrence tests passed")
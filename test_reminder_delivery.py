@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+"""
+Test script for batched reminder delivery
+"""
+
+import ast
+import asyncio
+import os
+import sys
+import tempfile
+from datetime import timedelta
+from unittest import mock
+
+# Add the current directory to Python path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import pytz
+from telegram.error import Forbidden, NetworkError
+
+import bot
+from migrations import new_user_record, set_scheduled_time
+from delivery import DeliveryLedger, Dispatcher
+from scheduler import ReminderQueue
+from storage import JsonFileBackend, UserDataStore
+
+MOSCOW = pytz.timezone('Europe/Moscow')
+
+
+def make_store(data):
+    backend = JsonFileBackend(os.path.join(tempfile.mkdtemp(), 'user_data.json'))
+    backend.save(data)
+    store = UserDataStore(backend, commit_window=0)
+    store.load()
+    return store, backend
+
+
+def make_reminder(scheduled, **fields):
+    reminder = dict({'title': 'Хлеб', 'sent': False, 'repeat': 'none'}, **fields)
+    set_scheduled_time(reminder, scheduled)
+    return reminder
+
+
+def make_ledger():
+    return DeliveryLedger(os.path.join(tempfile.mkdtemp(), 'delivery_ledger.db'))
+
+
+def run_pass(store, due, now, error=None, ledger=None):
+    app = mock.MagicMock()
+    app.bot.send_message = mock.AsyncMock(side_effect=error)
+    with mock.patch.object(bot, 'user_store', store), \
+            mock.patch.object(bot, 'delivery_ledger', make_ledger() if ledger is None else ledger):
+        sent = asyncio.run(bot.deliver_reminders(app, due, now))
+    return sent, app.bot.send_message
+
+
+def test_pass_is_saved_in_one_write():
+    """A pass claims its reminders in the ledger and saves the results in one write"""
+    now = bot.datetime.now(MOSCOW)
+    data = {'1': new_user_record(), '2': new_user_record()}
+    data['1']['reminders'] = {
+        'a': make_reminder(now - timedelta(minutes=5)),
+        'b': make_reminder(now - timedelta(minutes=1), repeat='daily'),
+    }
+    data['2']['reminders'] = {'c': make_reminder(now - timedelta(minutes=2))}
+    store, backend = make_store(data)
+
+    ledger = make_ledger()
+    with mock.patch.object(backend, 'save', wraps=backend.save) as save:
+        sent, send_message = run_pass(store, [('1', 'a'), ('1', 'b'), ('2', 'c')], now, ledger=ledger)
+    assert sent == 3 and send_message.call_count == 3
+    assert save.call_count == 1
+    assert len(ledger) == 3
+
+    on_disk = backend.load_all()
+    assert on_disk['1']['reminders']['a']['sent'] is True
+    assert on_disk['2']['reminders']['c']['sent'] is True
+    daily = on_disk['1']['reminders']['b']
+    assert daily['sent'] is False and 'delivering' not in daily
+    next_time = now - timedelta(minutes=1) + timedelta(days=1)
+    assert daily['scheduled_at'] == next_time.isoformat()
+    assert daily['scheduled_ts'] == int(next_time.timestamp())
+
+
+def test_claimed_reminder_is_not_sent_again():
+    """An occurrence already in the ledger is finished without a second message"""
+    now = bot.datetime.now(MOSCOW)
+    scheduled = now - timedelta(minutes=5)
+    data = {'1': new_user_record()}
+    data['1']['reminders'] = {
+        'a': make_reminder(scheduled),
+        'b': make_reminder(scheduled),
+    }
+    store, backend = make_store(data)
+    # Sent by another instance, or before a restart that lost the results
+    ledger = make_ledger()
+    assert ledger.claim([('1', 'a', scheduled.isoformat(), scheduled.timestamp())]) == [True]
+    assert ledger.claim([('1', 'a', scheduled.isoformat(), scheduled.timestamp())]) == [False]
+
+    sent, send_message = run_pass(store, [('1', 'a'), ('1', 'b')], now, ledger=ledger)
+    assert sent == 1
+    assert send_message.call_count == 1
+    assert send_message.call_args.kwargs['reply_markup'].inline_keyboard[0][0].callback_data.endswith('_b')
+    reminders = backend.load_all()['1']['reminders']
+    assert reminders['a']['sent'] is True and 'delivering' not in reminders['a']
+    assert reminders['b']['sent'] is True
+
+
+def test_interrupted_pass_leaves_no_delivering_marker():
+    """Markers of a pass that fails midway, or of a crashed process, don't hide reminders"""
+    now = bot.datetime.now(MOSCOW)
+    data = {'1': new_user_record()}
+    data['1']['reminders'] = {'a': make_reminder(now - timedelta(minutes=5))}
+    store, backend = make_store(data)
+
+    ledger = make_ledger()
+    with mock.patch.object(ledger, 'claim', side_effect=OSError('disk I/O error')):
+        try:
+            run_pass(store, [('1', 'a')], now, ledger=ledger)
+            assert False, 'the ledger error should propagate'
+        except OSError:
+            pass
+    reminder = store.data['1']['reminders']['a']
+    assert 'delivering' not in reminder
+    assert bot.pending_reminder_times(store.data['1']) == {'a': reminder['scheduled_ts']}
+    sent, _ = run_pass(store, [('1', 'a')], now, ledger=ledger)
+    assert sent == 1
+
+    # A marker saved before the process died is dropped at startup
+    user = {'reminders': {'b': make_reminder(now, delivering=now.isoformat()), 'c': make_reminder(now)}}
+    assert bot.clear_stale_deliveries({'2': user, '3': new_user_record()}) == ['2']
+    assert 'b' in bot.pending_reminder_times(user)
+
+
+def test_cancelled_pass_releases_unsent_claims():
+    """A pass cancelled mid-send gives back the claims of unsent messages, so the next pass sends them"""
+    now = bot.datetime.now(MOSCOW)
+    data = {'1': new_user_record(), '2': new_user_record()}
+    data['1']['reminders'] = {'a': make_reminder(now - timedelta(minutes=5))}
+    data['2']['reminders'] = {'b': make_reminder(now - timedelta(minutes=5))}
+    store, backend = make_store(data)
+    ledger = make_ledger()
+    hang = asyncio.Event()
+
+    async def send_message(chat_id, **kwargs):
+        if chat_id == 2:
+            await hang.wait()
+
+    async def scenario():
+        app = mock.MagicMock()
+        app.bot.send_message = send_message
+        pass_task = asyncio.ensure_future(bot.deliver_reminders(app, [('1', 'a'), ('2', 'b')], now))
+        while len(ledger) < 2:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.1)
+        # E.g. the scheduler lease was lost while chat 2 was being sent to
+        pass_task.cancel()
+        try:
+            await pass_task
+            assert False, 'the pass should have been cancelled'
+        except asyncio.CancelledError:
+            pass
+
+    with mock.patch.object(bot, 'user_store', store), mock.patch.object(bot, 'delivery_ledger', ledger), \
+            mock.patch.object(bot, 'reminder_dispatcher', Dispatcher(global_rate=1000, chat_rate=1000)):
+        asyncio.run(scenario())
+    # Only the message that went out is still claimed
+    assert len(ledger) == 1
+    assert not any('delivering' in user['reminders'][reminder_id]
+                   for user, reminder_id in ((store.data['1'], 'a'), (store.data['2'], 'b')))
+
+    with mock.patch.object(bot, 'reminder_dispatcher', Dispatcher(global_rate=1000, chat_rate=1000)):
+        sent, send_message = run_pass(store, [('1', 'a'), ('2', 'b')], now, ledger=ledger)
+    assert sent == 1 and send_message.call_count == 1
+    assert send_message.call_args.kwargs['chat_id'] == 2
+    # The one sent before the cancel is finished, not sent again
+    assert store.data['1']['reminders']['a']['sent'] is True
+    assert store.data['2']['reminders']['b']['sent'] is True
+
+
+def test_failed_delivery_backs_off_then_dead_letters():
+    """Failures are kept in the outbox with a growing retry time until given up"""
+    now = bot.datetime.now(MOSCOW)
+    data = {'1': new_user_record()}
+    data['1']['reminders'] = {'a': make_reminder(now - timedelta(minutes=5))}
+    store, backend = make_store(data)
+
+    ledger = make_ledger()
+    sent, _ = run_pass(store, [('1', 'a')], now, error=NetworkError("timed out"), ledger=ledger)
+    assert sent == 0
+    # The claim is released so the retry can be sent
+    assert len(ledger) == 0
+    reminder = backend.load_all()['1']['reminders']['a']
+    job = reminder['delivery']
+    assert job['attempts'] == 1 and job['last_error'] == "timed out"
+    assert now.timestamp() + 15 <= job['next_attempt_at'] <= now.timestamp() + 31
+    assert reminder['sent'] is False and 'delivering' not in reminder
+    assert bot.pending_reminder_times(store.data['1']) == {'a': job['next_attempt_at']}
+
+    # Not retried before its time
+    sent, send_message = run_pass(store, [('1', 'a')], now)
+    assert send_message.call_count == 0
+
+    with mock.patch.object(bot, 'DELIVERY_MAX_ATTEMPTS', 2):
+        later = now + timedelta(minutes=1)
+        run_pass(store, [('1', 'a')], later, error=NetworkError("timed out"))
+    job = backend.load_all()['1']['reminders']['a']['delivery']
+    assert job['attempts'] == 2 and job['state'] == 'dead'
+    assert bot.pending_reminder_times(store.data['1']) == {}
+
+
+def test_retry_due_within_the_second_is_sent():
+    """Retry times are compared with fractions of a second, and early pops go back in the queue"""
+    now = bot.datetime.now(MOSCOW).replace(microsecond=600000)
+    data = {'1': new_user_record()}
+    retry = make_reminder(now - timedelta(minutes=5))
+    # Due 0.3s into the current second, i.e. already due at `now`
+    retry['delivery'] = {'occurrence': retry['scheduled_at'], 'attempts': 1, 'last_error': 'timed out',
+                         'next_attempt_at': int(now.timestamp()) + 0.3}
+    data['1']['reminders'] = {'a': retry, 'b': make_reminder(now + timedelta(minutes=5))}
+    store, _ = make_store(data)
+
+    queue = ReminderQueue()
+    with mock.patch.object(bot, 'reminder_queue', queue), mock.patch.object(bot, 'user_store', store):
+        sent, _ = run_pass(store, [('1', 'a'), ('1', 'b')], now)
+        assert sent == 1
+        assert store.data['1']['reminders']['a']['sent'] is True
+        # 'b' isn't due for five minutes and is back in the queue
+        assert queue.count_due(now.timestamp() + 301) == 1
+        assert queue.pop_due(now.timestamp() + 301) == [('1', 'b')]
+
+
+def test_blocked_chat_stops_reminders():
+    """A user who blocked the bot drops out of scheduling until they write again"""
+    now = bot.datetime.now(MOSCOW)
+    data = {'1': new_user_record()}
+    data['1']['reminders'] = {
+        'a': make_reminder(now - timedelta(minutes=5)),
+        'b': make_reminder(now + timedelta(hours=1)),
+    }
+    store, backend = make_store(data)
+
+    run_pass(store, [('1', 'a')], now, error=Forbidden("Forbidden: bot was blocked by the user"))
+    assert 'blocked' in backend.load_all()['1']['reminders_blocked']['error']
+    assert bot.pending_reminder_times(store.data['1']) == {}
+
+    update = mock.MagicMock()
+    update.effective_user.id = 1
+    handler = mock.AsyncMock()
+    with mock.patch.object(bot, 'user_store', store):
+        asyncio.run(bot.per_user(handler)(update, None))
+    assert handler.call_count == 1
+    assert set(bot.pending_reminder_times(store.data['1'])) == {'a', 'b'}
+
+
+def test_partitioned_worker_sends_only_its_users():
+    """In partitioned mode a process skips users outside its partitions"""
+    now = bot.datetime.now(MOSCOW)
+    data = {'1': new_user_record(), '2': new_user_record()}
+    data['1']['reminders'] = {'a': make_reminder(now - timedelta(minutes=5))}
+    data['2']['reminders'] = {'b': make_reminder(now - timedelta(minutes=5))}
+    store, backend = make_store(data)
+
+    with mock.patch.object(bot, 'owns_reminders', lambda user_id: user_id == '2'):
+        sent, send_message = run_pass(store, [('1', 'a'), ('2', 'b')], now)
+    assert sent == 1
+    assert send_message.call_args.kwargs['chat_id'] == 2
+    assert backend.load_all()['1']['reminders']['a']['sent'] is False
+
+
+def test_ledger_prunes_old_entries():
+    """Entries past the retention period are dropped on the next claim"""
+    ledger = make_ledger()
+    ledger.retention = 3600
+    now = bot.time.time()
+    ledger.claim([('1', 'old', 'o', now - 7200), ('1', 'new', 'n', now - 60)])
+    ledger._pruned_at = 0
+    ledger.claim([('2', 'x', 'x', now)])
+    assert len(ledger) == 2
+
+
+def test_startup_catch_up_streams_backlog_in_order():
+    """After downtime the scheduler sends the backlog oldest first, one commit per batch"""
+    now = bot.datetime.now(MOSCOW)
+    data = {str(user_id): new_user_record() for user_id in range(1, 6)}
+    for index in range(250):
+        due = now - timedelta(minutes=250 - index)
+        data[str(index % 5 + 1)]['reminders'][f'r{index}'] = make_reminder(due, title=str(index))
+    store, backend = make_store(data)
+
+    sent = []
+
+    async def send_message(chat_id, text, reply_markup):
+        sent.append(int(text.split('"')[1]))
+
+    async def run():
+        app = mock.MagicMock()
+        app.bot.send_message = send_message
+        scheduler = asyncio.create_task(bot.run_reminder_scheduler(app))
+        # Starting the scheduler doesn't wait for the backlog
+        assert not sent
+        for _ in range(200):
+            if len(sent) == 250:
+                break
+            await asyncio.sleep(0.05)
+        scheduler.cancel()
+
+    with mock.patch.object(bot, 'user_store', store), \
+            mock.patch.object(bot, 'delivery_ledger', make_ledger()), \
+            mock.patch.object(bot, 'reminder_queue', ReminderQueue()), \
+            mock.patch.object(bot, 'reminder_dispatcher', Dispatcher(global_rate=10000, chat_rate=10000)), \
+            mock.patch.object(bot, 'REMINDER_BATCH_SIZE', 100), \
+            mock.patch.object(backend, 'save', wraps=backend.save) as save:
+        bot.sync_reminder_queue()
+        asyncio.run(run())
+
+    assert sorted(sent) == list(range(250))
+    # Messages of a batch go out concurrently, batches in due order
+    batches = [sent[start:start + 100] for start in range(0, 250, 100)]
+    assert all(max(batches[i]) < min(batches[i + 1]) for i in range(len(batches) - 1))
+    assert save.call_count == 3
+    assert all(reminder['sent'] for user in backend.load_all().values() for reminder in user['reminders'].values())
+
+
+def test_bot_defines_everything_before_main_guard():
+    """Nothing is defined after `if __name__ == "__main__"`, which blocks under `python bot.py`"""
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py'), encoding='utf-8') as f:
+        body = ast.parse(f.read()).body
+    guard = next(index for index, node in enumerate(body)
+                 if isinstance(node, ast.If) and '__main__' in ast.unparse(node.test))
+    assert guard == len(body) - 1
+
+
+if __name__ == "__main__":
+    test_pass_is_saved_in_one_write()
+    test_claimed_reminder_is_not_sent_again()
+    test_interrupted_pass_leaves_no_delivering_marker()
+    test_cancelled_pass_releases_unsent_claims()
+    test_failed_delivery_backs_off_then_dead_letters()
+    test_retry_due_within_the_second_is_sent()
+    test_blocked_chat_stops_reminders()
+    test_partitioned_worker_sends_only_its_users()
+    test_ledger_prunes_old_entries()
+    test_startup_catch_up_streams_backlog_in_order()
+    test_bot_defines_everything_before_main_guard()
+    print("All reminder delivery tests passed")
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Test script for the reminder scheduling queue
+"""
+
+import asyncio
+import math
+import os
+import random
+import sys
+import time
+
+# Add the current directory to Python path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from scheduler import ReminderQueue, TimingWheel
+
+# Both engines, the wheel starting at the epoch like the timestamps below
+ENGINES = (ReminderQueue, lambda: TimingWheel(now_ts=0))
+
+
+def test_queue_orders_and_reschedules():
+    """Reminders come out by due time; rescheduled and cancelled ones are skipped"""
+    for engine in ENGINES:
+        check_queue_orders_and_reschedules(engine())
+
+
+def check_queue_orders_and_reschedules(queue):
+    queue.schedule('1', 'a', 30)
+    queue.schedule('1', 'b', 10)
+    queue.schedule('2', 'c', 20)
+    assert queue.next_due() == 10
+
+    queue.schedule('1', 'b', 40)
+    queue.cancel('2', 'c')
+    assert len(queue) == 2 and ('2', 'c') not in queue
+    assert queue.next_due() == 30
+    assert queue.pop_due(35) == [('1', 'a')]
+    assert queue.pop_due(35) == []
+    assert queue.pop_due(40) == [('1', 'b')]
+    assert queue.next_due() is None
+
+
+def test_replace_user():
+    """replace_user() leaves exactly the given reminders queued for that user"""
+    for engine in ENGINES:
+        check_replace_user(engine())
+
+
+def check_replace_user(queue):
+    queue.replace_user(1, {'a': 10, 'b': 20})
+    queue.schedule('2', 'c', 15)
+    queue.replace_user(1, {'b': 5})
+    assert len(queue) == 2
+    assert sorted(queue.pop_due(100)) == [('1', 'b'), ('2', 'c')]
+    queue.replace_user('1', {})
+    assert len(queue) == 0
+
+
+def test_backlog_pops_oldest_first_in_batches():
+    """With a limit, a backlog of due reminders comes out oldest first, the rest stays queued"""
+    for engine in ENGINES:
+        queue = engine()
+        due_times = list(range(1, 251))
+        random.shuffle(due_times)
+        for index, due_ts in enumerate(due_times):
+            queue.schedule(str(index % 7), f'r{due_ts}', due_ts)
+        queue.schedule('9', 'later', 1000)
+        assert queue.count_due(500) == 250
+
+        batches = []
+        while True:
+            batch = queue.pop_due(500, 100)
+            if not batch:
+                break
+            batches.append([int(reminder_id[1:]) for _, reminder_id in batch])
+        assert [len(batch) for batch in batches] == [100, 100, 50]
+        assert sum(batches, []) == list(range(1, 251))
+        assert len(queue) == 1 and queue.pop_due(1000) == [('9', 'later')]
+
+
+def test_wait_due_sleeps_until_head():
+    """The waiter wakes for a reminder that becomes the new head while it sleeps"""
+    async def run(queue):
+        queue.schedule('1', 'late', time.time() + 30)
+        waiter = asyncio.create_task(queue.wait_due())
+        await asyncio.sleep(0.05)
+        assert not waiter.done()
+
+        started = time.monotonic()
+        queue.schedule('1', 'soon', time.time() + 0.1)
+        assert await asyncio.wait_for(waiter, 2) == [('1', 'soon')]
+        assert time.monotonic() - started >= 0.09
+        assert ('1', 'late') in queue
+
+    for engine in (ReminderQueue, TimingWheel):
+        asyncio.run(run(engine()))
+
+
+def test_wheel_matches_heap():
+    """Across all wheels and the overflow set the wheel pops what the heap pops"""
+    rng = random.Random(7)
+    heap, wheel = ReminderQueue(), TimingWheel(now_ts=1000)
+    for step in range(3000):
+        user_id, reminder_id = str(rng.randrange(50)), str(rng.randrange(20))
+        if rng.random() < 0.2:
+            heap.cancel(user_id, reminder_id)
+            wheel.cancel(user_id, reminder_id)
+        else:
+            # Seconds to 90 days ahead, plus some already overdue
+            due_ts = 1000 + rng.choice((-5, 30, 600, 7200, 200000, 90 * 86400)) * rng.random()
+            heap.schedule(user_id, reminder_id, due_ts)
+            wheel.schedule(user_id, reminder_id, due_ts)
+    assert len(heap) == len(wheel)
+
+    now = 1000
+    while len(heap):
+        assert wheel.next_due() <= math.ceil(heap.next_due())
+        now += rng.choice((1, 45, 3000, 50000, 400000))
+        # The wheel counts whole seconds, so compare at second boundaries
+        assert sorted(wheel.pop_due(now)) == sorted(heap.pop_due(now))
+    assert len(wheel) == 0 and wheel.next_due() is None
+
+
+if __name__ == "__main__":
+    test_queue_orders_and_reschedules()
+    test_replace_user()
+    test_backlog_pops_oldest_first_in_batches()
+    test_wait_due_sleeps_until_head()
+    test_wheel_matches_heap()
+    print("All scheduler tests passed")
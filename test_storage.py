@@ -0,0 +1,488 @@
+#!/usr/bin/env python3
+"""
+Test script for the in-memory user data repository
+"""
+
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from unittest import mock
+
+# Add the current directory to Python path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import storage
+from storage import (
+    UserDataStore, StateStore, JsonFileBackend, ShardedJsonBackend, SqliteBackend, JournalBackend,
+    migrate_json_to_shards, migrate_json_to_sqlite
+)
+
+
+def test_store_serves_reads_from_memory():
+    """Data is loaded once and flushed only when marked dirty"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'user_data.json')
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'1': {'piggy_banks': {}}}, f)
+
+        store = UserDataStore(JsonFileBackend(path))
+        data = store.data
+        assert store.data is data
+
+        # Changes on disk are not re-read on every access
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({}, f)
+        assert '1' in store.data
+
+        data['1']['piggy_banks']['Отпуск'] = {'current': 0, 'target': 100}
+        store.flush()
+        with open(path, 'r', encoding='utf-8') as f:
+            assert json.load(f) == {}
+
+        store.mark_dirty('1')
+        store.flush()
+        with open(path, 'r', encoding='utf-8') as f:
+            assert json.load(f)['1']['piggy_banks']['Отпуск']['target'] == 100
+
+
+def test_background_flusher():
+    """The flusher persists dirty users without an explicit flush()"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'user_data.json')
+        store = UserDataStore(JsonFileBackend(path), flush_interval=0.01)
+        store.load()
+
+        async def scenario():
+            task = asyncio.create_task(store.run_flusher())
+            store.data['7'] = {'reminders': {}}
+            store.mark_dirty('7')
+            await asyncio.sleep(0.1)
+            task.cancel()
+
+        asyncio.run(scenario())
+        with open(path, 'r', encoding='utf-8') as f:
+            assert json.load(f) == {'7': {'reminders': {}}}
+
+
+def test_async_api_keeps_disk_io_off_the_loop():
+    """get_all() loads and flush_async() writes from executor threads"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'user_data.json')
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'1': {'notes': {}}}, f)
+        backend = JsonFileBackend(path)
+        threads = []
+        for name in ('load_all', 'save'):
+            method = getattr(backend, name)
+
+            def recorded(*args, method=method):
+                threads.append(threading.get_ident())
+                return method(*args)
+            setattr(backend, name, recorded)
+
+        store = UserDataStore(backend)
+
+        async def scenario():
+            # Concurrent first reads share a single load
+            first, second = await asyncio.gather(store.get_all(), store.get_all())
+            assert first is second
+            assert await store.get_user(1) == {'notes': {}}
+            assert await store.get_user('2') is None
+
+            first['2'] = {'notes': {}}
+            await store.commit('2')
+            await store.flush_async()
+            return threading.get_ident()
+
+        loop_thread = asyncio.run(scenario())
+        assert len(threads) == 2
+        assert loop_thread not in threads
+        with open(path, 'r', encoding='utf-8') as f:
+            assert '2' in json.load(f)
+
+
+def test_transactions_serialize_per_user():
+    """Read-modify-write blocks of one user never interleave; other users don't wait"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'user_data.json')
+        store = UserDataStore(JsonFileBackend(path), commit_window=0.01)
+        order = []
+
+        async def deposit(user_id, amount):
+            async with store.transaction(user_id) as user:
+                current = user.get('current', 0)
+                order.append(('start', user_id))
+                await asyncio.sleep(0.01)
+                user['current'] = current + amount
+                order.append(('end', user_id))
+
+        async def nested():
+            # The lock is re-entrant within a task
+            async with store.lock('3'):
+                async with store.transaction('3') as user:
+                    user['nested'] = True
+
+        async def scenario():
+            await asyncio.gather(deposit('1', 10), deposit('1', 5), deposit('2', 1), nested())
+
+        asyncio.run(scenario())
+        assert store.data['1']['current'] == 15
+        assert store.data['3'] == {'nested': True}
+        # User 2 ran while user 1's first transaction was in progress
+        assert order.index(('start', '2')) < order.index(('end', '1'))
+        starts = [i for i, step in enumerate(order) if step == ('start', '1')]
+        ends = [i for i, step in enumerate(order) if step == ('end', '1')]
+        assert ends[0] < starts[1]
+        # Every transaction was committed to disk when its block exited
+        with open(path, 'r', encoding='utf-8') as f:
+            assert json.load(f) == store.data
+
+
+def test_failed_transaction_rolls_back():
+    """A block that raises leaves the user as it was and writes nothing"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'user_data.json')
+        store = UserDataStore(JsonFileBackend(path), commit_window=0.01)
+
+        async def scenario():
+            async with store.transaction('1') as user:
+                user['piggy_banks'] = {'Отпуск': {'current': 10}}
+            saves = []
+            with mock.patch.object(store.backend, 'save', side_effect=saves.append):
+                try:
+                    async with store.transaction('1') as user:
+                        user['piggy_banks']['Отпуск']['current'] = 0
+                        user['notes'] = {}
+                        raise ValueError('half done')
+                except ValueError:
+                    pass
+                try:
+                    async with store.transaction('2') as user:
+                        user['notes'] = {'1': {}}
+                        raise ValueError('new user')
+                except ValueError:
+                    pass
+                await store.sync()
+            assert saves == []
+            assert store.data == {'1': {'piggy_banks': {'Отпуск': {'current': 10}}}}
+
+        asyncio.run(scenario())
+
+
+def test_group_commit_coalesces_saves():
+    """Commits within the window share one write and return once it is durable"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'user_data.json')
+        backend = JsonFileBackend(path)
+        store = UserDataStore(backend, commit_window=0.05)
+        store.load()
+
+        async def save(user_id):
+            store.data[user_id] = {'notes': {}}
+            await store.commit(user_id)
+            # Acknowledged only after the batch reached the disk
+            with open(path, 'r', encoding='utf-8') as f:
+                assert user_id in json.load(f)
+
+        async def scenario():
+            await asyncio.gather(*(save(str(user_id)) for user_id in range(20)))
+            await save('late')
+
+        with mock.patch.object(backend, 'save', wraps=backend.save) as write:
+            asyncio.run(scenario())
+            assert write.call_count == 2
+            assert len(write.call_args_list[0].args[0]) == 20
+
+
+def test_stale_snapshot_is_not_written():
+    """An older snapshot never overwrites a newer one"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'user_data.json')
+        store = UserDataStore(JsonFileBackend(path))
+        store.load()
+        store.data['1'] = {'value': 1}
+        store.mark_dirty('1')
+        old_seq, old_changes = store._take_dirty()
+
+        store.data['1']['value'] = 2
+        store.mark_dirty('1')
+        store.flush()
+        store._write(old_seq, old_changes)
+
+        with open(path, 'r', encoding='utf-8') as f:
+            assert json.load(f)['1']['value'] == 2
+
+
+def test_json_save_reserializes_only_changed_users():
+    """Untouched users are written from their cached serialized form"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'user_data.json')
+        data = {str(user_id): {'notes': {'1': {'title': 'Заметка'}}, 'shopping_list': {}} for user_id in range(50)}
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+
+        store = UserDataStore(JsonFileBackend(path))
+        store.load()
+        store.data['7']['notes']['2'] = {'title': 'Новая'}
+        store.data['100'] = {}
+        store.mark_dirty('7')
+        store.mark_dirty('100')
+        with mock.patch.object(storage, '_dump_user_fragment', wraps=storage._dump_user_fragment) as dump:
+            store.flush()
+            assert dump.call_count == 2
+
+        data['7']['notes']['2'] = {'title': 'Новая'}
+        data['100'] = {}
+        with open(path, 'r', encoding='utf-8') as f:
+            assert f.read() == json.dumps(data, indent=2, ensure_ascii=False)
+
+
+def test_sharded_save_touches_only_changed_shard():
+    """Saving one user rewrites only that user's file"""
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = os.path.join(tmp, 'user_data')
+        backend = ShardedJsonBackend(directory)
+        backend.save({'1': {'n': 1}, '2': {'n': 2}})
+        other = os.path.join(directory, backend.shard_name('2'))
+        before = os.stat(other).st_mtime_ns
+
+        store = UserDataStore(ShardedJsonBackend(directory))
+        assert store.data == {'1': {'n': 1}, '2': {'n': 2}}
+        store.data['1']['n'] = 10
+        store.mark_dirty('1')
+        store.flush()
+
+        assert os.stat(other).st_mtime_ns == before
+        assert ShardedJsonBackend(directory).load_all()['1'] == {'n': 10}
+
+
+def test_migrate_json_to_shards():
+    """The monolithic file is split into hash buckets without losing users"""
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, 'user_data.json')
+        data = {str(user_id): {'reminders': {}} for user_id in range(20)}
+        with open(source, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+
+        directory = os.path.join(tmp, 'user_data')
+        assert migrate_json_to_shards(source, directory, shard_count=4) == 20
+        assert len(os.listdir(directory)) <= 4
+        assert ShardedJsonBackend(directory, 4).load_all() == data
+
+
+def test_sqlite_round_trip():
+    """Records come back from SQLite exactly as they were saved"""
+    user = {
+        'bybit_api_key': 'enc-key',
+        'bybit_api_secret': 'enc-secret',
+        'piggy_banks': {'Отпуск': {'current': 0, 'target': 1000.0}},
+        'shopping_list': {'Продукты': ['Молоко', 'Хлеб'], 'Аптека': [], 'Остальное': []},
+        'notes': {'1': {'title': 'Заметка', 'content': 'Текст'}},
+        'reminders': {
+            '100': {'title': 'Хлеб', 'content': 'Хлеб', 'date': '', 'time': '', 'repeat': 'daily',
+                    'scheduled_at': '2025-09-18T09:00:00+03:00', 'sent': False}
+        }
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'user_data.db')
+        backend = SqliteBackend(path)
+        backend.save({'1': user})
+        backend.close()
+
+        backend = SqliteBackend(path)
+        assert backend.load_all() == {'1': user}
+        assert backend._conn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+        assert backend._conn.execute("PRAGMA synchronous").fetchone()[0] == 2
+        indexes = {row[1] for row in backend._conn.execute("PRAGMA index_list(reminders)")}
+        assert 'idx_reminders_due' in indexes
+        backend.close()
+
+
+def test_sqlite_save_touches_only_changed_rows():
+    """A save writes the rows that changed and leaves the user's other rows alone"""
+    user = {
+        'piggy_banks': {'Отпуск': {'current': 0, 'target': 1000.0}},
+        'shopping_list': {'Продукты': ['Молоко'], 'Аптека': ['Бинт']},
+        'notes': {'1': {'title': 'Заметка', 'content': 'Текст'}, '2': {'title': 'Вторая', 'content': ''}},
+        'reminders': {'100': {'title': 'Хлеб', 'scheduled_at': '2025-09-18T09:00:00+03:00', 'sent': False}}
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'user_data.db')
+        backend = SqliteBackend(path)
+        backend.save({'1': user})
+        backend.close()
+
+        backend = SqliteBackend(path)
+        record = backend.load_all()['1']
+        note_rowid = backend._conn.execute("SELECT id FROM notes WHERE note_id = '1'").fetchone()[0]
+        statements = []
+        backend._conn.set_trace_callback(statements.append)
+
+        record['shopping_list']['Продукты'].append('Хлеб')
+        del record['notes']['2']
+        backend.save({'1': record})
+        writes = [sql for sql in statements
+                  if sql.startswith(('INSERT', 'UPDATE', 'DELETE')) and 'user_changes' not in sql]
+        assert len(writes) == 4, writes
+        assert not any('reminders' in sql or 'piggy_banks' in sql or 'Аптека' in sql for sql in writes)
+
+        # Nothing changed, nothing written
+        statements.clear()
+        backend.save({'1': record})
+        assert not [sql for sql in statements if sql.startswith(('INSERT', 'UPDATE', 'DELETE'))]
+
+        record['reminders']['100']['sent'] = True
+        backend.save({'1': record})
+        backend.close()
+
+        backend = SqliteBackend(path)
+        assert backend.load_all() == {'1': record}
+        assert backend._conn.execute("SELECT id FROM notes WHERE note_id = '1'").fetchone()[0] == note_rowid
+        backend.close()
+
+
+def test_migrate_json_to_sqlite():
+    """A JSON file is copied into SQLite as it was, due times included"""
+    data = {
+        '1': {'reminders': {
+            'a': {'title': 'a', 'scheduled_at': '2025-01-01T10:00:00+00:00', 'sent': False},
+            'b': {'title': 'b', 'scheduled_at': '2025-01-01T10:00:00+00:00', 'sent': True},
+            'c': {'title': 'c', 'sent': False}
+        }}
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, 'user_data.json')
+        with open(source, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        path = os.path.join(tmp, 'user_data.db')
+        assert migrate_json_to_sqlite(source, path) == 1
+
+        backend = SqliteBackend(path)
+        assert backend.load_all()['1']['reminders'] == data['1']['reminders']
+        assert backend._conn.execute(
+            "SELECT reminder_id, scheduled_ts FROM reminders ORDER BY reminder_id").fetchall() == [
+            ('a', 1735725600), ('b', 1735725600), ('c', 0)]
+        backend.close()
+
+
+def test_journal_appends_only_changed_fields():
+    """A save appends the changed paths and replay restores the records"""
+    with tempfile.TemporaryDirectory() as tmp:
+        snapshot = os.path.join(tmp, 'user_data.json')
+        journal = os.path.join(tmp, 'user_data.journal')
+        with open(snapshot, 'w', encoding='utf-8') as f:
+            json.dump({'1': {'piggy_banks': {'Отпуск': {'current': 0, 'target': 100}}, 'notes': {'1': {}}}}, f)
+
+        store = UserDataStore(JournalBackend(snapshot, journal))
+        store.data['1']['piggy_banks']['Отпуск']['current'] = 50
+        del store.data['1']['notes']['1']
+        store.data['2'] = {'reminders': {}}
+        store.mark_dirty()
+        store.flush()
+
+        with open(journal, 'r', encoding='utf-8') as f:
+            entries = {entry['user_id']: entry['ops'] for entry in map(json.loads, f)}
+        assert entries == {
+            '1': [['set', ['piggy_banks', 'Отпуск', 'current'], 50], ['del', ['notes', '1']]],
+            '2': [['set', [], {'reminders': {}}]]
+        }
+        assert JournalBackend(snapshot, journal).load_all() == store.data
+
+
+def test_journal_compaction_and_torn_tail():
+    """compact() folds the journal into the snapshot; a torn last line is skipped"""
+    with tempfile.TemporaryDirectory() as tmp:
+        snapshot = os.path.join(tmp, 'user_data.json')
+        journal = os.path.join(tmp, 'user_data.journal')
+        store = UserDataStore(JournalBackend(snapshot, journal))
+        store.load()
+        store.data['1'] = {'n': 1}
+        store.mark_dirty('1')
+        store.flush()
+        store.data['1']['n'] = 2
+        store.mark_dirty('1')
+        store.flush()
+
+        with open(journal, 'a', encoding='utf-8') as f:
+            f.write('{"user_id": "1", "ops": [["set", ["n"]')
+        assert JournalBackend(snapshot, journal).load_all() == {'1': {'n': 2}}
+        with open(journal, 'r', encoding='utf-8') as f:
+            assert f.read().endswith('\n')
+
+        store.compact()
+        assert os.path.getsize(journal) == 0
+        with open(snapshot, 'r', encoding='utf-8') as f:
+            assert json.load(f) == {'1': {'n': 2}}
+
+
+def test_journal_failed_append_is_retried():
+    """A change whose append failed is written again by the next flush"""
+    with tempfile.TemporaryDirectory() as tmp:
+        snapshot = os.path.join(tmp, 'user_data.json')
+        journal = os.path.join(tmp, 'user_data.journal')
+        store = UserDataStore(JournalBackend(snapshot, journal))
+        store.load()
+        store.data['1'] = {'x': 1}
+        store.mark_dirty('1')
+        store.flush()
+
+        store.data['1']['x'] = 2
+        store.mark_dirty('1')
+        with mock.patch.object(storage.os, 'fsync', side_effect=OSError('disk full')):
+            store.flush()
+        # The torn write never made it to disk
+        with open(journal, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'user_id': '1', 'ops': [['set', [], {'x': 1}]]}) + '\n')
+
+        store.flush()
+        assert JournalBackend(snapshot, journal).load_all() == {'1': {'x': 2}}
+
+
+def test_state_store_expiry_and_snapshot():
+    """States expire after the TTL and are only written on flush"""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'user_states.json')
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'1': 'ADDING_ITEM_Продукты'}, f, ensure_ascii=False)
+
+        states = StateStore(path, ttl=0.05)
+        assert states['1'] == 'ADDING_ITEM_Продукты'
+        states['2'] = 'DEPOSITING_Отпуск'
+        with open(path, 'r', encoding='utf-8') as f:
+            assert '2' not in json.load(f)
+
+        states.flush()
+        restored = StateStore(path, ttl=0.05)
+        assert restored['2'] == 'DEPOSITING_Отпуск'
+
+        time.sleep(0.1)
+        assert '1' not in restored
+        assert len(restored) == 0
+        restored.flush()
+        with open(path, 'r', encoding='utf-8') as f:
+            assert json.load(f) == {}
+
+
+if __name__ == "__main__":
+    test_store_serves_reads_from_memory()
+    test_background_flusher()
+    test_async_api_keeps_disk_io_off_the_loop()
+    test_transactions_serialize_per_user()
+    test_failed_transaction_rolls_back()
+    test_group_commit_coalesces_saves()
+    test_stale_snapshot_is_not_written()
+    test_json_save_reserializes_only_changed_users()
+    test_sharded_save_touches_only_changed_shard()
+    test_migrate_json_to_shards()
+    test_sqlite_round_trip()
+    test_sqlite_save_touches_only_changed_rows()
+    test_migrate_json_to_sqlite()
+    test_journal_appends_only_changed_fields()
+    test_journal_compaction_and_torn_tail()
+    test_journal_failed_append_is_retried()
+    test_state_store_expiry_and_snapshot()
+    print("All storage tests passed")
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Test script for per-user timezones and recurrence across DST changes
+"""
+
+import os
+import sys
+from datetime import datetime, timedelta
+
+# Add the current directory to Python path
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import bot
+from migrations import DEFAULT_TIMEZONE, get_timezone, migrate_user, new_user_record, user_timezone
+
+BERLIN = get_timezone('Europe/Berlin')
+
+
+def test_users_get_a_timezone():
+    """New and migrated users are in Moscow time until they choose another zone"""
+    assert new_user_record()['timezone'] == 'Europe/Moscow'
+    record = {'schema_version': 3, 'reminders': {}}
+    migrate_user(record)
+    assert user_timezone(record) is DEFAULT_TIMEZONE
+
+    assert user_timezone({'timezone': 'Europe/Berlin'}) is BERLIN
+    assert user_timezone({'timezone': 'Mars/Olympus'}) is DEFAULT_TIMEZONE
+    assert get_timezone('Mars/Olympus') is None
+
+
+def test_daily_reminder_keeps_local_time_across_dst():
+    """A daily 9:00 reminder stays at 9:00 local time when the clocks change"""
+    before = BERLIN.localize(datetime(2025, 3, 29, 9, 0))
+    after = bot.calculate_next_occurrence(before, 'daily', BERLIN)
+    assert after.strftime('%Y-%m-%d %H:%M %z') == '2025-03-30 09:00 +0200'
+    # Only 23 hours pass on the day the clocks go forward
+    assert after - before == timedelta(hours=23)
+
+    autumn = bot.calculate_next_occurrence(BERLIN.localize(datetime(2025, 10, 25, 9, 0)), 'daily', BERLIN)
+    assert autumn.strftime('%Y-%m-%d %H:%M %z') == '2025-10-26 09:00 +0100'
+
+    # A time that doesn't exist on the next day moves forward past the gap
+    gap = bot.calculate_next_occurrence(BERLIN.localize(datetime(2025, 3, 29, 2, 30)), 'daily', BERLIN)
+    assert gap.strftime('%Y-%m-%d %H:%M %z') == '2025-03-30 03:30 +0200'
+
+    # A stored occurrence with a fixed offset is stepped in the user's zone
+    stored = datetime.fromisoformat('2025-03-29T09:00:00+01:00')
+    assert bot.calculate_next_occurrence(stored, 'weekly', BERLIN).isoformat() == '2025-04-05T09:00:00+02:00'
+
+
+def test_natural_dates_use_the_users_today():
+    """'завтра' is tomorrow in the user's timezone, not the server's"""
+    tz = get_timezone('Pacific/Kiritimati')
+    parsed = bot.parse_natural_date('завтра 10:15', tz)
+    assert parsed.tzinfo is None
+    assert parsed.date() == datetime.now(tz).date() + timedelta(days=1)
+    assert (parsed.hour, parsed.minute) == (10, 15)
+
+
+if __name__ == "__main__":
+    test_users_get_a_timezone()
+    test_daily_reminder_keeps_local_time_across_dst()
+    test_natural_dates_use_the_users_today()
+    print("All timezone tests passed")